@@ -1,24 +1,30 @@
 # app.py
 import os
-import sys
-import io
-from flask import Flask, render_template, request, jsonify
+import time
+from flask import Flask, render_template, request, jsonify, make_response
 from werkzeug.utils import secure_filename  # For secure file uploads
 
-# --- UTF-8 Setup (if needed for Flask's environment, though Flask handles Unicode well) ---
-# This might not be strictly necessary here as Flask/browsers handle UTF-8 well
-# but keeping it for consistency if other parts of your system expect it.
-if sys.stdout.encoding != 'utf-8':
-    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
-if sys.stderr.encoding != 'utf-8':
-    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
-# --- End UTF-8 Setup ---
+# stdout/stderr are rewrapped as UTF-8 by the entry point (see __main__ below), not at import:
+# importing APP into a WSGI server or a test harness must not replace the process-wide streams.
 
 # Import your existing logic. Assume they are in the same directory or PYTHONPATH
-from input_parser import process_input_section  # We'll adapt this slightly
-from text_extractor import extract_text_from_txt, extract_text_from_pdf, transcribe_audio_gcp
-from deidentifier import basic_deidentify_text
+# text_extractor (PDF parsing, Speech-to-Text client) and audio_preprocessing (NumPy) are imported inside collect_section_texts,
+# and note_processing_core defers its Vertex AI / Entrez imports, so the index page is served without
+# waiting on any of the heavy SDKs.
+import chunked_uploads
+from deid_service import deidentify_documents
+from identifier_redactor import IdentifierRedactor, extract_known_identifiers
+from input_budget import INPUT_FORM_FIELD_MAX_BYTES, InputBudget, InputTooLarge
+import note_archive
 import note_processing_core as core  # Your main note generation logic
+from model_traffic_replay import get_traffic_recorder
+from note_rendering import render_cache_stats, render_note_html
+import patient_fact_store
+from prefix_cache import get_prefix_cache
+from request_coalescing import SingleFlight, request_fingerprint
+from request_profiler import PROFILE_HEADER, profile_request, profile_stage
+from response_compression import compress_response
+from run_store import new_run_id
 
 app = Flask(__name__)
 
@@ -27,33 +33,57 @@ UPLOAD_FOLDER = 'uploads'  # Create this folder in your project directory
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'wav', 'mp3', 'm4a'}  # Add more as needed
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 32 * 1024 * 1024  # 32 MB upload limit (adjust as needed)
+# Largest text field werkzeug will parse into memory; the per-section caps are checked after parsing (input_budget).
+app.config['MAX_FORM_MEMORY_SIZE'] = INPUT_FORM_FIELD_MAX_BYTES
+
+# Duplicate /generate_note submissions (double-clicks, browser retries) share one pipeline run.
+# Results are kept for IDEMPOTENCY_WINDOW_SECONDS under the client's Idempotency-Key header.
+IDEMPOTENCY_WINDOW_SECONDS = int(os.getenv("IDEMPOTENCY_WINDOW_SECONDS", "600"))
+note_generation_flight = SingleFlight(idempotency_ttl_seconds=IDEMPOTENCY_WINDOW_SECONDS)
 
 # --- GCP Configuration (move to a config file or env variables for production) ---
 GCP_PROJECT_ID_FOR_SPEECH = core.PROJECT_ID  # Assuming it's the same as for Vertex AI
+chunked_uploads.set_extraction_project_id(GCP_PROJECT_ID_FOR_SPEECH)
 
 
 # ----------------------------------------------------------------------------------
 
+@app.after_request
+def compress_after_request(response):
+    # gzip/brotli by Accept-Encoding for JSON, HTML and text bodies (see response_compression).
+    return compress_response(response, request.accept_encodings)
+
+
 def allowed_file(filename):
     return '.' in filename and \
         filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def process_uploaded_files_and_text(form_data, files_data, section_name_prefix, deidentify_flag):
+SECTION_NAMES = ("background", "additional", "transcription", "revised")
+SECTION_SEPARATOR = "\n\n---\n\n"
+
+
+def collect_section_texts(form_data, files_data, section_name_prefix, budget=None):
     """
-    Processes direct text input and uploaded files for a given section.
+    Collects the raw direct text input and the text extracted from uploaded files for a given section.
+    De-identification happens afterwards, for all sections in one batch (see deid_service).
     `form_data`: request.form from Flask
     `files_data`: request.files from Flask
     `section_name_prefix`: e.g., "background"
-    `deidentify_flag`: boolean
+    `budget`: optional input_budget.InputBudget; each text is counted as it is added (raises InputTooLarge).
+    Returns a list of texts.
     """
     section_texts = []
 
+    def add_text(text):
+        if budget is not None:
+            budget.add(section_name_prefix, text)
+        section_texts.append(text)
+
     # Process direct text input
     direct_text = form_data.get(f'{section_name_prefix}_text')
     if direct_text:
-        processed_text = basic_deidentify_text(direct_text) if deidentify_flag else direct_text
-        section_texts.append(processed_text)
+        add_text(direct_text)
         print(f"DEBUG: Added direct text for {section_name_prefix}")
 
     # Process uploaded files
@@ -62,6 +92,15 @@ def process_uploaded_files_and_text(form_data, files_data, section_name_prefix,
     # For simplicity, let's assume a single file input per category for now,
     # or adapt to handle `request.files.getlist(f"{section_name_prefix}_files")` for multiple.
 
+    # Files sent through the chunked upload API (see /uploads) arrive as an upload ID; their text was
+    # extracted while the chunks were coming in, so this usually returns immediately.
+    upload_id = form_data.get(f'{section_name_prefix}_upload_id')
+    if upload_id:
+        filename, extracted_text = chunked_uploads.get_extracted_text(upload_id)
+        if extracted_text:
+            add_text(extracted_text)
+            print(f"DEBUG: Added extracted text of chunked upload {filename} for {section_name_prefix}")
+
     file_key = f'{section_name_prefix}_file'  # Assuming single file input named like 'background_file'
     if file_key in files_data:
         file = files_data[file_key]
@@ -74,30 +113,69 @@ def process_uploaded_files_and_text(form_data, files_data, section_name_prefix,
             extracted_text = None
             ext = filename.rsplit('.', 1)[1].lower()
             if ext == 'txt':
+                from text_extractor import extract_text_from_txt
                 extracted_text = extract_text_from_txt(temp_file_path)
             elif ext == 'pdf':
+                from text_extractor import extract_text_from_pdf
                 extracted_text = extract_text_from_pdf(temp_file_path)
             elif ext in {'wav', 'mp3', 'm4a'}:  # Add other audio extensions
                 if GCP_PROJECT_ID_FOR_SPEECH:
-                    extracted_text = transcribe_audio_gcp(temp_file_path, GCP_PROJECT_ID_FOR_SPEECH)
+                    # Downmixed to 16 kHz mono, silence cut, and transcribed as parallel chunks with timestamps.
+                    from audio_preprocessing import transcribe_audio_file
+                    try:
+                        extracted_text, audio = transcribe_audio_file(temp_file_path, GCP_PROJECT_ID_FOR_SPEECH)
+                        print(f"DEBUG: {filename}: {audio.removed_seconds:.1f}s of {audio.original_seconds:.1f}s "
+                              f"removed as silence before transcription.")
+                    except RuntimeError as e:
+                        print(f"ERROR: Could not preprocess audio file {filename}: {e}")
                 else:
                     print("ERROR: GCP_PROJECT_ID_FOR_SPEECH not configured for audio transcription.")
 
-            if extracted_text:
-                processed_text = basic_deidentify_text(extracted_text) if deidentify_flag else extracted_text
-                section_texts.append(processed_text)
-                print(f"DEBUG: Extracted and processed text from {filename}")
-
             # Clean up the temporary file
             try:
                 os.remove(temp_file_path)
                 print(f"DEBUG: Removed temporary file {temp_file_path}")
             except OSError as e:
                 print(f"Error deleting temporary file {temp_file_path}: {e}")
+
+            if extracted_text:
+                add_text(extracted_text)
+                print(f"DEBUG: Extracted text from {filename}")
         elif file and file.filename != '':
             print(f"WARNING: File type not allowed for {file.filename}")
 
-    return "\n\n---\n\n".join(filter(None, section_texts))
+    return [text for text in section_texts if text]
+
+
+def process_sections(form_data, files_data, deidentify_flag, patient_id=None):
+    """
+    Returns ({section_name: text}, background_document_hashes) for all input sections.
+    When de-identifying, the known identifiers (background header blocks plus the known_identifiers field) are
+    first replaced with consistent surrogates in one pass over every collected text; the regex chain, including
+    the generic name guess for names the dictionary did not know, then runs on the whole batch on the process
+    pool (see deid_service).
+    For a patient ID the surrogates are numbered with the patient's surrogate key, so they are the same at every
+    visit, and background_document_hashes are the hashes of the background documents as uploaded (see
+    patient_fact_store); otherwise it is None.
+    Raises input_budget.InputTooLarge when the collected text is over the per-request size caps.
+    """
+    budget = InputBudget()
+    with profile_stage("collect_sections"):
+        collected = {name: collect_section_texts(form_data, files_data, name, budget) for name in SECTION_NAMES}
+    background_document_hashes = None
+    if patient_id:
+        background_document_hashes = patient_fact_store.uploaded_document_hashes(collected["background"])
+    if deidentify_flag:
+        flat = [text for name in SECTION_NAMES for text in collected[name]]
+        with profile_stage("deidentify"):
+            identifiers = extract_known_identifiers(collected["background"], form_data.get('known_identifiers', ''))
+            if identifiers:
+                surrogate_key = patient_fact_store.surrogate_key(patient_id) if patient_id else None
+                flat, _ = IdentifierRedactor(identifiers, surrogate_key).redact_sections(flat)
+            deidentified = iter(deidentify_documents(flat))
+        collected = {name: [next(deidentified) for _ in collected[name]] for name in SECTION_NAMES}
+    sections = {name: SECTION_SEPARATOR.join(filter(None, texts)) for name, texts in collected.items()}
+    return sections, background_document_hashes
 
 
 @app.route('/')
@@ -110,36 +188,104 @@ def index():
 
 @app.route('/generate_note', methods=['POST'])
 def generate_note_route():
+    # Opt-in profiling (X-Profile-Request header or PROFILE_SAMPLE_RATE); the profile ID is returned in a header.
+    with profile_request("generate_note", request.headers.get(PROFILE_HEADER)) as profile:
+        response = make_response(_generate_note())
+    if profile is not None:
+        response.headers['X-Profile-Id'] = profile.profile_id
+    return response
+
+
+def _wants_html():
+    """Whether the client asked for the note rendered server-side (render=html in the form or query string)."""
+    return (request.form.get('render') or request.args.get('render')) == 'html'
+
+
+def _note_response(run_id, note):
+    payload = {'note': note, 'run_id': run_id}
+    if _wants_html():
+        with profile_stage("render_html"):
+            payload['note_html'] = render_note_html(note)
+    return jsonify(payload)
+
+
+def _generate_note():
     try:
         print("DEBUG: /generate_note endpoint hit")
-        deidentify = request.form.get('deidentify') == 'on'  # Checkbox value
-        print(f"DEBUG: De-identify flag: {deidentify}")
-
-        background_info = process_uploaded_files_and_text(request.form, request.files, "background", deidentify)
-        additional_info = process_uploaded_files_and_text(request.form, request.files, "additional", deidentify)
-        transcription = process_uploaded_files_and_text(request.form, request.files, "transcription", deidentify)
-        revised_info = process_uploaded_files_and_text(request.form, request.files, "revised", deidentify)
-
-        print("\n--- Summary of Processed Inputs for Core Logic (first 100 chars) ---")
-        print(f"Background Info: {background_info[:100]}...")
-        print(f"Additional Info: {additional_info[:100]}...")
-        print(f"Transcription: {transcription[:100]}...")
-        print(f"Revised Info: {revised_info[:100]}...")
-        print("----------------------------------------------------")
-
-        # Call your core note generation logic
-        generated_note = core.generate_full_note(
-            background_info_text=background_info,
-            additional_info_text=additional_info,
-            transcription_text=transcription,
-            revised_info_text=revised_info
-        )
-
-        if "ERROR:" in generated_note:
-            return jsonify({'error': generated_note}), 500
-
-        return jsonify({'note': generated_note})
+        idempotency_key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key')
+        stored_result = note_generation_flight.get_idempotent_result(idempotency_key)
+        if stored_result is not None:
+            print(f"DEBUG: Returning stored result for idempotency key {idempotency_key}")
+            stored_run_id, stored_note = stored_result
+            return _note_response(stored_run_id, stored_note)
+
+        # Resuming a failed run: the inputs and completed stages come from the run store, nothing is re-uploaded.
+        resume_run_id = request.form.get('resume_run_id')
+        if resume_run_id:
+            print(f"DEBUG: Resume requested for run {resume_run_id}")
+            (run_id, generated_note), shared = note_generation_flight.do(
+                f"resume:{resume_run_id}",
+                lambda: (resume_run_id, core.resume_full_note(resume_run_id))
+            )
+        else:
+            deidentify = request.form.get('deidentify') == 'on'  # Checkbox value
+            print(f"DEBUG: De-identify flag: {deidentify}")
+            # Optional pseudonymous patient ID: prior documents already processed for it are not processed again.
+            patient_id = request.form.get('patient_id', '').strip() or None
+            if patient_id and not patient_fact_store.is_valid_patient_id(patient_id):
+                return jsonify({'error': 'Invalid patient ID (letters, digits, ".", "_" and "-" only, '
+                                         'at most 64 characters).'}), 400
+
+            sections, background_document_hashes = process_sections(
+                request.form, request.files, deidentify, patient_id)
+            background_info = sections["background"]
+            additional_info = sections["additional"]
+            transcription = sections["transcription"]
+            revised_info = sections["revised"]
+
+            print("\n--- Summary of Processed Inputs for Core Logic (first 100 chars) ---")
+            print(f"Background Info: {background_info[:100]}...")
+            print(f"Additional Info: {additional_info[:100]}...")
+            print(f"Transcription: {transcription[:100]}...")
+            print(f"Revised Info: {revised_info[:100]}...")
+            print("----------------------------------------------------")
+
+            # Call your core note generation logic, once per distinct set of inputs currently in flight.
+            # Duplicates share the first request's run ID as well as its note.
+            request_key = request_fingerprint(background_info, additional_info, transcription, revised_info, deidentify,
+                                              patient_id)
+
+            def run_pipeline():
+                pipeline_run_id = new_run_id()
+                # With MODEL_TRAFFIC_RECORD_DIR set, de-identified runs are recorded for offline replay; runs that
+                # send identifiable text to the model never are.
+                traffic = get_traffic_recorder() if deidentify else None
+                return pipeline_run_id, core.generate_full_note(
+                    background_info_text=background_info,
+                    additional_info_text=additional_info,
+                    transcription_text=transcription,
+                    revised_info_text=revised_info,
+                    run_id=pipeline_run_id,
+                    context=core.new_pipeline_context(run_id=pipeline_run_id, traffic=traffic),
+                    patient_id=patient_id,
+                    background_document_hashes=background_document_hashes
+                )
+
+            (run_id, generated_note), shared = note_generation_flight.do(request_key, run_pipeline)
+        print(f"DEBUG: Note generation for run {run_id} "
+              f"{'shared with an identical in-flight request' if shared else 'completed'}. "
+              f"Coalescing stats: {note_generation_flight.stats()}")
+
+        if "ERROR:" in generated_note or generated_note.startswith("FAILED TO GENERATE"):
+            # The run ID lets the client resume from the last completed stage instead of starting over.
+            return jsonify({'error': generated_note, 'run_id': run_id}), 500
 
+        note_generation_flight.store_idempotent_result(idempotency_key, (run_id, generated_note))
+        return _note_response(run_id, generated_note)
+
+    except (chunked_uploads.UploadError, InputTooLarge) as e:
+        print(f"ERROR in /generate_note: {e}")
+        return jsonify({'error': str(e)}), e.status
     except Exception as e:
         print(f"ERROR in /generate_note: {e}")
         import traceback
@@ -147,8 +293,110 @@ def generate_note_route():
         return jsonify({'error': f'An unexpected error occurred: {str(e)}'}), 500
 
 
+@app.route('/uploads', methods=['POST'])
+def initiate_upload_route():
+    """Starts a chunked upload. Body: {"filename", "size"}. Returns the upload ID and chunk layout."""
+    payload = request.get_json(silent=True) or request.form
+    try:
+        size = int(payload.get('size', 0))
+        session = chunked_uploads.initiate_upload(secure_filename(payload.get('filename', '')), size,
+                                                  ALLOWED_EXTENSIONS)
+    except ValueError:
+        return jsonify({'error': 'size must be an integer'}), 400
+    except chunked_uploads.UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    return jsonify(session.status()), 201
+
+
+@app.route('/uploads/<upload_id>/chunks/<int:chunk_index>', methods=['PUT'])
+def upload_chunk_route(upload_id, chunk_index):
+    """Receives one chunk as the raw request body, with its hex SHA-256 in the X-Chunk-SHA256 header."""
+    try:
+        session = chunked_uploads.write_chunk(upload_id, chunk_index, request.stream,
+                                              request.headers.get('X-Chunk-SHA256'))
+    except chunked_uploads.UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    return jsonify({'upload_id': upload_id, 'chunk': chunk_index,
+                    'received': len(session.received), 'total_chunks': session.total_chunks})
+
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status_route(upload_id):
+    """Lists received and missing chunks, so an interrupted upload can resume with only the missing ones."""
+    try:
+        return jsonify(chunked_uploads.get_upload(upload_id).status())
+    except chunked_uploads.UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload_route(upload_id):
+    payload = request.get_json(silent=True) or request.form
+    try:
+        session = chunked_uploads.finalize_upload(upload_id, payload.get('sha256'))
+    except chunked_uploads.UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    return jsonify(session.status())
+
+
+@app.route('/patients/<patient_id>', methods=['GET', 'DELETE'])
+def patient_facts_route(patient_id):
+    """What the patient fact store holds for a patient (counts only), or deletes it."""
+    if not patient_fact_store.is_valid_patient_id(patient_id):
+        return jsonify({'error': 'Invalid patient ID.'}), 400
+    if request.method == 'DELETE':
+        if not patient_fact_store.delete_patient(patient_id):
+            return jsonify({'error': 'Unknown patient ID.'}), 404
+        return jsonify({'deleted': patient_id})
+    summary = patient_fact_store.patient_summary(patient_id)
+    if summary is None:
+        return jsonify({'error': 'Unknown patient ID.'}), 404
+    return jsonify(summary)
+
+
+@app.route('/notes/search', methods=['GET'])
+def search_notes_route():
+    """
+    Archived notes matching ?q= in ?field=diagnosis|differential|heading, optionally from the last ?since_days=,
+    newest first.
+    """
+    query = request.args.get('q', '')
+    try:
+        since_days = float(request.args.get('since_days', 0))
+        limit = min(int(request.args.get('limit', 50)), 500)
+        results = note_archive.search_notes(query, field=request.args.get('field', 'diagnosis'), limit=limit,
+                                            since=time.time() - since_days * 86400 if since_days else None)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'query': query, 'results': results})
+
+
+@app.route('/notes/<run_id>', methods=['GET'])
+def archived_note_route(run_id):
+    """
+    The archived final note and stage outputs of a completed run (?render=html adds final_note_html).
+    Archived notes do not change, so the response has an ETag and a revalidation returns 304.
+    """
+    note = note_archive.get_note(run_id)
+    if note is None:
+        return jsonify({'error': f'Run {run_id} is not in the note archive.'}), 404
+    if _wants_html():
+        note['final_note_html'] = render_note_html(note['final_note'])
+    response = jsonify(note)
+    response.headers['Cache-Control'] = 'private, no-cache'  # Browser may keep it but must revalidate.
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@app.route('/generate_note/stats', methods=['GET'])
+def generate_note_stats_route():
+    prefix_cache = get_prefix_cache()
+    return jsonify({'coalescing': note_generation_flight.stats(),
+                    'prefix_cache': prefix_cache.stats() if prefix_cache else {'backend': 'off'},
+                    'note_rendering': render_cache_stats()})
+
+
 if __name__ == '__main__':
-    # Ensure core Vertex AI initialization happens when generate_full_note is called
-    # Or initialize it once here if preferred, but core.py also does it.
-    # core.initialize_vertex_ai() # Optional: initialize once at app start
+    core.ensure_utf8_stdio()
+    # Vertex AI is initialized once, by the first generate_full_note call of the process.
     app.run(debug=True)  # debug=True is for development only
\ No newline at end of file
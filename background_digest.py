@@ -0,0 +1,204 @@
+# background_digest.py
+# Map-reduce pre-summarization of oversized "Background Information" input.
+# Long outside records are split into chunks, each chunk is summarized (in parallel) into a fixed set
+# of clinical headings, and the chunk summaries are merged into one structured digest that the
+# downstream prompts use instead of the raw text. Chunk summaries are cached on disk by content hash,
+# so the same records uploaded again at the next visit cost no model calls.
+import hashlib
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+# Raw background text longer than this is replaced by the digest in downstream prompts.
+BACKGROUND_DIGEST_THRESHOLD_CHARS = int(os.getenv("BACKGROUND_DIGEST_THRESHOLD_CHARS", "20000"))
+BACKGROUND_CHUNK_CHARS = int(os.getenv("BACKGROUND_CHUNK_CHARS", "8000"))
+BACKGROUND_DIGEST_MAX_WORKERS = int(os.getenv("BACKGROUND_DIGEST_MAX_WORKERS", "4"))
+BACKGROUND_DIGEST_CACHE_DIR = os.getenv("BACKGROUND_DIGEST_CACHE_DIR", os.path.join("cache", "background_digest"))
+
+DIGEST_SECTIONS = ("Diagnoses and History", "Medications", "Imaging", "Cognitive Scores", "Labs")
+
+# Bump when CHUNK_SUMMARY_PROMPT changes so stale cached summaries are not reused.
+CHUNK_SUMMARY_PROMPT_VERSION = "1"
+
+CHUNK_SUMMARY_PROMPT = """You are summarizing one part of a patient's prior medical records for a neurology clinic.
+Extract ONLY facts that are explicitly stated in the excerpt below. Do not infer or add information.
+Keep numbers, units, dates of tests, drug names and doses exactly as written.
+
+Use exactly these headings, in this order, each followed by short bullet points:
+### Diagnoses and History
+### Medications
+### Imaging
+### Cognitive Scores
+### Labs
+
+Under a heading with nothing relevant in the excerpt, write a single bullet "- None in this excerpt."
+
+Records excerpt:
+---
+{chunk}
+---
+"""
+
+_EMPTY_BULLET_RE = re.compile(r"^-\s*none in this excerpt\.?$", re.IGNORECASE)
+_PARAGRAPH_BREAK_RE = re.compile(r"\n\s*\n")
+
+
+def _iter_paragraphs(text):
+    """The pieces of re.split(r"\n\s*\n", text), one at a time rather than as a list of the whole text."""
+    start = 0
+    for match in _PARAGRAPH_BREAK_RE.finditer(text):
+        yield text[start:match.start()]
+        start = match.end()
+    yield text[start:]
+
+
+def split_background_into_chunks(text, chunk_chars=BACKGROUND_CHUNK_CHARS):
+    """
+    Splits text into chunks of at most `chunk_chars`, breaking at paragraph boundaries where possible.
+    A single paragraph longer than `chunk_chars` is split on line boundaries, then hard-split.
+    """
+    chunks = []
+    current = []
+    current_len = 0
+
+    def flush():
+        nonlocal current, current_len
+        if current:
+            chunks.append("\n\n".join(current))
+        current = []
+        current_len = 0
+
+    for paragraph in _iter_paragraphs(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        pieces = [paragraph]
+        if len(paragraph) > chunk_chars:
+            pieces = []
+            for line in paragraph.splitlines():
+                while len(line) > chunk_chars:
+                    pieces.append(line[:chunk_chars])
+                    line = line[chunk_chars:]
+                pieces.append(line)
+        for piece in pieces:
+            if current and current_len + len(piece) + 2 > chunk_chars:
+                flush()
+            current.append(piece)
+            current_len += len(piece) + 2
+    flush()
+    return chunks
+
+
+def _chunk_cache_path(chunk, model_name):
+    key_source = f"{CHUNK_SUMMARY_PROMPT_VERSION}\x00{model_name}\x00{chunk}".encode("utf-8")
+    digest = hashlib.sha256(key_source).hexdigest()
+    return os.path.join(BACKGROUND_DIGEST_CACHE_DIR, digest[:2], f"{digest}.txt")
+
+
+def _read_cached_summary(cache_path):
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _write_cached_summary(cache_path, summary):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(summary)
+        os.replace(tmp_path, cache_path)  # Atomic, so concurrent requests never read a partial file.
+    except OSError as e:
+        print(f"WARNING: Could not write background digest cache entry {cache_path}: {e}")
+
+
+def raw_chunk_summary(chunk):
+    """What summarize_background_chunk returns for a chunk the model could not summarize."""
+    return f"### Diagnoses and History\n{chunk}"
+
+
+def summarize_background_chunk(chunk, generate_fn, model_name):
+    """
+    Returns (summary_text, from_cache). `generate_fn(prompt)` must return the model's text response.
+    On a model error the raw chunk is returned (and not cached) so no information is dropped.
+    """
+    cache_path = _chunk_cache_path(chunk, model_name)
+    cached = _read_cached_summary(cache_path)
+    if cached is not None:
+        return cached, True
+    try:
+        summary = generate_fn(CHUNK_SUMMARY_PROMPT.format(chunk=chunk)).strip()
+    except Exception as e:
+        print(f"ERROR summarizing background chunk ({len(chunk)} chars): {e}. Using raw chunk text.")
+        return raw_chunk_summary(chunk), False
+    if not summary:
+        return raw_chunk_summary(chunk), False
+    _write_cached_summary(cache_path, summary)
+    return summary, False
+
+
+def collect_section_lines(chunk_summaries):
+    """
+    Collects the bullets under each DIGEST_SECTIONS heading across all chunk summaries (in chunk order),
+    dropping "None in this excerpt" bullets and exact duplicate lines. Returns {section: [line, ...]}.
+    """
+    section_lines = {section: [] for section in DIGEST_SECTIONS}
+    seen = {section: set() for section in DIGEST_SECTIONS}
+    heading_lookup = {section.lower(): section for section in DIGEST_SECTIONS}
+
+    for summary in chunk_summaries:
+        current_section = DIGEST_SECTIONS[0]
+        for line in summary.splitlines():
+            stripped = line.strip()
+            if not stripped:
+                continue
+            heading_match = re.match(r"^#{1,4}\s*(.+?)\s*:?\s*$", stripped)
+            if heading_match and heading_match.group(1).lower() in heading_lookup:
+                current_section = heading_lookup[heading_match.group(1).lower()]
+                continue
+            if _EMPTY_BULLET_RE.match(stripped):
+                continue
+            normalized = stripped.lower()
+            if normalized in seen[current_section]:
+                continue
+            seen[current_section].add(normalized)
+            section_lines[current_section].append(stripped)
+    return section_lines
+
+
+def merge_chunk_summaries(chunk_summaries):
+    """Reduce step: one "### <section>" block per DIGEST_SECTIONS heading (see collect_section_lines)."""
+    section_lines = collect_section_lines(chunk_summaries)
+    parts = []
+    for section in DIGEST_SECTIONS:
+        lines = section_lines[section] or ["- None documented in the provided records."]
+        parts.append(f"### {section}\n" + "\n".join(lines))
+    return "\n\n".join(parts)
+
+
+def build_background_digest(background_text, generate_fn, model_name):
+    """
+    Map (parallel per-chunk summaries, cached by content hash) and reduce (merge by heading).
+    Returns the digest text, prefixed with a short provenance header.
+    """
+    chunks = split_background_into_chunks(background_text)
+    print(f"DEBUG: Building background digest from {len(chunks)} chunks ({len(background_text)} chars).")
+    with ThreadPoolExecutor(max_workers=max(1, min(BACKGROUND_DIGEST_MAX_WORKERS, len(chunks)))) as executor:
+        results = list(executor.map(lambda c: summarize_background_chunk(c, generate_fn, model_name), chunks))
+    cache_hits = sum(1 for _, from_cache in results if from_cache)
+    print(f"DEBUG: Background digest chunk summaries: {len(results)} total, {cache_hits} from cache.")
+
+    digest = merge_chunk_summaries([summary for summary, _ in results])
+    header = (f"DIGEST OF PRIOR RECORDS (structured summary of {len(background_text)} characters of outside records "
+              f"in {len(chunks)} parts; only explicitly documented facts are listed):")
+    return f"{header}\n\n{digest}"
+
+
+def prepare_background_for_prompts(background_text, generate_fn, model_name,
+                                   threshold_chars=BACKGROUND_DIGEST_THRESHOLD_CHARS):
+    """Returns the raw background text when it is small enough, otherwise its structured digest."""
+    if not background_text or len(background_text) <= threshold_chars:
+        return background_text
+    return build_background_digest(background_text, generate_fn, model_name)
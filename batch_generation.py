@@ -0,0 +1,428 @@
+# batch_generation.py
+# Offline bulk note generation through batch prediction, for backlog runs (audits, model migrations) where the
+# latency of each call does not matter but cost and quota do.
+#
+# Every case runs generate_full_note on its own thread, with a PipelineContext whose model queues each call
+# instead of sending it. Once every running case is waiting on the model (and no call has arrived for
+# BATCH_SETTLE_SECONDS), the queued prompts of all cases are written as one JSONL batch job per model and
+# submitted; when the job has completed, each case continues with its answer into its next stage. The cases
+# move through the pipeline in lockstep, so a clinic day of notes costs one job per stage (background digest,
+# note body, assessment, diagnosis, checklist, elaboration, literature, ...) instead of thousands of online calls.
+# Stage outputs are checkpointed in the run store as usual: a failed case can be run again with the run_id from
+# the results file, and only its failed stages are batched again.
+#
+#     python batch_generation.py CASES.jsonl [--out RESULTS.jsonl] [--backend vertex|local]
+#
+# CASES.jsonl has one case per line: {"case_id", "background_info_text", "additional_info_text",
+# "transcription_text", "revised_info_text"} plus optional "patient_id" and "run_id". RESULTS.jsonl has one line
+# per case: {"case_id", "run_id", "note"}, or {"case_id", "run_id", "error"}.
+#
+# Backends (BATCH_BACKEND):
+#   vertex - Vertex AI batch prediction (vertexai.batch_prediction.BatchPredictionJob); the input and output
+#            JSONL files of each job are kept under BATCH_GCS_PREFIX (gs://bucket/path).
+#   local  - file-based stand-in: the same JSONL files under BATCH_WORK_DIR, each job executed by a background
+#            thread with online model calls. Used by load_test.py and for testing without batch quota.
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+BATCH_BACKEND = os.getenv("BATCH_BACKEND", "vertex")
+BATCH_GCS_PREFIX = os.getenv("BATCH_GCS_PREFIX", "")
+BATCH_WORK_DIR = os.getenv("BATCH_WORK_DIR", os.path.join("data", "batch_jobs"))
+BATCH_SETTLE_SECONDS = float(os.getenv("BATCH_SETTLE_SECONDS", "0.5"))
+# A round is submitted anyway once its oldest call has waited this long (e.g. a case is stuck on PubMed).
+BATCH_MAX_WAIT_SECONDS = float(os.getenv("BATCH_MAX_WAIT_SECONDS", "120"))
+BATCH_POLL_SECONDS = float(os.getenv("BATCH_POLL_SECONDS", "30"))
+BATCH_MAX_CASES = int(os.getenv("BATCH_MAX_CASES", "500"))  # Cases run together; larger files go in waves.
+BATCH_LOCAL_WORKERS = int(os.getenv("BATCH_LOCAL_WORKERS", "8"))
+
+CASE_TEXT_FIELDS = ("background_info_text", "additional_info_text", "transcription_text", "revised_info_text")
+
+# What a queued model call returns to the stage code, which only reads `.text`.
+BatchResponse = namedtuple("BatchResponse", ["text"])
+
+
+class BatchJobError(Exception):
+    """A batch job (or one request in it) failed; raised from generate_content in the waiting case's thread."""
+
+
+def request_line(key, parts):
+    """One line of a batch job's input JSONL (the Gemini batch prediction request format)."""
+    return {"key": key, "request": {"contents": [
+        {"role": "user", "parts": [{"text": part} for part in parts if isinstance(part, str)]}]}}
+
+
+def parse_output_line(line):
+    """(key, request, text, error) of one line of a job's output; error is None for a successful request."""
+    error = line.get("status") or None
+    text = None
+    candidates = (line.get("response") or {}).get("candidates") or []
+    if candidates:
+        text = "".join(part.get("text", "") for part in (candidates[0].get("content") or {}).get("parts", []))
+    if error is None and text is None:
+        error = "the response has no candidates"
+    return line.get("key"), line.get("request"), text, error
+
+
+def _request_signature(request):
+    return json.dumps(request, sort_keys=True, ensure_ascii=False)
+
+
+def _write_jsonl(path, lines):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for line in lines:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+
+
+def _read_jsonl(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _online_model(model_name):
+    # Looked up at call time, so replacing core._get_generative_model (as load_test.py does) takes effect.
+    import note_processing_core as core
+    return core._get_generative_model(model_name)
+
+
+class LocalBatchBackend:
+    """
+    File-based stand-in for the batch prediction API. A job is a directory under `work_dir` holding input.jsonl,
+    status.json and, once done, predictions.jsonl in the format the Vertex AI jobs write.
+    """
+
+    name = "local"
+
+    def __init__(self, work_dir=BATCH_WORK_DIR, model_factory=None, workers=BATCH_LOCAL_WORKERS, poll_seconds=0.05):
+        self.work_dir = work_dir
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self._model_factory = model_factory or _online_model
+
+    def submit(self, job_name, model_name, lines):
+        job_dir = os.path.join(self.work_dir, job_name)
+        os.makedirs(job_dir, exist_ok=True)
+        _write_jsonl(os.path.join(job_dir, "input.jsonl"), lines)
+        self._set_status(job_dir, "RUNNING")
+        threading.Thread(target=self._execute, args=(job_dir, model_name), name=f"batch-{job_name}",
+                         daemon=True).start()
+        return job_dir
+
+    def _execute(self, job_dir, model_name):
+        model = self._model_factory(model_name)
+
+        def predict(line):
+            parts = [part["text"] for part in line["request"]["contents"][0]["parts"]]
+            try:
+                text = model.generate_content(parts).text
+            except Exception as e:
+                return dict(line, status=str(e))
+            return dict(line, status="", response={"candidates": [{"content": {"role": "model",
+                                                                               "parts": [{"text": text}]}}]})
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                outputs = list(pool.map(predict, _read_jsonl(os.path.join(job_dir, "input.jsonl"))))
+            _write_jsonl(os.path.join(job_dir, "predictions.jsonl"), outputs)
+            self._set_status(job_dir, "SUCCEEDED")
+        except Exception as e:
+            self._set_status(job_dir, "FAILED", str(e))
+
+    @staticmethod
+    def _set_status(job_dir, state, error=None):
+        tmp_path = os.path.join(job_dir, "status.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"state": state, "error": error, "updated_at": time.time()}, f)
+        os.replace(tmp_path, os.path.join(job_dir, "status.json"))
+
+    def wait(self, job_dir):
+        """Blocks until the job has ended; returns its output lines or raises BatchJobError."""
+        while True:
+            with open(os.path.join(job_dir, "status.json"), "r", encoding="utf-8") as f:
+                status = json.load(f)
+            if status["state"] != "RUNNING":
+                break
+            time.sleep(self.poll_seconds)
+        if status["state"] != "SUCCEEDED":
+            raise BatchJobError(f"Local batch job {os.path.basename(job_dir)} failed: {status['error']}")
+        return _read_jsonl(os.path.join(job_dir, "predictions.jsonl"))
+
+
+def _split_gcs_uri(uri):
+    match = re.match(r"^gs://([^/]+)/?(.*)$", uri)
+    if not match:
+        raise ValueError(f"Not a gs:// URI: {uri}")
+    return match.group(1), match.group(2).rstrip("/")
+
+
+class VertexBatchBackend:
+    """Vertex AI batch prediction; a job's input.jsonl and output/ live under gcs_prefix/<job name>/."""
+
+    name = "vertex"
+
+    def __init__(self, gcs_prefix=BATCH_GCS_PREFIX, poll_seconds=BATCH_POLL_SECONDS):
+        if not gcs_prefix.startswith("gs://"):
+            raise ValueError("BATCH_GCS_PREFIX must be a gs://bucket/path URI for the vertex batch backend.")
+        self.gcs_prefix = gcs_prefix.rstrip("/")
+        self.poll_seconds = poll_seconds
+
+    @staticmethod
+    def _storage_client():
+        # Deferred imports, like every Google SDK in this project.
+        import note_processing_core as core
+        from google.cloud import storage
+        core.initialize_vertex_ai()
+        return storage.Client(project=core.PROJECT_ID)
+
+    def submit(self, job_name, model_name, lines):
+        from vertexai.batch_prediction import BatchPredictionJob
+        bucket_name, path = _split_gcs_uri(f"{self.gcs_prefix}/{job_name}")
+        blob = self._storage_client().bucket(bucket_name).blob(f"{path}/input.jsonl")
+        blob.upload_from_string("".join(json.dumps(line, ensure_ascii=False) + "\n" for line in lines),
+                                content_type="application/jsonl")
+        return BatchPredictionJob.submit(source_model=model_name,
+                                         input_dataset=f"gs://{bucket_name}/{path}/input.jsonl",
+                                         output_uri_prefix=f"gs://{bucket_name}/{path}/output")
+
+    def wait(self, job):
+        """Blocks until the job has ended; returns its output lines or raises BatchJobError."""
+        while not job.has_ended:
+            time.sleep(self.poll_seconds)
+            job.refresh()
+        if not job.has_succeeded:
+            raise BatchJobError(f"Vertex AI batch job {job.resource_name} failed: {job.error}")
+        bucket_name, path = _split_gcs_uri(job.output_location)
+        lines = []
+        for blob in self._storage_client().list_blobs(bucket_name, prefix=path):
+            if blob.name.endswith(".jsonl"):
+                lines.extend(json.loads(line) for line in blob.download_as_text().splitlines() if line.strip())
+        return lines
+
+
+def get_backend(name=None, **kwargs):
+    name = name or BATCH_BACKEND
+    if name == "vertex":
+        return VertexBatchBackend(**kwargs)
+    if name == "local":
+        return LocalBatchBackend(**kwargs)
+    raise ValueError(f"Unknown BATCH_BACKEND '{name}' (expected vertex or local).")
+
+
+class _QueuedCall:
+    def __init__(self, case, model_name, parts):
+        self.key = uuid.uuid4().hex
+        self.case = case
+        self.model_name = model_name
+        self.parts = parts
+        self.queued_at = time.monotonic()
+        self.text = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _QueueingModel:
+    """The model client of one case: generate_content queues the prompt for the next round and waits for it."""
+
+    def __init__(self, coordinator, case, model_name):
+        self._coordinator = coordinator
+        self._case = case
+        self._model_name = model_name
+
+    def generate_content(self, contents, *args, **kwargs):
+        parts = contents if isinstance(contents, list) else [contents]
+        return BatchResponse(self._coordinator.call(self._case, self._model_name, parts))
+
+
+class BatchCoordinator:
+    """
+    Collects the model calls of concurrently running cases into rounds and runs each round as batch jobs (one
+    per model). A round is submitted once every running case has a call queued and no call has arrived for
+    settle_seconds, or once its oldest call has waited max_wait_seconds.
+    """
+
+    def __init__(self, backend, settle_seconds=BATCH_SETTLE_SECONDS, max_wait_seconds=BATCH_MAX_WAIT_SECONDS):
+        self.backend = backend
+        self.settle_seconds = settle_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.jobs = []  # One summary dict per submitted job.
+        self._batch_id = uuid.uuid4().hex[:8]
+        self._round = 0
+        self._cond = threading.Condition()
+        self._running = set()
+        self._queue = []
+        self._last_queued = 0.0
+
+    def model_factory(self, case):
+        """PipelineContext model factory for one case (`cached_content` is not supported by batch jobs)."""
+        return lambda model_name, cached_content=None: _QueueingModel(self, case, model_name)
+
+    def case_started(self, case):
+        with self._cond:
+            self._running.add(case)
+
+    def case_finished(self, case):
+        with self._cond:
+            self._running.discard(case)
+            self._cond.notify_all()
+
+    def call(self, case, model_name, parts):
+        """Queues one prompt and blocks until its round has completed. Returns the text or raises BatchJobError."""
+        call = _QueuedCall(case, model_name, parts)
+        with self._cond:
+            self._queue.append(call)
+            self._last_queued = call.queued_at
+            self._cond.notify_all()
+        call.done.wait()
+        if call.error:
+            raise BatchJobError(call.error)
+        return call.text
+
+    def _next_round(self):
+        """Blocks until a round is due and returns its calls; [] once no case is running."""
+        with self._cond:
+            while True:
+                if not self._queue:
+                    if not self._running:
+                        return []
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                settled = now - self._last_queued >= self.settle_seconds
+                all_waiting = self._running <= {call.case for call in self._queue}
+                if (settled and all_waiting) or now - self._queue[0].queued_at >= self.max_wait_seconds:
+                    calls, self._queue = self._queue, []
+                    return calls
+                self._cond.wait(timeout=max(0.01, self.settle_seconds / 2))
+
+    def run(self):
+        """Runs rounds until every started case has finished."""
+        while True:
+            calls = self._next_round()
+            if not calls:
+                return
+            self._round += 1
+            by_model = {}
+            for call in calls:
+                by_model.setdefault(call.model_name, []).append(call)
+            submitted = [self._submit(model_name, model_calls) for model_name, model_calls in by_model.items()]
+            for job_name, job, model_calls, started in submitted:
+                self._collect(job_name, job, model_calls, started)
+
+    def _submit(self, model_name, calls):
+        job_name = f"notes-{self._batch_id}-r{self._round:02d}-{re.sub(r'[^a-z0-9]+', '-', model_name.lower())}"
+        print(f"DEBUG: Submitting batch job {job_name}: {len(calls)} requests from "
+              f"{len({call.case for call in calls})} cases.")
+        started = time.perf_counter()
+        try:
+            job = self.backend.submit(job_name, model_name, [request_line(call.key, call.parts) for call in calls])
+        except Exception as e:
+            print(f"ERROR submitting batch job {job_name}: {e}")
+            job = e
+        return job_name, job, calls, started
+
+    def _collect(self, job_name, job, calls, started):
+        job_error = None
+        outputs = []
+        if isinstance(job, Exception):
+            job_error = f"Batch job {job_name} could not be submitted: {job}"
+        else:
+            try:
+                outputs = self.backend.wait(job)
+            except Exception as e:
+                job_error = str(e)
+                print(f"ERROR: {job_error}")
+        by_key = {call.key: call for call in calls}
+        by_request = {}
+        for call in calls:
+            by_request.setdefault(_request_signature(request_line(call.key, call.parts)["request"]), []).append(call)
+        for output in outputs:
+            key, request, text, error = parse_output_line(output)
+            # Output lines are matched by key, or by the echoed request if the backend dropped the key.
+            matched = [by_key[key]] if key in by_key else by_request.get(_request_signature(request), [])
+            for call in matched:
+                call.text, call.error = text, error
+        failed = 0
+        for call in calls:
+            if call.text is None and call.error is None:
+                call.error = job_error or f"No output for this request in batch job {job_name}."
+            failed += call.error is not None
+            call.done.set()
+        seconds = time.perf_counter() - started
+        self.jobs.append({"job": job_name, "model": calls[0].model_name, "round": self._round,
+                          "requests": len(calls), "cases": len({call.case for call in calls}), "failed": failed,
+                          "seconds": seconds})
+        print(f"DEBUG: Batch job {job_name} finished in {seconds:.1f}s: {len(calls) - failed} answered, "
+              f"{failed} failed.")
+
+
+def _run_case(coordinator, index, case, results):
+    import note_processing_core as core
+    from run_store import new_run_id
+    run_id = case.get("run_id") or new_run_id()
+    result = {"case_id": case.get("case_id", index), "run_id": run_id}
+    try:
+        ctx = core.new_pipeline_context(run_id=run_id, deadline_seconds=0,
+                                        model_factory=coordinator.model_factory(index))
+        note = core.generate_full_note(*(case.get(field) or "" for field in CASE_TEXT_FIELDS), run_id=run_id,
+                                       context=ctx, patient_id=case.get("patient_id"))
+        if "ERROR:" in note or note.startswith("FAILED TO GENERATE"):
+            result["error"] = note
+        else:
+            result["note"] = note
+    except Exception as e:
+        result["error"] = f"ERROR: {e}"
+    finally:
+        coordinator.case_finished(index)
+    results[index] = result
+
+
+def run_cases(cases, backend=None, max_cases=BATCH_MAX_CASES, settle_seconds=BATCH_SETTLE_SECONDS):
+    """
+    Generates the notes of `cases` (dicts as in CASES.jsonl) through batch jobs, max_cases at a time.
+    Returns (results in case order, job summaries).
+    """
+    backend = backend or get_backend()
+    results = [None] * len(cases)
+    jobs = []
+    for wave_start in range(0, len(cases), max_cases):
+        coordinator = BatchCoordinator(backend, settle_seconds=settle_seconds)
+        indices = range(wave_start, min(len(cases), wave_start + max_cases))
+        for index in indices:
+            coordinator.case_started(index)
+        for index in indices:
+            threading.Thread(target=_run_case, args=(coordinator, index, cases[index], results),
+                             name=f"batch-case-{index}", daemon=True).start()
+        coordinator.run()
+        jobs.extend(coordinator.jobs)
+    return results, jobs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generates the notes of a file of cases through batch jobs.")
+    parser.add_argument("cases", help="JSONL file with one case per line")
+    parser.add_argument("--out", help="results JSONL file (default: CASES with .results.jsonl)")
+    parser.add_argument("--backend", choices=("vertex", "local"), default=BATCH_BACKEND)
+    args = parser.parse_args(argv)
+
+    cases = _read_jsonl(args.cases)
+    out_path = args.out or re.sub(r"(\.jsonl)?$", ".results.jsonl", args.cases, count=1)
+    started = time.perf_counter()
+    results, jobs = run_cases(cases, get_backend(args.backend))
+    _write_jsonl(out_path, results)
+    failed = sum("error" in result for result in results)
+    print(f"{len(cases)} cases in {time.perf_counter() - started:.1f}s ({failed} failed): "
+          f"{sum(job['requests'] for job in jobs)} model calls in {len(jobs)} batch jobs. Results: {out_path}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,305 @@
+# checklist_extractor.py
+# Rule-based extraction of cognitive scores, labs and other numeric facts used by the
+# Alzheimer's Disease Candidate Checklist. All patterns are compiled into one alternation that is
+# run once over each input section; every hit keeps its source section and character span so the
+# prefilled value can be traced back to the text it came from.
+import re
+from collections import namedtuple
+
+ExtractedValue = namedtuple("ExtractedValue", ["name", "value", "matched_text", "source", "start", "end", "negated"])
+
+_ANTICOAGULANTS = {
+    "warfarin": "warfarin", "coumadin": "warfarin", "jantoven": "warfarin",
+    "apixaban": "apixaban", "eliquis": "apixaban",
+    "rivaroxaban": "rivaroxaban", "xarelto": "rivaroxaban",
+    "dabigatran": "dabigatran", "pradaxa": "dabigatran",
+    "edoxaban": "edoxaban", "savaysa": "edoxaban",
+    "enoxaparin": "enoxaparin", "lovenox": "enoxaparin",
+    "heparin": "heparin", "fondaparinux": "fondaparinux",
+}
+
+# Gap allowed between a label and its value, e.g. "MMSE score today: 24/30", without crossing a line.
+_GAP = r"[^0-9\n]{0,25}?"
+
+_FACT_PATTERNS = [
+    ("mmse", rf"\b(?:MMSE|Mini[- ]Mental(?:\s+State)?(?:\s+Exam(?:ination)?)?){_GAP}(?P<mmse>\d{{1,2}})\s*/\s*30\b"),
+    ("moca", rf"\b(?:MoCA|Montreal\s+Cognitive\s+Assessment){_GAP}(?P<moca>\d{{1,2}})\s*/\s*30\b"),
+    ("cdr", rf"\bCDR(?![- ]?SB)(?!\s+sum)(?:[- ]global)?(?:\s+score)?{_GAP}(?P<cdr>0\.5|[0123](?:\.0)?)(?!\.?[0-9])"),
+    ("faq", rf"\b(?:FAQ|Functional\s+Activities\s+Questionnaire){_GAP}(?P<faq>\d{{1,2}})(?:\s*/\s*30)?\b"),
+    ("gds", rf"\b(?:GDS(?:-15)?|Geriatric\s+Depression\s+Scale(?:-15)?){_GAP}(?P<gds>\d{{1,2}})(?:\s*/\s*15)?\b"),
+    ("age", r"\b(?P<age>\d{2,3})[- ]?(?:(?:years?|yrs?)[- ]old|y/?o)\b|\bage(?:d|:)\s*(?P<age_label>\d{2,3})\b"),
+    ("bmi", rf"\b(?:BMI|body\s+mass\s+index){_GAP}(?P<bmi>\d{{2}}(?:\.\d+)?)"),
+    ("apoe", r"\bAPO\s?E(?:\s+genotype|\s+status)?[^\n]{0,20}?(?P<apoe>[eε]\s?[234]\s*/\s*[eε]?\s?[234])"),
+    ("inr", r"\bINR\b[^0-9\n]{0,15}?(?P<inr>\d(?:\.\d+)?)(?![0-9])"),
+    ("platelets", rf"\b(?:platelets?|plt)\b{_GAP}(?P<platelets>\d{{1,4}}(?:\.\d+)?)"),
+    ("anticoagulant", r"\b(?P<anticoagulant>" + "|".join(_ANTICOAGULANTS) + r")\b"),
+]
+_FACT_RE = re.compile("|".join(f"(?:{pattern})" for _, pattern in _FACT_PATTERNS), re.IGNORECASE)
+# An "NN-year-old" within a few words of one of these describes someone else ("her daughter, a 45-year-old nurse").
+_RELATIVE_BEFORE_RE = re.compile(
+    r"\b(?:daughters?|sons?|husband|wife|spouse|partner|sisters?|brothers?|mother|father|parents?|grand(?:son|"
+    r"daughter|child(?:ren)?)|niece|nephew|caregiver|friend|neighbou?r|child(?:ren)?)\b\W+(?:\w+\W+){0,4}$",
+    re.IGNORECASE)
+_RELATIVE_AFTER_RE = re.compile(
+    r"^\W+(?:daughter|son|husband|wife|spouse|partner|sister|brother|mother|father|grand\w+|niece|nephew|"
+    r"caregiver|friend|neighbou?r|child)\b", re.IGNORECASE)
+_NEGATION_RE = re.compile(r"\b(?:no|not|denies|denied|never|stopped|discontinued|off|without|held)\b[^.\n]{0,30}$",
+                          re.IGNORECASE)
+
+# Plausible ranges; values outside are treated as mis-matches (e.g. a date fragment) and ignored.
+_VALID_RANGES = {
+    "mmse": (0, 30), "moca": (0, 30), "faq": (0, 30), "gds": (0, 15), "cdr": (0, 3),
+    "age": (18, 110), "bmi": (10, 70), "inr": (0.5, 10), "platelets": (1, 1500),
+}
+
+# Which retrieval information need (see retrieval_index.STAGE_INFORMATION_NEEDS["checklist"]) each
+# extracted fact answers, so resolved facts no longer need passages in the LLM prompt.
+CHECKLIST_FACT_NEEDS = {
+    "mmse": "MMSE mini mental", "moca": "MoCA montreal", "cdr": "CDR clinical dementia rating",
+    "faq": "FAQ functional", "gds": "GDS geriatric depression", "age": "age years old",
+    "bmi": "BMI weight height kg", "apoe": "APOE genotype e4", "inr": "INR", "platelets": "platelets",
+}
+
+UNRESOLVED_SELECTION = "No / YES / UNKNOWN"
+# A template hint after a slot, e.g. '*** (e.g., e3/e3, ...)'; it is dropped once the slot is filled.
+_TEMPLATE_HINT_RE = re.compile(r"\s*\([^()*\n]*\)")
+
+
+def _normalize_value(name, raw):
+    if name == "apoe":
+        alleles = re.findall(r"[234]", raw)
+        return "e{}/e{}".format(*sorted(alleles)) if len(alleles) == 2 else None
+    if name == "anticoagulant":
+        return _ANTICOAGULANTS[raw.lower()]
+    value = float(raw)
+    low, high = _VALID_RANGES[name]
+    if not low <= value <= high:
+        return None
+    return int(value) if name in ("mmse", "moca", "faq", "gds", "age") else value
+
+
+def extract_checklist_facts(sections):
+    """
+    Scans each (source_name, text) pair once with the combined pattern.
+    Returns {fact_name: [ExtractedValue, ...]} in input order (later mentions last).
+    """
+    facts = {}
+    for source, text in sections:
+        if not text:
+            continue
+        for match in _FACT_RE.finditer(text):
+            for group_name, raw in match.groupdict().items():
+                if raw is None:
+                    continue
+                name = "age" if group_name == "age_label" else group_name
+                value = _normalize_value(name, raw)
+                if value is None:
+                    continue
+                if group_name == "age" and _describes_someone_else(text, match):
+                    continue
+                negated = False
+                if name == "anticoagulant":  # "not on warfarin", "apixaban discontinued" style mentions
+                    line_start = text.rfind("\n", 0, match.start()) + 1
+                    negated = bool(_NEGATION_RE.search(text[line_start:match.start()]))
+                facts.setdefault(name, []).append(
+                    ExtractedValue(name, value, match.group(0), source, match.start(), match.end(), negated))
+                break
+    return facts
+
+
+def _describes_someone_else(text, match):
+    """Whether an "NN-year-old" mention is about a relative or caregiver rather than the patient."""
+    line_start = text.rfind("\n", 0, match.start()) + 1
+    line_end = text.find("\n", match.end())
+    after = text[match.end():line_end if line_end != -1 else len(text)][:40]
+    return bool(_RELATIVE_BEFORE_RE.search(text[line_start:match.start()][-60:]) or _RELATIVE_AFTER_RE.match(after))
+
+
+def patient_age(facts):
+    """
+    The patient's age: a labelled one ("Age: 72", "aged 72") if any, otherwise the first "NN-year-old" mention
+    (mentions describing a relative are not extracted). The first mention is used because later ones are more
+    often about someone else, or a past visit's age quoted in the history.
+    """
+    ages = facts.get("age", [])
+    for extracted in ages:
+        if extracted.matched_text.lower().startswith("age"):
+            return extracted
+    return ages[0] if ages else None
+
+
+def latest_value(facts, name):
+    """The last non-negated mention of a fact (inputs are ordered oldest to newest), or None."""
+    for extracted in reversed(facts.get(name, [])):
+        if not extracted.negated:
+            return extracted
+    return None
+
+
+def _format_number(value):
+    return f"{value:g}" if isinstance(value, float) else str(value)
+
+
+def _replace_slot(template, line_prefix, old, new):
+    """
+    Replaces the first `old` on the template line starting with `line_prefix`. A hint in parentheses ending the
+    line is removed with it, unless `new` still leaves a slot ("***") the hint is about.
+    """
+    lines = template.split("\n")
+    for i, line in enumerate(lines):
+        if line.startswith(line_prefix) and old in line:
+            before, rest = line.split(old, 1)
+            if "***" not in new and _TEMPLATE_HINT_RE.fullmatch(rest):
+                rest = ""
+            lines[i] = before + new + rest
+            break
+    return "\n".join(lines)
+
+
+def _set_selection(template, criterion_label, selection):
+    return _replace_slot(template, f"{UNRESOLVED_SELECTION} : {criterion_label}", UNRESOLVED_SELECTION, selection)
+
+
+def _aria_risk(genotype):
+    e4_count = genotype.count("4")
+    if e4_count == 2:
+        return "Highest (APOE e4 homozygote)"
+    if e4_count == 1:
+        return "Intermediate (APOE e4 heterozygote)"
+    return "Lower (APOE e4 non-carrier)"
+
+
+def count_unresolved_items(checklist_text):
+    return checklist_text.count("***") + checklist_text.count(UNRESOLVED_SELECTION)
+
+
+def prefill_checklist(template, facts):
+    """
+    Fills the template slots that can be decided from extracted facts alone.
+    Returns (prefilled_template, used_facts) where used_facts lists the ExtractedValues that were applied.
+    Only clear-cut rules are applied; anything needing judgment is left for the LLM. No extracted value fails
+    inclusion on its own: the inclusion items it cannot confirm and the overall verdict stay open for the LLM.
+    """
+    filled = template
+    used = []
+
+    age = patient_age(facts)
+    if age:
+        used.append(age)
+        if 50 <= age.value <= 90:
+            filled = _replace_slot(filled, "1- Age between", "***", f"YES (Age: {age.value})")
+            filled = _replace_slot(filled, f"{UNRESOLVED_SELECTION} : Age Criteria", "(Actual Age: ***)",
+                                   f"(Actual Age: {age.value})")
+            filled = _set_selection(filled, "Age Criteria", "No")
+        else:
+            # A pattern match alone never fails inclusion (it may be someone else's age): the item stays open for
+            # the LLM, which sees the extracted value and its source.
+            filled = _replace_slot(filled, "1- Age between", "***",
+                                   f"*** (extracted age {age.value} is outside 50-90; confirm it is the patient's)")
+
+    mmse = latest_value(facts, "mmse")
+    if mmse:
+        used.append(mmse)
+        if mmse.value > 19:
+            filled = _replace_slot(filled, "4- MMSE Score", "***", f"YES (MMSE: {mmse.value}/30)")
+        else:
+            # May be an old or intercurrent score (e.g. during delirium): flagged like an out-of-range age.
+            filled = _replace_slot(filled, "4- MMSE Score", "***",
+                                   f"*** (extracted MMSE {mmse.value}/30 is 19 or lower; confirm it is current)")
+        filled = _replace_slot(filled, "- MMSE score:", "***/30", f"{mmse.value}/30")
+
+    for name, line_prefix in (("moca", "- MoCA score:"), ("faq", "- FAQ score:")):
+        extracted = latest_value(facts, name)
+        if extracted:
+            used.append(extracted)
+            filled = _replace_slot(filled, line_prefix, "***/30", f"{extracted.value}/30")
+
+    cdr = latest_value(facts, "cdr")
+    if cdr:
+        used.append(cdr)
+        cdr_text = _format_number(cdr.value)
+        filled = _replace_slot(filled, "- CDR-global:", "***", cdr_text)
+        filled = _replace_slot(filled, "- CDR-global:", "(Score: ***", f"(Score: {cdr_text}")
+
+    apoe = latest_value(facts, "apoe")
+    if apoe:
+        used.append(apoe)
+        filled = _replace_slot(filled, "- APOE Genotype:", "***", apoe.value)
+        filled = _replace_slot(filled, "- Associated ARIA Risk", "***", _aria_risk(apoe.value))
+
+    gds = latest_value(facts, "gds")
+    if gds:
+        used.append(gds)
+        filled = _replace_slot(filled, f"{UNRESOLVED_SELECTION} : Mental Health", "(GDS Score: ***/15)",
+                               f"(GDS Score: {gds.value}/15)")
+        if gds.value > 8:
+            filled = _set_selection(filled, "Mental Health", "YES")
+
+    bmi = latest_value(facts, "bmi")
+    if bmi:
+        used.append(bmi)
+        bmi_text = _format_number(bmi.value)
+        filled = _replace_slot(filled, f"{UNRESOLVED_SELECTION} : Body Mass Index",
+                               "(Estimated BMI: *** kg/m² ; Calculated from: ***)",
+                               f"(Estimated BMI: {bmi_text} kg/m² ; Calculated from: documented BMI)")
+        filled = _set_selection(filled, "Body Mass Index", "No" if 17 <= bmi.value <= 35 else "YES")
+
+    inr = latest_value(facts, "inr")
+    platelets = latest_value(facts, "platelets")
+    anticoagulant = latest_value(facts, "anticoagulant")
+    lab_results = []
+    if inr:
+        used.append(inr)
+        lab_results.append(f"INR {_format_number(inr.value)}")
+    if platelets:
+        used.append(platelets)
+        lab_results.append(f"Platelets {_format_number(platelets.value)}")
+    if lab_results:
+        filled = _replace_slot(filled, "- Baseline Labs", "Results: ***",
+                               f"Results: {', '.join(lab_results)}; other baseline labs: ***")
+    if anticoagulant:
+        used.append(anticoagulant)
+    # Only the exclusionary direction is certain from numbers alone; "No" also needs the absence of a
+    # bleeding disorder, which is a judgment left to the LLM.
+    if (inr and inr.value > 1.5) or (platelets and platelets.value < 50) or anticoagulant:
+        filled = _set_selection(filled, "Bleeding Risks", "YES")
+    return filled, used
+
+
+def describe_extracted_facts(used_facts):
+    """One line per applied fact, with its source section and span, for the LLM prompt and debugging."""
+    return "\n".join(
+        f"- {fact.name}: {fact.value} (from {fact.source}, chars {fact.start}-{fact.end}: \"{fact.matched_text}\")"
+        for fact in used_facts
+    )
+
+
+if __name__ == '__main__':
+    # Regression cases: python checklist_extractor.py exits non-zero if one fails.
+    import sys
+    from note_processing_core import ALZHEIMERS_CHECKLIST_TEMPLATE_FOR_PROCESSING as template
+
+    relative_age = extract_checklist_facts([("background", "72-year-old woman with memory loss. Accompanied by "
+                                                           "her daughter, a 45-year-old nurse. MMSE 24/30.")])
+    labelled_age = extract_checklist_facts([("background", "Age: 68\nHer husband (70 years old) is present. "
+                                                           "The 45-year-old daughter lives nearby.")])
+    young_patient = extract_checklist_facts([("background", "45-year-old man with early-onset memory loss.")])
+    young_checklist, _ = prefill_checklist(template, young_patient)
+    old_low_mmse, _ = prefill_checklist(template, extract_checklist_facts([
+        ("background", "2019 note: MMSE 18/30 during delirium admission"), ("transcription", "72-year-old")]))
+    apoe_checklist, _ = prefill_checklist(template, extract_checklist_facts([("background", "APOE e3/e4")]))
+    failures = [description for description, ok in (
+        ("relative's age ignored", patient_age(relative_age).value == 72),
+        ("labelled age preferred", patient_age(labelled_age).value == 68),
+        ("relatives' ages not extracted", [a.value for a in labelled_age["age"]] == [68]),
+        ("out-of-range age left for the LLM", "NOT APPLICABLE" not in young_checklist
+         and count_unresolved_items(young_checklist) > 0),
+        ("low MMSE left for the LLM", "NOT APPLICABLE" not in old_low_mmse and "Overall Inclusion Criteria Met: ***"
+         in old_low_mmse and "4- MMSE Score > 19: *** (extracted MMSE 18/30" in old_low_mmse),
+        ("filled slot drops its template hint", "- APOE Genotype: e3/e4\n" in apoe_checklist),
+        ("slot left open keeps its hint", "Results: *** (or" in apoe_checklist),
+    ) if not ok]
+    for description in failures:
+        print(f"FAILED: {description}")
+    print(f"{7 - len(failures)} of 7 regression cases passed.")
+    sys.exit(1 if failures else 0)
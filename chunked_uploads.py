@@ -0,0 +1,388 @@
+# chunked_uploads.py
+# Resumable chunked uploads for large recordings and record bundles.
+# A client initiates an upload (file name and size), PUTs numbered chunks with a SHA-256 checksum each, and
+# finalizes (optionally with the SHA-256 of the whole file). Chunks may arrive in any order and be retried;
+# each one is streamed to its own part file, and copied to its offset in a preallocated file on disk only once
+# its checksum matches, so nothing is buffered whole in memory and a bad resend never overwrites verified bytes.
+# After an interruption the client asks which chunks are missing and sends only those.
+# Extraction starts before the upload is complete: text files are decoded and WAV recordings are decoded and
+# resampled as their contiguous prefix grows, on a background thread per upload. PDFs and compressed audio are
+# extracted on finalize. /generate_note then refers to the upload by ID and waits for the extracted text.
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+UPLOAD_SESSION_DIR = os.getenv("UPLOAD_SESSION_DIR", os.path.join("uploads", "sessions"))
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(4 * 1024 * 1024)))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+UPLOAD_SESSION_TTL_SECONDS = int(os.getenv("UPLOAD_SESSION_TTL_HOURS", "24")) * 3600
+UPLOAD_EXTRACTION_TIMEOUT_SECONDS = int(os.getenv("UPLOAD_EXTRACTION_TIMEOUT_SECONDS", "1800"))
+
+_STREAM_BLOCK_BYTES = 64 * 1024
+_UPLOAD_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+_META_FILE = "meta.json"
+
+_sessions_lock = threading.Lock()
+_sessions = {}  # upload_id -> UploadSession (those touched since this process started)
+
+
+class UploadError(Exception):
+    """A client error (bad ID, chunk index, checksum, size); carries the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class UploadSession:
+    """One upload: metadata and received chunks in meta.json, bytes in data.<ext>, extraction on a worker thread."""
+
+    def __init__(self, upload_id, meta):
+        self.upload_id = upload_id
+        self.meta = meta
+        self.directory = os.path.join(UPLOAD_SESSION_DIR, upload_id)
+        # Named by extension: decode_audio and the PDF extractor go by the file suffix.
+        self.data_path = os.path.join(self.directory, "data." + self.extension)
+        self.received = set(meta["received"])
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.extraction_state = "pending"  # pending -> extracting -> ready / failed
+        self.extracted_text = None
+        self.extraction_error = None
+        self.extraction_done = threading.Event()
+        self._worker = None
+
+    @property
+    def total_chunks(self):
+        return self.meta["total_chunks"]
+
+    @property
+    def extension(self):
+        return self.meta["filename"].rsplit(".", 1)[-1].lower()
+
+    def chunk_range(self, index):
+        start = index * self.meta["chunk_size"]
+        return start, min(start + self.meta["chunk_size"], self.meta["size"])
+
+    def contiguous_bytes(self):
+        """Length of the prefix of the file whose chunks have all been received."""
+        index = 0
+        while index in self.received:
+            index += 1
+        return self.chunk_range(index - 1)[1] if index else 0
+
+    def _save_meta(self):
+        self.meta["received"] = sorted(self.received)
+        tmp_path = os.path.join(self.directory, _META_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, os.path.join(self.directory, _META_FILE))
+
+    def status(self):
+        with self.lock:
+            return {
+                "upload_id": self.upload_id, "filename": self.meta["filename"], "size": self.meta["size"],
+                "chunk_size": self.meta["chunk_size"], "total_chunks": self.total_chunks,
+                "received_chunks": sorted(self.received),
+                "missing_chunks": [i for i in range(self.total_chunks) if i not in self.received],
+                "finalized": self.meta["finalized"], "extraction": self.extraction_state,
+                "extraction_error": self.extraction_error,
+            }
+
+
+def _new_meta(filename, size, chunk_size):
+    return {"filename": filename, "size": size, "chunk_size": chunk_size,
+            "total_chunks": max(1, -(-size // chunk_size)), "received": [], "chunk_sha256": {},
+            "finalized": False, "sha256": None, "created_at": time.time()}
+
+
+def initiate_upload(filename, size, allowed_extensions):
+    """Creates an upload session and its preallocated (sparse) data file. Returns the session."""
+    if "." not in filename or filename.rsplit(".", 1)[1].lower() not in allowed_extensions:
+        raise UploadError(f"File type not allowed: {filename}")
+    if not isinstance(size, int) or size <= 0 or size > UPLOAD_MAX_BYTES:
+        raise UploadError(f"Upload size must be between 1 and {UPLOAD_MAX_BYTES} bytes.")
+    purge_expired_uploads()
+    upload_id = uuid.uuid4().hex
+    session = UploadSession(upload_id, _new_meta(filename, size, UPLOAD_CHUNK_BYTES))
+    os.makedirs(session.directory)
+    with open(session.data_path, "wb") as f:
+        f.truncate(size)
+    session._save_meta()
+    with _sessions_lock:
+        _sessions[upload_id] = session
+    _start_extraction_worker(session)
+    print(f"DEBUG: Upload {upload_id} initiated for {filename} ({size} bytes, {session.total_chunks} chunks).")
+    return session
+
+
+def get_upload(upload_id):
+    """The session for an upload ID (reloaded from disk after a restart). Raises UploadError(404) if unknown."""
+    if not upload_id or not _UPLOAD_ID_RE.match(upload_id):
+        raise UploadError("Invalid upload ID.", 404)
+    with _sessions_lock:
+        session = _sessions.get(upload_id)
+        if session is None:
+            try:
+                with open(os.path.join(UPLOAD_SESSION_DIR, upload_id, _META_FILE), "r", encoding="utf-8") as f:
+                    session = UploadSession(upload_id, json.load(f))
+            except (OSError, ValueError):
+                raise UploadError("Unknown or expired upload ID.", 404)
+            _sessions[upload_id] = session
+    if session._worker is None:
+        _start_extraction_worker(session)
+    return session
+
+
+def write_chunk(upload_id, index, stream, expected_sha256):
+    """
+    Streams one chunk from `stream` (a file-like request body) to a part file, verifying length and SHA-256,
+    and copies it to its offset only once it verifies. A chunk that fails verification is not marked received
+    and can simply be sent again; resending a received chunk with different content is rejected.
+    """
+    session = get_upload(upload_id)
+    if session.meta["finalized"]:
+        raise UploadError("Upload is already finalized.", 409)
+    if not 0 <= index < session.total_chunks:
+        raise UploadError(f"Chunk index must be between 0 and {session.total_chunks - 1}.")
+    if not expected_sha256:
+        raise UploadError("Missing X-Chunk-SHA256 header.")
+    start, end = session.chunk_range(index)
+    digest = hashlib.sha256()
+    written = 0
+    part_path = os.path.join(session.directory, f"chunk-{index}-{uuid.uuid4().hex}.part")
+    try:
+        with open(part_path, "wb") as part:
+            while True:
+                block = stream.read(min(_STREAM_BLOCK_BYTES, end - start - written + 1))
+                if not block:
+                    break
+                written += len(block)
+                if written > end - start:
+                    raise UploadError(f"Chunk {index} is longer than {end - start} bytes.")
+                digest.update(block)
+                part.write(block)
+        if written != end - start:
+            raise UploadError(f"Chunk {index} has {written} bytes, expected {end - start}.")
+        checksum = digest.hexdigest()
+        if checksum != expected_sha256.strip().lower():
+            raise UploadError(f"Checksum mismatch for chunk {index}; please resend it.")
+        with session.changed:
+            if index in session.received:
+                if session.meta["chunk_sha256"].get(str(index)) != checksum:
+                    raise UploadError(f"Chunk {index} was already received with different content.", 409)
+                return session  # A retried chunk that did arrive; the verified bytes stay as they are.
+            with open(part_path, "rb") as part, open(session.data_path, "r+b") as f:
+                f.seek(start)
+                shutil.copyfileobj(part, f, _STREAM_BLOCK_BYTES)
+            session.received.add(index)
+            session.meta["chunk_sha256"][str(index)] = checksum
+            session._save_meta()
+            session.changed.notify_all()
+    finally:
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+    return session
+
+
+def finalize_upload(upload_id, expected_sha256=None):
+    """Checks that every chunk arrived (and the optional whole-file SHA-256), then releases extraction."""
+    session = get_upload(upload_id)
+    with session.changed:
+        missing = [i for i in range(session.total_chunks) if i not in session.received]
+        if missing:
+            raise UploadError(f"{len(missing)} chunks are still missing (first: {missing[0]}).", 409)
+        if expected_sha256 and not session.meta["finalized"]:
+            digest = hashlib.sha256()
+            with open(session.data_path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(block)
+            if digest.hexdigest() != expected_sha256.strip().lower():
+                raise UploadError("Checksum mismatch for the assembled file.", 422)
+            session.meta["sha256"] = digest.hexdigest()
+        session.meta["finalized"] = True
+        session._save_meta()
+        session.changed.notify_all()
+    print(f"DEBUG: Upload {upload_id} finalized ({session.meta['size']} bytes).")
+    return session
+
+
+def _wait_for_bytes(session, consumed):
+    """Blocks until more contiguous bytes than `consumed` exist. Returns (contiguous_bytes, finalized)."""
+    with session.changed:
+        while True:
+            available = session.contiguous_bytes()
+            if available > consumed or session.meta["finalized"]:
+                return available, session.meta["finalized"]
+            if not session.changed.wait(timeout=UPLOAD_SESSION_TTL_SECONDS):
+                raise TimeoutError("upload abandoned")
+
+
+def _read_range(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while start < end:
+            block = f.read(min(1024 * 1024, end - start))
+            if not block:
+                return
+            start += len(block)
+            yield block
+
+
+def _extract_incrementally(session, feed):
+    """Feeds the contiguous prefix to `feed` block by block as chunks arrive, until the upload is finalized."""
+    consumed = 0
+    while True:
+        available, finalized = _wait_for_bytes(session, consumed)
+        for block in _read_range(session.data_path, consumed, available):
+            feed(block)
+        consumed = available
+        if finalized and consumed >= session.meta["size"]:
+            return
+
+
+def _run_extraction(session, project_id):
+    """Worker thread body: produces session.extracted_text from the upload, as early as the format allows."""
+    import codecs
+
+    ext = session.extension
+    session.extraction_state = "extracting"
+    try:
+        if ext == "txt":
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            parts = []
+            _extract_incrementally(session, lambda block: parts.append(decoder.decode(block)))
+            parts.append(decoder.decode(b"", final=True))
+            text = "".join(parts)
+        elif ext == "wav":
+            from audio_preprocessing import StreamingWavDecoder, transcribe_audio_file
+            wav_decoder = StreamingWavDecoder()
+            try:
+                _extract_incrementally(session, wav_decoder.feed)
+                samples = wav_decoder.samples()
+            except ValueError as e:
+                print(f"DEBUG: Upload {session.upload_id}: streaming WAV decode not possible ({e}); decoding on finalize.")
+                _wait_until_finalized(session)
+                samples = None
+            text, _ = transcribe_audio_file(session.data_path, project_id, samples=samples)
+        else:
+            _wait_until_finalized(session)
+            if ext == "pdf":
+                from text_extractor import extract_text_from_pdf
+                text = extract_text_from_pdf(session.data_path)
+            else:
+                from audio_preprocessing import transcribe_audio_file
+                text, _ = transcribe_audio_file(session.data_path, project_id)
+        session.extracted_text = text or ""
+        session.extraction_state = "ready"
+        print(f"DEBUG: Upload {session.upload_id}: extracted {len(session.extracted_text)} chars.")
+    except Exception as e:
+        session.extraction_error = str(e)
+        session.extraction_state = "failed"
+        print(f"ERROR extracting text from upload {session.upload_id} ({session.meta['filename']}): {e}")
+    finally:
+        session.extraction_done.set()
+
+
+def _wait_until_finalized(session):
+    with session.changed:
+        while not session.meta["finalized"]:
+            if not session.changed.wait(timeout=UPLOAD_SESSION_TTL_SECONDS):
+                raise TimeoutError("upload abandoned")
+
+
+_extraction_project_id = {"value": None}
+
+
+def set_extraction_project_id(project_id):
+    """GCP project used for Speech-to-Text by the extraction workers."""
+    _extraction_project_id["value"] = project_id
+
+
+def _start_extraction_worker(session):
+    with session.lock:
+        if session._worker is not None:
+            return
+        session._worker = threading.Thread(target=_run_extraction, args=(session, _extraction_project_id["value"]),
+                                           name=f"upload-extract-{session.upload_id[:8]}", daemon=True)
+    session._worker.start()
+
+
+def get_extracted_text(upload_id, timeout=UPLOAD_EXTRACTION_TIMEOUT_SECONDS):
+    """
+    Waits for the upload's extraction and returns (filename, text). Raises UploadError if the upload is not
+    finalized or extraction failed or timed out.
+    """
+    session = get_upload(upload_id)
+    if not session.meta["finalized"]:
+        raise UploadError(f"Upload {upload_id} is not finalized.", 409)
+    if not session.extraction_done.wait(timeout):
+        raise UploadError(f"Text extraction for {session.meta['filename']} did not finish in time.", 504)
+    if session.extraction_state != "ready":
+        raise UploadError(f"Text extraction failed for {session.meta['filename']}: {session.extraction_error}", 422)
+    return session.meta["filename"], session.extracted_text
+
+
+def purge_expired_uploads(ttl_seconds=UPLOAD_SESSION_TTL_SECONDS):
+    """Removes upload sessions older than the TTL from disk and memory. Returns the count."""
+    if not os.path.isdir(UPLOAD_SESSION_DIR):
+        return 0
+    cutoff = time.time() - ttl_seconds
+    removed = 0
+    for upload_id in os.listdir(UPLOAD_SESSION_DIR):
+        directory = os.path.join(UPLOAD_SESSION_DIR, upload_id)
+        try:
+            if os.path.getmtime(directory) >= cutoff:
+                continue
+        except OSError:
+            continue
+        shutil.rmtree(directory, ignore_errors=True)
+        with _sessions_lock:
+            _sessions.pop(upload_id, None)
+        removed += 1
+    if removed:
+        print(f"DEBUG: Purged {removed} expired upload sessions.")
+    return removed
+
+
+def _regression_failures():
+    """Case from review: a rejected resend of an accepted chunk must not replace its verified bytes."""
+    import io
+    import tempfile
+
+    global UPLOAD_SESSION_DIR, UPLOAD_CHUNK_BYTES
+    saved = UPLOAD_SESSION_DIR, UPLOAD_CHUNK_BYTES
+    UPLOAD_SESSION_DIR, UPLOAD_CHUNK_BYTES = tempfile.mkdtemp(), 4
+    checksum = lambda data: hashlib.sha256(data).hexdigest()
+    rejected = []
+    try:
+        upload_id = initiate_upload("notes.txt", 8, {"txt"}).upload_id
+        write_chunk(upload_id, 0, io.BytesIO(b"abcd"), checksum(b"abcd"))
+        for data, sha in ((b"XXXX", checksum(b"abcd")), (b"XXXX", checksum(b"XXXX"))):
+            try:
+                write_chunk(upload_id, 0, io.BytesIO(data), sha)
+            except UploadError as e:
+                rejected.append(e.status)
+        write_chunk(upload_id, 1, io.BytesIO(b"efgh"), checksum(b"efgh"))
+        finalize_upload(upload_id, checksum(b"abcdefgh"))
+        text = get_extracted_text(upload_id, timeout=10)[1]
+    finally:
+        shutil.rmtree(UPLOAD_SESSION_DIR, ignore_errors=True)
+        UPLOAD_SESSION_DIR, UPLOAD_CHUNK_BYTES = saved
+    checks = (
+        ("bad resend of a received chunk rejected", rejected == [400, 409]),
+        ("verified bytes kept", text == "abcdefgh"),
+    )
+    return [description for description, ok in checks if not ok]
+
+
+if __name__ == '__main__':
+    for failure in _regression_failures():
+        print(f"FAILED: {failure}")
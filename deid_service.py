@@ -0,0 +1,137 @@
+# deid_service.py
+# Parallel de-identification of many documents on a warm process pool.
+# basic_deidentify_text is CPU-bound regex work, so threads do not help (GIL). Documents, and large
+# documents split at boundaries no redaction pattern can span, are fanned out to a process pool that is
+# created once and reused across requests. Results come back in input order. Small batches are done
+# in-process, where the IPC round trip would cost more than it saves.
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from deidentifier import basic_deidentify_text
+
+DEID_POOL_WORKERS = int(os.getenv("DEID_POOL_WORKERS", str(os.cpu_count() or 1)))
+# Below this many characters in total the batch is de-identified in-process.
+DEID_PARALLEL_MIN_CHARS = int(os.getenv("DEID_PARALLEL_MIN_CHARS", "200000"))
+# Documents longer than this are split into pieces of roughly this size.
+DEID_PIECE_CHARS = int(os.getenv("DEID_PIECE_CHARS", "100000"))
+
+_pool = None
+
+# A split point is a blank line directly after sentence-ending punctuation. None of the patterns in
+# basic_deidentify_text can match across ". \n\n" (names and addresses need letters/digits/whitespace only,
+# dates and phones need adjacent digits), except "Dr.\n\nSmith"-style titles, which are excluded here.
+_SAFE_BOUNDARY_RE = re.compile(r"(?<!\bMr)(?<!\bMs)(?<!\bDr)(?<!\bMrs)[.!?:]\s*\n\s*\n")
+
+
+def split_at_safe_boundaries(text, piece_chars=DEID_PIECE_CHARS):
+    """
+    Splits text into consecutive pieces of roughly piece_chars that de-identify identically on their own,
+    i.e. "".join(map(basic_deidentify_text, pieces)) == basic_deidentify_text(text).
+    Text without a safe boundary near the target size is left in one piece.
+    """
+    if len(text) <= piece_chars:
+        return [text]
+    pieces = []
+    start = 0
+    while len(text) - start > piece_chars:
+        match = _SAFE_BOUNDARY_RE.search(text, start + piece_chars)
+        if not match:
+            break
+        pieces.append(text[start:match.end()])
+        start = match.end()
+    pieces.append(text[start:])
+    return pieces
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=DEID_POOL_WORKERS)
+        print(f"DEBUG: Started de-identification process pool with {DEID_POOL_WORKERS} workers.")
+    return _pool
+
+
+def warm_up_pool():
+    """Starts the pool's worker processes ahead of the first request (optional; otherwise done lazily)."""
+    pool = _get_pool()
+    list(pool.map(basic_deidentify_text, [""] * DEID_POOL_WORKERS))
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool = None
+
+
+def deidentify_documents(texts, parallel=None):
+    """
+    De-identifies each text with basic_deidentify_text and returns the results in input order.
+    parallel: force (True) or disable (False) the process pool; by default it is used when the
+    batch is at least DEID_PARALLEL_MIN_CHARS and there is more than one worker.
+    """
+    texts = [text or "" for text in texts]
+    total_chars = sum(len(text) for text in texts)
+    if parallel is None:
+        parallel = DEID_POOL_WORKERS > 1 and total_chars >= DEID_PARALLEL_MIN_CHARS
+    if not parallel:
+        return [basic_deidentify_text(text) if text else "" for text in texts]
+
+    # Flatten to (document index, piece) tasks so one huge document is spread over several workers.
+    owners = []
+    pieces = []
+    for doc_index, text in enumerate(texts):
+        for piece in split_at_safe_boundaries(text):
+            owners.append(doc_index)
+            pieces.append(piece)
+    try:
+        processed = list(_get_pool().map(basic_deidentify_text, pieces))
+    except BrokenProcessPool as e:
+        print(f"WARNING: De-identification pool broke ({e}); restarting it and falling back to in-process for this batch.")
+        shutdown_pool()
+        return [basic_deidentify_text(text) if text else "" for text in texts]
+
+    results = [[] for _ in texts]
+    for doc_index, piece in zip(owners, processed):
+        results[doc_index].append(piece)
+    print(f"DEBUG: De-identified {len(texts)} documents ({total_chars} chars) as {len(pieces)} pieces on the pool.")
+    return ["".join(parts) for parts in results]
+
+
+def benchmark_deidentification(texts, repeats=3):
+    """
+    Compares in-process and pooled de-identification of the same batch.
+    Returns {"chars", "cpu_count", "workers", "serial_seconds", "parallel_seconds", "speedup", "efficiency"}.
+    """
+    warm_up_pool()  # Worker start-up is a one-off cost, not part of the per-request comparison.
+    serial = min(_timed(lambda: deidentify_documents(texts, parallel=False)) for _ in range(repeats))
+    parallel = min(_timed(lambda: deidentify_documents(texts, parallel=True)) for _ in range(repeats))
+    speedup = serial / parallel if parallel else float("inf")
+    return {
+        "chars": sum(len(text) for text in texts), "cpu_count": os.cpu_count(), "workers": DEID_POOL_WORKERS,
+        "serial_seconds": serial, "parallel_seconds": parallel, "speedup": speedup,
+        "efficiency": speedup / DEID_POOL_WORKERS,
+    }
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    # Synthetic batch shaped like one large upload: four sections, one of them a long outside record.
+    paragraph = ("Mr. John Smith, a 72-year-old seen on 03/14/2023 at 1200 Oak Street, reports memory loss. "
+                 "Call 210-555-0100 or jsmith@example.com. MRN AB123456. Mini Mental State Exam 24/30.\n\n")
+    size_multiplier = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    batch = [paragraph * size_multiplier, paragraph * 50, paragraph * 200, paragraph * 10]
+    report = benchmark_deidentification(batch)
+    shutdown_pool()
+    print(f"De-identified {report['chars']} chars: serial {report['serial_seconds']:.3f}s, "
+          f"pool {report['parallel_seconds']:.3f}s -> speedup {report['speedup']:.2f}x "
+          f"on {report['workers']} workers / {report['cpu_count']} cores (efficiency {report['efficiency']:.0%}).")
@@ -13,7 +13,7 @@ import sys  # For sys.stdout.encoding
 #    Consult the documentation for the version of Scrubber you are using.
 #    The example below uses hypothetical flags.
 
-SCRUBBER_EXE_PATH = "C:\Users\u2121\projects\neuroapp\scrubber.19.0411W\scrubber.19.0411W.exe"  # Assumes scrubber.exe is in PATH or current dir.
+SCRUBBER_EXE_PATH = r"C:\Users\u2121\projects\neuroapp\scrubber.19.0411W\scrubber.19.0411W.exe"  # Assumes scrubber.exe is in PATH or current dir.
 # OR "C:/path/to/your/scrubber.exe"
 # OR "./tools/scrubber.exe" (relative path)
 
@@ -129,10 +129,50 @@ def deidentify_text_with_scrubber(text_content):
         if 'outfile_path' in locals() and os.path.exists(outfile_path): os.remove(outfile_path)
 
 
+# Capitalized words the generic name guess never redacts on their own: a run made only of these (e.g. "Mini Mental
+# State", "Alzheimer Disease", "Lewy Body Dementia") is a clinical term, not a name.
+_CLINICAL_TERM_WORDS = {
+    "mini", "mental", "state", "exam", "examination", "montreal", "cognitive", "assessment", "clinical", "dementia",
+    "rating", "scale", "geriatric", "depression", "functional", "activities", "questionnaire", "alzheimer",
+    "alzheimers", "disease", "lewy", "body", "bodies", "parkinson", "parkinsons", "frontotemporal", "vascular",
+    "primary", "progressive", "aphasia", "normal", "pressure", "hydrocephalus", "mild", "moderate", "severe",
+    "impairment", "amyloid", "tau", "positron", "emission", "tomography", "magnetic", "resonance", "imaging",
+    "cerebrospinal", "fluid", "diagnostic", "statistical", "manual", "boston", "naming", "test", "trail", "making",
+    "clock", "drawing", "memory", "clinic", "history", "present", "illness", "medications", "allergies", "plan",
+    "impression", "family", "social", "review", "systems", "physical", "neurological", "labs", "results",
+}
+# Words that start sentences next to a surrogate ("[PERSON_1] The ...") and are not first names.
+_NOT_NAME_WORDS = _CLINICAL_TERM_WORDS | {
+    "the", "she", "he", "they", "his", "her", "their", "this", "that", "and", "but", "with", "patient", "husband",
+    "wife", "daughter", "son", "mother", "father", "sister", "brother", "caregiver", "reports", "states", "says",
+}
+_GENERIC_NAME_RE = re.compile(r'\b[A-Z][a-z]+(?:\s+[A-Z][a-z]+){1,2}\b')
+# A capitalized word directly beside a dictionary surrogate is the rest of that person's name ("husband John
+# [PERSON_1]"), even when it is a single word the generic guess would not catch.
+_NAME_BEFORE_SURROGATE_RE = re.compile(r'\b([A-Z][a-z]+)(?=[ \t]+\[PERSON_\d+\])')
+_NAME_AFTER_SURROGATE_RE = re.compile(r'(\[PERSON_\d+\][ \t]+)([A-Z][a-z]+)\b')
+
+
+def _redact_generic_name(match):
+    if all(word.lower() in _CLINICAL_TERM_WORDS for word in match.group(0).split()):
+        return match.group(0)
+    return '[NAME_REDACTED]'
+
+
+def _redact_name_beside_surrogate(match):
+    prefix = match.group(1) if match.re is _NAME_AFTER_SURROGATE_RE else ''
+    word = match.group(match.lastindex)
+    return match.group(0) if word.lower() in _NOT_NAME_WORDS else prefix + '[NAME_REDACTED]'
+
+
 # Keep basic_deidentify_text as a fallback or alternative
+# The generic capitalized-word name guess always runs, including on text whose known names were already replaced
+# by identifier_redactor: it is the safeguard for names the dictionary did not know about.
 def basic_deidentify_text(text):
     if not text: return ""
-    text = re.sub(r'\b[A-Z][a-z]+(?:\s+[A-Z][a-z]+){1,2}\b', '[NAME_REDACTED]', text)
+    text = _NAME_BEFORE_SURROGATE_RE.sub(_redact_name_beside_surrogate, text)
+    text = _NAME_AFTER_SURROGATE_RE.sub(_redact_name_beside_surrogate, text)
+    text = _GENERIC_NAME_RE.sub(_redact_generic_name, text)
     text = re.sub(r'\b(Mr|Mrs|Ms|Dr)\.\s*[A-Z][a-z]+(?:\s+[A-Z][a-z]+)?\b', '[NAME_REDACTED]', text)
     text = re.sub(r'\b\d{1,2}[/-]\d{1,2}[/-]\d{2,4}\b', '[DATE_REDACTED]', text)
     text = re.sub(
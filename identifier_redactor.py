@@ -0,0 +1,386 @@
+# identifier_redactor.py
+# Dictionary-driven redaction of known patient identifiers with consistent surrogate tokens.
+# The identifiers of a request (patient and family names, MRNs, addresses) are read from the header
+# block of the background documents ("Patient: ...", "MRN: ...", "Wife: ...") plus the optional
+# known_identifiers form field; never from the transcription, where "Daughter: she forgets..." is a speaker
+# turn, not a header. A person value is only taken when it looks like a name. The identifiers are compiled
+# into one Aho-Corasick automaton, and each of the four sections is scanned with it once. Every occurrence
+# of the same identifier, in any section and in any capitalization, becomes the same surrogate ([PERSON_1],
+# [MRN_1], [ADDRESS_1]), so the model can tell that the person in the transcription is the person in the
+# background.
+# With a surrogate key (per patient, see patient_fact_store.surrogate_key) the surrogate number is derived from
+# the identifier itself, so a person keeps the same surrogate at every visit whatever else was uploaded, and the
+# facts stored for the patient keep referring to the right person.
+# The surrogate -> original mapping is not kept: it is not sent to the model, returned to the client or stored.
+import hashlib
+import hmac
+import re
+import sys
+import time
+from array import array
+from bisect import bisect_right
+from collections import deque
+
+HEADER_BLOCK_LINES = 30  # Identifiers are only harvested from the first lines of each background document.
+MIN_NAME_PART_CHARS = 3
+
+_HEADER_FIELD_RE = re.compile(
+    r"^[ \t]*(?P<label>patient(?:[ \t]+name)?|name|mrn|medical[ \t]+record[ \t]+(?:number|no\.?|#)|address|"
+    r"wife|husband|spouse|partner|son|daughter|mother|father|sister|brother|caregiver|informant|"
+    r"emergency[ \t]+contact)[ \t]*[:#][ \t]*(?P<value>\S.*)$",
+    re.IGNORECASE | re.MULTILINE)
+_LABEL_KINDS = {"mrn": "MRN", "medical": "MRN", "address": "ADDRESS"}  # Every other label names a person.
+_TITLE_RE = re.compile(r"^(?:mr|mrs|ms|miss|dr)\.?\s+", re.IGNORECASE)
+_NAME_TOKEN_RE = re.compile(r"[A-Za-z][A-Za-z'\-]*\.?")
+_LAST_FIRST_RE = re.compile(r"^([A-Z][A-Za-z'\-]+),\s*([A-Z][A-Za-z'\-]+)")
+_MRN_VALUE_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9\-]*\d[A-Za-z0-9\-]*")
+_WHITESPACE_RUN_RE = re.compile(r"\s+")
+
+# Single name parts that are also everyday words are only redacted as part of the full name.
+_COMMON_WORDS = {
+    "will", "may", "june", "april", "august", "mark", "bill", "grace", "hope", "joy", "faith", "rose", "art",
+    "ray", "dean", "long", "young", "white", "black", "brown", "green", "gray", "grey", "king", "hill", "wood",
+    "ward", "rich", "said", "sun", "son", "the", "and", "patient", "wife", "husband", "daughter", "mother",
+}
+
+# Pronouns and other function words: never a name or a name part, whatever their capitalization.
+_NAME_STOPWORDS = {
+    "i", "me", "my", "you", "your", "he", "him", "his", "she", "her", "hers", "we", "us", "our", "they", "them",
+    "their", "it", "its", "this", "that", "who", "what", "which", "is", "am", "are", "was", "were", "be", "has",
+    "have", "had", "does", "did", "not", "no", "yes", "says", "said", "a", "an", "of", "to", "in", "on", "at",
+    "for", "with", "from", "by", "as", "or", "but", "if", "so", "very", "fine", "well", "ok", "okay", "unknown",
+    "none", "n/a", "na", "same", "see", "above", "below",
+}
+# Lowercase surname particles allowed between the capitalized tokens of a name ("Ludwig van Beethoven").
+_NAME_PARTICLES = {"van", "von", "de", "der", "den", "del", "della", "da", "di", "du", "la", "le", "bin", "al"}
+MAX_NAME_TOKENS = 4
+STABLE_SURROGATE_SPACE = 10000  # Keyed surrogates are [KIND_0] to [KIND_9999].
+
+
+class AhoCorasick:
+    """
+    Case-insensitive multi-pattern matcher. Patterns are added with an arbitrary payload; `find(text)` returns
+    non-overlapping (start, end, payload) matches that start and end on word boundaries, preferring the
+    leftmost and then the longest match. Runs of whitespace in the text match a single space in a pattern.
+    """
+
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]  # node -> [(pattern length, payload)], including outputs reachable via fail links
+        self._built = False
+
+    def add(self, pattern, payload):
+        key = _normalize(pattern)[0].strip()
+        if not key:
+            return
+        node = 0
+        for ch in key:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        if all(length != len(key) for length, _ in self._out[node]):
+            self._out[node].append((len(key), payload))
+        self._built = False
+
+    def build(self):
+        queue = deque(self._goto[0].values())  # Depth-1 nodes keep fail = 0 (the root).
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+                queue.append(child)
+        self._built = True
+
+    def find(self, text):
+        if not self._built:
+            self.build()
+        normalized, to_original = _normalize(text)
+        goto, fail, out = self._goto, self._fail, self._out
+        candidates = []
+        node = 0
+        for i, ch in enumerate(normalized):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for length, payload in out[node]:
+                start = i - length + 1
+                if _is_word_boundary(normalized, start - 1) and _is_word_boundary(normalized, i + 1):
+                    candidates.append((start, -length, payload))
+        matches = []
+        covered_until = 0
+        for start, neg_length, payload in sorted(candidates, key=lambda c: (c[0], c[1])):
+            if start < covered_until:
+                continue
+            end = start - neg_length
+            matches.append((to_original(start), to_original(end - 1) + 1, payload))
+            covered_until = end
+        return matches
+
+
+def _normalize(text):
+    """
+    Lowercases and collapses whitespace runs to one space. Returns (normalized, to_original) where
+    to_original(i) is the index in `text` of normalized character i. The mapping is kept as the offsets that
+    change after each collapsed run rather than one index per character, so it stays small for large inputs.
+    """
+    lowered = text.lower()
+    if len(lowered) != len(text):  # A few characters lowercase to two (e.g. "\u0130"); those are kept as is.
+        lowered = "".join(low if len(low) == 1 else ch for ch, low in ((ch, ch.lower()) for ch in text))
+    starts = array("q", [0])  # normalized index from which ...
+    shifts = array("q", [0])  # ... original index = normalized index + shift
+    removed = 0
+    for match in _WHITESPACE_RUN_RE.finditer(lowered):
+        removed += match.end() - match.start() - 1
+        if removed != shifts[-1]:
+            starts.append(match.end() - removed)
+            shifts.append(removed)
+    normalized = _WHITESPACE_RUN_RE.sub(" ", lowered)
+
+    def to_original(index):
+        return index + shifts[bisect_right(starts, index) - 1]
+
+    return normalized, to_original
+
+
+def _is_word_boundary(text, index):
+    return index < 0 or index >= len(text) or not text[index].isalnum()
+
+
+def _is_name_token(token):
+    return token[0].isupper() and token.lower() not in _NAME_STOPWORDS
+
+
+def _clean_person_name(value, min_tokens=2):
+    """
+    The name at the start of a header value ("Jane Doe (daughter)" -> "Jane Doe", "Doe, Jane" -> "Jane Doe"),
+    or None unless it is min_tokens to MAX_NAME_TOKENS capitalized tokens that are not pronouns or stopwords.
+    """
+    value = _TITLE_RE.sub("", value.strip())
+    last_first = _LAST_FIRST_RE.match(value)
+    if last_first and _is_name_token(last_first.group(1)) and _is_name_token(last_first.group(2)):
+        return f"{last_first.group(2)} {last_first.group(1)}"
+    tokens = []
+    for match in _NAME_TOKEN_RE.finditer(value):
+        if value[match.start() - 1:match.start()] not in ("", " ", "\t") and match.start() > 0:
+            break  # Punctuation ("Jane Doe, who...", "Jane (Doe)") ends the name.
+        token = match.group(0).rstrip(".")
+        if not _is_name_token(token) and not (tokens and token in _NAME_PARTICLES):
+            break
+        tokens.append(token)
+        if match.group(0).endswith(".") and len(token) > 1:
+            break  # End of a sentence, not an initial.
+    while tokens and tokens[-1] in _NAME_PARTICLES:
+        tokens.pop()
+    if not min_tokens <= len(tokens) <= MAX_NAME_TOKENS:
+        return None
+    name = " ".join(tokens)
+    return name if len(name) >= MIN_NAME_PART_CHARS else None
+
+
+def _header_block(text):
+    """The first HEADER_BLOCK_LINES lines of `text`, without splitting the whole (possibly very large) text."""
+    end = -1
+    for _ in range(HEADER_BLOCK_LINES):  # splitlines also breaks on \r, \u2028, ...: never fewer lines than this.
+        end = text.find("\n", end + 1)
+        if end < 0:
+            end = len(text)
+            break
+    return "\n".join(text[:end].splitlines()[:HEADER_BLOCK_LINES])
+
+
+def extract_known_identifiers(background_texts, extra_identifiers_text=""):
+    """
+    Harvests identifiers from the header block of each background document and from the free-text
+    known_identifiers field ("Label: value" lines like the headers; bare lines are taken as person names).
+    Only pass background documents: other sections (the transcription above all) have "Speaker: ..." lines.
+    A header person value needs two to four capitalized name tokens; the known_identifiers field, typed by the
+    clinician, may also give a single name.
+    Returns a list of (kind, value) with kind in PERSON / MRN / ADDRESS, deduplicated, in order of appearance.
+    """
+    sources = [(_header_block(text or ""), 2) for text in background_texts]
+    extra_lines = [line.strip() for line in (extra_identifiers_text or "").splitlines() if line.strip()]
+    sources.append(("\n".join(line if _HEADER_FIELD_RE.match(line) else f"Name: {line}" for line in extra_lines), 1))
+
+    identifiers = []
+    seen = set()
+    for source, min_name_tokens in sources:
+        for match in _HEADER_FIELD_RE.finditer(source):
+            kind = _LABEL_KINDS.get(match.group("label").split()[0].lower(), "PERSON")
+            raw_value = match.group("value").strip()
+            if kind == "PERSON":
+                value = _clean_person_name(raw_value, min_name_tokens)
+            elif kind == "MRN":
+                mrn = _MRN_VALUE_RE.search(raw_value)
+                value = mrn.group(0) if mrn else None
+            else:
+                value = raw_value.rstrip(" .;")
+            if value and (kind, value.lower()) not in seen:
+                seen.add((kind, value.lower()))
+                identifiers.append((kind, value))
+    return identifiers
+
+
+def _variants(kind, value):
+    """The spellings of one identifier that should map to its surrogate."""
+    variants = [value]
+    if kind == "PERSON":
+        parts = value.split()
+        if len(parts) > 1:
+            variants.append(f"{parts[-1]}, {parts[0]}")
+            variants.extend(p for p in parts if len(p) >= MIN_NAME_PART_CHARS and p.lower() not in _COMMON_WORDS
+                            and p.lower() not in _NAME_STOPWORDS and p.lower() not in _NAME_PARTICLES)
+    elif kind == "MRN":
+        digits = re.sub(r"\D", "", value)
+        if digits != value and len(digits) >= 5:
+            variants.append(digits)
+    elif kind == "ADDRESS":
+        street = value.split(",")[0].strip()
+        if street != value and len(street) >= 8:
+            variants.append(street)
+    return variants
+
+
+def _stable_surrogate_number(surrogate_key, kind, value, taken):
+    """A number for (kind, value) derived from surrogate_key, moved to the next free one if already taken."""
+    digest = hmac.new(surrogate_key, f"{kind}\x00{_normalize(value)[0].strip()}".encode("utf-8"), hashlib.sha256)
+    number = int(digest.hexdigest()[:8], 16) % STABLE_SURROGATE_SPACE
+    while number in taken:
+        number = (number + 1) % STABLE_SURROGATE_SPACE
+    return number
+
+
+class IdentifierRedactor:
+    """
+    Built once per request from (kind, value) identifiers. `redact_sections(texts)` scans each section once
+    and returns (redacted_texts, mapping) with mapping {surrogate: original value}.
+    When two identifiers share a name part (a patient and a spouse with one surname), the bare part maps to
+    the identifier listed first.
+    surrogate_key: optional bytes; surrogates are then numbered from a keyed hash of each identifier (the same
+    for the same identifier under the same key) instead of in order of appearance.
+    """
+
+    def __init__(self, identifiers, surrogate_key=None):
+        self.surrogates = []  # index -> (surrogate, original value)
+        counters = {}
+        taken = {}
+        self._automaton = AhoCorasick()
+        for kind, value in identifiers:
+            if surrogate_key:
+                number = _stable_surrogate_number(surrogate_key, kind, value, taken.setdefault(kind, set()))
+                taken[kind].add(number)
+            else:
+                number = counters[kind] = counters.get(kind, 0) + 1
+            entity = len(self.surrogates)
+            self.surrogates.append((f"[{kind}_{number}]", value))
+            for variant in _variants(kind, value):
+                self._automaton.add(variant, entity)
+        self._automaton.build()
+
+    def redact_sections(self, texts):
+        redacted = []
+        used = {}
+        replaced = 0
+        for text in texts:
+            text = text or ""
+            pieces = []
+            last = 0
+            for start, end, entity in self._automaton.find(text):
+                surrogate, original = self.surrogates[entity]
+                pieces.append(text[last:start])
+                pieces.append(surrogate)
+                used[surrogate] = original
+                last = end
+            replaced += len(pieces) // 2
+            if pieces:
+                pieces.append(text[last:])
+                text = "".join(pieces)
+            redacted.append(text)
+        print(f"DEBUG: Dictionary redaction replaced {replaced} identifier occurrences "
+              f"({len(used)} distinct surrogates) across {len(texts)} texts.")
+        return redacted, used
+
+
+def benchmark_redaction(section_texts, identifiers, repeats=3):
+    """
+    Times the one-pass dictionary redaction against the regex chain (basic_deidentify_text) on the same texts.
+    Returns {"chars", "identifiers", "automaton_seconds", "regex_chain_seconds"}.
+    """
+    import contextlib
+    import io
+    from deidentifier import basic_deidentify_text
+
+    def timed(fn):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            fn()
+        return time.perf_counter() - start
+
+    automaton_seconds = min(timed(lambda: IdentifierRedactor(identifiers).redact_sections(section_texts))
+                            for _ in range(repeats))
+    regex_seconds = min(timed(lambda: [basic_deidentify_text(t) for t in section_texts]) for _ in range(repeats))
+    return {"chars": sum(len(t) for t in section_texts), "identifiers": len(identifiers),
+            "automaton_seconds": automaton_seconds, "regex_chain_seconds": regex_seconds}
+
+
+def _regression_failures():
+    """Cases from review: speaker turns are not headers, and only name-like header values become identifiers."""
+    from deidentifier import basic_deidentify_text
+    background = ("Patient: Eleanor Whitfield\nMRN: 448-221-09\nDaughter: she forgets her keys\n"
+                  "Husband: husband, who says she drives\n\nSeen with Susan Miller and Robert Jones. "
+                  "Mini Mental State Exam 22/30. Alzheimer Disease suspected.")
+    transcription = "Daughter: she forgets her keys.\nPatient: I am fine.\nDoctor: Does husband John Whitfield drive?"
+
+    def deidentify(texts):
+        redacted_texts, _ = IdentifierRedactor(extract_known_identifiers([texts[0]])).redact_sections(texts)
+        return [basic_deidentify_text(text) for text in redacted_texts]
+
+    known = extract_known_identifiers([background])
+    redacted = deidentify([background, transcription])
+    mrn_only = deidentify(["MRN: 448-221-09\n\nSeen with Susan Miller."])[0]
+    checks = (
+        ("only name-like header values harvested", known == [("PERSON", "Eleanor Whitfield"), ("MRN", "448-221-09")]),
+        ("pronouns and words kept", "she forgets her keys" in redacted[1] and "I am fine" in redacted[1]),
+        ("unknown names redacted by the generic pass", "Susan Miller" not in redacted[0]
+         and "Robert Jones" not in redacted[0] and "Susan Miller" not in mrn_only),
+        ("clinical terms kept", "Mini Mental State Exam" in redacted[0] and "Alzheimer Disease" in redacted[0]),
+        ("first name beside a surrogate redacted", "John" not in redacted[1]),
+    )
+    return [description for description, ok in checks if not ok]
+
+
+if __name__ == '__main__':
+    import contextlib
+    import io
+    with contextlib.redirect_stdout(io.StringIO()):
+        regression_failures = _regression_failures()
+    for failure in regression_failures:
+        print(f"FAILED: {failure}")
+    print(f"Regression cases: {len(regression_failures)} failed.")
+    # Synthetic visit: the identifiers come from the background header; the transcript is lowercase.
+    background = ("Patient: Eleanor Whitfield\nMRN: 448-221-09\nAddress: 12 Larkspur Lane, Dayton, OH\n"
+                  "Husband: Harold Whitfield\n\n"
+                  + "Mrs. Whitfield has progressive memory loss. Mini Mental State Exam 22/30. "
+                    "Alzheimer Disease suspected; amyloid PET ordered. Harold reports she got lost driving.\n" * 200)
+    transcription = "doctor: how is eleanor doing? harold whitfield: she repeats questions all day.\n" * 400
+    sections = [background, "", transcription, "MRN 44822109 reviewed."]
+    known = extract_known_identifiers([background])
+    redacted, mapping = IdentifierRedactor(known).redact_sections(sections)
+    print("Identifiers:", known)
+    print("Surrogates:", mapping)
+    print("Sample:", redacted[0][120:330].replace("\n", " | "), "...", redacted[2][:80])
+    multiplier = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    report = benchmark_redaction([s * multiplier for s in sections], known)
+    mb = report["chars"] / 1e6
+    print(f"{report['chars']} chars, {report['identifiers']} identifiers: automaton {report['automaton_seconds']:.3f}s "
+          f"({mb / report['automaton_seconds']:.1f} MB/s), regex chain {report['regex_chain_seconds']:.3f}s "
+          f"({mb / report['regex_chain_seconds']:.1f} MB/s).")
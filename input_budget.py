@@ -0,0 +1,43 @@
+# input_budget.py
+# Per-request size caps on the patient text a /generate_note request may bring in. Every text collected for
+# a section (typed text, extracted upload text, transcripts) is counted as it is added, so an oversized
+# request is refused with 413 before de-identification, the run store and the model stages each hold their
+# own copies of it. A section over INPUT_SECTION_MAX_CHARS, or all sections together over
+# INPUT_TOTAL_MAX_CHARS, fails the request.
+import os
+
+INPUT_SECTION_MAX_CHARS = int(os.getenv("INPUT_SECTION_MAX_CHARS", "1000000"))
+INPUT_TOTAL_MAX_CHARS = int(os.getenv("INPUT_TOTAL_MAX_CHARS", "2000000"))
+
+# Form fields are parsed before the caps can be checked; a UTF-8 character is at most 4 bytes.
+INPUT_FORM_FIELD_MAX_BYTES = INPUT_SECTION_MAX_CHARS * 4
+
+
+class InputTooLarge(Exception):
+    """A request's text is over a size cap; carries the HTTP status to answer with."""
+
+    def __init__(self, message, status=413):
+        super().__init__(message)
+        self.status = status
+
+
+class InputBudget:
+    """Running per-section and total character counts for one request."""
+
+    def __init__(self, section_max_chars=INPUT_SECTION_MAX_CHARS, total_max_chars=INPUT_TOTAL_MAX_CHARS):
+        self.section_max_chars = section_max_chars
+        self.total_max_chars = total_max_chars
+        self.section_chars = {}
+        self.total_chars = 0
+
+    def add(self, section, text):
+        """Counts `text` against `section`; raises InputTooLarge when a cap is exceeded."""
+        size = len(text or "")
+        section_chars = self.section_chars.get(section, 0) + size
+        if section_chars > self.section_max_chars:
+            raise InputTooLarge(f"The {section} input is {section_chars} characters; "
+                                f"the limit is {self.section_max_chars} per section.")
+        if self.total_chars + size > self.total_max_chars:
+            raise InputTooLarge(f"The inputs are over {self.total_max_chars} characters in total.")
+        self.section_chars[section] = section_chars
+        self.total_chars += size
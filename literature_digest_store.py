@@ -0,0 +1,282 @@
+# literature_digest_store.py
+# Versioned store of finished "### Recent Literature Summary" sections, one per normalized diagnosis.
+# generate_full_note looks the diagnosis up here (an in-memory dict lookup) and only falls back to live
+# PubMed search + Gemini summarization for diagnoses the store has not seen yet. Those misses are logged
+# and picked up by the next offline rebuild:
+#
+#     python literature_digest_store.py rebuild ["Alzheimer's Disease" ...] [--diagnoses-file FILE]
+#
+# Every rebuild writes a new immutable digests-<version>.json and then repoints CURRENT at it; old
+# versions are kept, and usage.jsonl records which digest version went into which note. A server logs each
+# missed diagnosis once per store version; a rebuild renames misses.jsonl aside before reading it, so misses
+# logged while it runs go to a fresh file, and deletes the renamed file only once the new version is published.
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+LITERATURE_DIGEST_DIR = os.getenv("LITERATURE_DIGEST_DIR", os.path.join("data", "literature_digests"))
+LITERATURE_DIGEST_RELOAD_SECONDS = 60  # How often a running server checks CURRENT for a newer version.
+
+DEFAULT_DIAGNOSES = [
+    "Alzheimer's Disease",
+    "Mild Cognitive Impairment due to Alzheimer's Disease",
+    "Frontotemporal Dementia",
+    "Dementia with Lewy Bodies",
+    "Vascular Dementia",
+    "Primary Progressive Aphasia",
+    "Normal Pressure Hydrocephalus",
+]
+
+_CURRENT_FILE = "CURRENT"
+_USAGE_LOG = "usage.jsonl"
+_MISSES_LOG = "misses.jsonl"
+_PENDING_MISSES_PATTERN = "misses-*.pending.jsonl"
+
+_store_lock = threading.Lock()
+_loaded_store = {"version": None, "entries": {}, "checked_at": None}
+_misses_lock = threading.Lock()
+_logged_misses = {"version": None, "keys": set()}  # Diagnoses this process has logged against that store version.
+
+
+def normalize_diagnosis(diagnosis):
+    """'Alzheimer's Disease.' and 'alzheimers  disease' map to the same key."""
+    text = (diagnosis or "").lower().replace("'", "").replace("’", "")
+    return re.sub(r"[^a-z0-9]+", " ", text).strip()
+
+
+def _path(name):
+    return os.path.join(LITERATURE_DIGEST_DIR, name)
+
+
+def _read_current_version():
+    try:
+        with open(_path(_CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def load_store_version(version):
+    """Returns the full store document for `version` (used for audits and by the rebuild job)."""
+    with open(_path(f"digests-{version}.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _current_entries():
+    """The entries of the CURRENT version, reloaded at most every LITERATURE_DIGEST_RELOAD_SECONDS."""
+    now = time.monotonic()
+    checked_at = _loaded_store["checked_at"]
+    if checked_at is not None and now - checked_at < LITERATURE_DIGEST_RELOAD_SECONDS:
+        return _loaded_store["version"], _loaded_store["entries"]
+    with _store_lock:
+        checked_at = _loaded_store["checked_at"]
+        if checked_at is None or now - checked_at >= LITERATURE_DIGEST_RELOAD_SECONDS:
+            version = _read_current_version()
+            if version and version != _loaded_store["version"]:
+                try:
+                    _loaded_store["entries"] = load_store_version(version)["entries"]
+                    _loaded_store["version"] = version
+                    print(f"DEBUG: Loaded literature digest store version {version} "
+                          f"({len(_loaded_store['entries'])} diagnoses).")
+                except (OSError, ValueError, KeyError) as e:
+                    print(f"ERROR loading literature digest store version {version}: {e}")
+            _loaded_store["checked_at"] = now
+    return _loaded_store["version"], _loaded_store["entries"]
+
+
+def lookup_literature_digest(diagnosis):
+    """
+    Returns {"summary", "store_version", "entry_version", "pmids", "built_at"} for the diagnosis,
+    or None if the current store has no digest for it.
+    """
+    store_version, entries = _current_entries()
+    entry = entries.get(normalize_diagnosis(diagnosis))
+    if not entry:
+        return None
+    return dict(entry, store_version=store_version)
+
+
+def _append_jsonl(name, record):
+    try:
+        os.makedirs(LITERATURE_DIGEST_DIR, exist_ok=True)
+        with _store_lock, open(_path(name), "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        print(f"WARNING: Could not append to literature digest log {name}: {e}")
+
+
+def record_digest_use(diagnosis, digest, note_ref=None):
+    """Audit trail: which digest version was inserted into which note."""
+    _append_jsonl(_USAGE_LOG, {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "note_ref": note_ref,
+        "diagnosis": diagnosis, "store_version": digest["store_version"], "entry_version": digest["entry_version"],
+    })
+
+
+def record_digest_miss(diagnosis):
+    """Remembers diagnoses served live so the next rebuild adds them to the store (once per store version)."""
+    key = normalize_diagnosis(diagnosis)
+    with _misses_lock:
+        if _logged_misses["version"] != _loaded_store["version"]:
+            _logged_misses["version"] = _loaded_store["version"]
+            _logged_misses["keys"] = set()
+        if not key or key in _logged_misses["keys"]:
+            return
+        _logged_misses["keys"].add(key)
+    _append_jsonl(_MISSES_LOG, {"time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "diagnosis": diagnosis})
+
+
+def take_pending_misses():
+    """
+    Renames misses.jsonl aside (new misses go to a fresh file) and returns the paths of every renamed log not
+    yet consumed, including those left by a rebuild that failed.
+    """
+    try:
+        with _store_lock:
+            os.replace(_path(_MISSES_LOG), _path(f"misses-{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}-"
+                                                 f"{os.getpid()}.pending.jsonl"))
+    except OSError:
+        pass  # Nothing logged since the last rebuild.
+    return sorted(glob.glob(_path(_PENDING_MISSES_PATTERN)))
+
+
+def _read_missed_diagnoses(paths):
+    """The diagnoses in the given miss logs, one per normalized diagnosis, in first-logged order."""
+    missed = {}
+    for path in paths:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        diagnosis = json.loads(line)["diagnosis"]
+                    except (ValueError, KeyError):
+                        continue
+                    missed.setdefault(normalize_diagnosis(diagnosis), diagnosis)
+        except OSError:
+            continue
+    return [diagnosis for key, diagnosis in missed.items() if key]
+
+
+def rebuild_literature_digests(diagnoses, max_results=5, pending_misses=()):
+    """
+    Offline batch job: fetches guideline PMIDs for every diagnosis, fetches the abstracts of all new PMIDs in one
+    batched efetch, summarizes, and publishes a new store version. A diagnosis whose PMID list is
+    unchanged since the previous version keeps its previous summary without a model call.
+    pending_misses: miss logs from take_pending_misses, deleted once the new version is published; their
+    diagnoses that still have no digest are logged as misses again.
+    Returns the new version id.
+    """
+    import note_processing_core as core  # Imported here: core itself imports this module.
+
+    core.initialize_vertex_ai()
+    previous_version = _read_current_version()
+    previous_entries = load_store_version(previous_version)["entries"] if previous_version else {}
+
+    entries = {}
+    queued = set()
+    to_summarize = []  # (key, diagnosis, pmids, previous entry) of the diagnoses with new PMIDs
+    for diagnosis in diagnoses:
+        key = normalize_diagnosis(diagnosis)
+        if not key or key in entries or key in queued:
+            continue
+        previous = previous_entries.get(key)
+        try:
+            pmids = list(dict.fromkeys(core.search_guideline_pmids(diagnosis, max_results=max_results)))
+        except Exception as e:
+            print(f"ERROR searching PubMed for '{diagnosis}': {e}. Keeping previous digest if any.")
+            if previous:
+                entries[key] = previous
+            continue
+
+        if previous and previous["pmids"] == pmids:
+            print(f"DEBUG: '{diagnosis}': PMIDs unchanged, reusing digest {previous['entry_version']}.")
+            entries[key] = previous
+            continue
+        to_summarize.append((key, diagnosis, pmids, previous))
+        queued.add(key)
+
+    # Every abstract the job needs comes from one efetch, cached per PMID: PMIDs shared between diagnoses
+    # are fetched once, and NCBI sees one request rather than one per PMID.
+    abstracts_by_pmid = {}
+    pmids_to_fetch = list(dict.fromkeys(pmid for _, _, pmids, _ in to_summarize for pmid in pmids))
+    if pmids_to_fetch:
+        try:
+            abstracts_by_pmid = core.fetch_abstracts_by_pmid(pmids_to_fetch)
+        except Exception as e:
+            print(f"ERROR fetching {len(pmids_to_fetch)} PMIDs: {e}")
+
+    for key, diagnosis, pmids, previous in to_summarize:
+        if not pmids:
+            summary = f"### Recent Literature Summary\n\nNo recent relevant guidelines found on PubMed for '{diagnosis}'."
+        else:
+            abstracts = [abstract for pmid in pmids for abstract in abstracts_by_pmid.get(pmid, [])]
+            summary = core.summarize_literature_with_gemini(abstracts, diagnosis)
+            if "Error summarizing literature." in summary:
+                print(f"ERROR: Summarization failed for '{diagnosis}'. Keeping previous digest if any.")
+                if previous:
+                    entries[key] = previous
+                continue
+
+        entry_hash = hashlib.sha256(json.dumps([pmids, summary]).encode("utf-8")).hexdigest()[:12]
+        entries[key] = {
+            "diagnosis": diagnosis, "pmids": pmids, "summary": summary, "entry_version": entry_hash,
+            "built_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        }
+        print(f"DEBUG: '{diagnosis}': new digest {entry_hash} from {len(pmids)} PMIDs.")
+
+    content_hash = hashlib.sha256(json.dumps(entries, sort_keys=True).encode("utf-8")).hexdigest()[:8]
+    version = f"{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}-{content_hash}"
+    os.makedirs(LITERATURE_DIGEST_DIR, exist_ok=True)
+    store_document = {"version": version, "previous_version": previous_version,
+                      "built_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "entries": entries}
+    tmp_path = _path(f"digests-{version}.json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(store_document, f, indent=1)
+    os.replace(tmp_path, _path(f"digests-{version}.json"))
+    tmp_path = _path(f"{_CURRENT_FILE}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(tmp_path, _path(_CURRENT_FILE))  # Servers pick this up within LITERATURE_DIGEST_RELOAD_SECONDS.
+    for diagnosis in _read_missed_diagnoses(pending_misses):
+        if normalize_diagnosis(diagnosis) not in entries:
+            record_digest_miss(diagnosis)  # Failed above; the next rebuild retries it.
+    for path in pending_misses:
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"WARNING: Could not remove consumed miss log {path}: {e}")
+    print(f"Published literature digest store version {version} with {len(entries)} diagnoses.")
+    return version
+
+
+def _diagnoses_for_rebuild(cli_diagnoses, diagnoses_file=None, pending_misses=()):
+    """CLI arguments, an optional file (one per line), everything in the current store and every logged miss."""
+    diagnoses = list(cli_diagnoses)
+    if diagnoses_file:
+        with open(diagnoses_file, "r", encoding="utf-8") as f:
+            diagnoses.extend(line.strip() for line in f if line.strip())
+    current_version = _read_current_version()
+    if current_version:
+        diagnoses.extend(entry["diagnosis"] for entry in load_store_version(current_version)["entries"].values())
+    diagnoses.extend(_read_missed_diagnoses(pending_misses))
+    return diagnoses or list(DEFAULT_DIAGNOSES)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if not args or args[0] != "rebuild":
+        print("Usage: python literature_digest_store.py rebuild [DIAGNOSIS ...] [--diagnoses-file FILE]")
+        sys.exit(2)
+    args = args[1:]
+    file_arg = None
+    if "--diagnoses-file" in args:
+        i = args.index("--diagnoses-file")
+        file_arg = args[i + 1]
+        args = args[:i] + args[i + 2:]
+    pending = take_pending_misses()
+    rebuild_literature_digests(_diagnoses_for_rebuild(args, file_arg, pending), pending_misses=pending)
@@ -0,0 +1,467 @@
+# load_test.py
+# Self-contained load generator for APP.py.
+# Starts the Flask app on a local threaded Werkzeug server with a fake Gemini model and a fake Entrez client
+# (configurable latency and error rate; no network, no credentials), then drives POST /generate_note with
+# multipart payloads (background/transcription/additional text plus synthetic TXT and PDF uploads) at stepped
+# concurrency levels. Each level runs a closed loop: every client thread sends its next request as soon as
+# the previous one returns. Per level it reports throughput, p50/p95/p99 latency, error rate and peak RSS.
+#
+#     python load_test.py --levels 1,4,16,32 --duration 20 --model-latency 2.0 --model-error-rate 0.02
+#
+# The server runs in this process, so the RSS figures include the client threads (small next to the server).
+# Run stores, caches and uploads go to a temporary directory; set every environment variable before APP import.
+#
+#     python load_test.py --stress 300 --stress-threads 64
+#
+# --stress skips HTTP and runs that many generate_full_note calls concurrently in threads of this process. The
+# fake model echoes the request and visit IDs it sees in each prompt, so a note containing another request's ID
+# shows state leaking between concurrent runs.
+#
+#     python load_test.py --batch 200 --model-latency 0.5
+#
+# --batch generates that many notes through batch_generation.py's local (file-based) batch backend and reports
+# how many batch jobs and model calls they took.
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGenerativeModel:
+    """Stands in for vertexai GenerativeModel: sleeps for the configured latency and answers by prompt type."""
+
+    def __init__(self, latency, jitter, error_rate):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    def generate_content(self, parts, **kwargs):
+        prompt = "".join(part for part in parts if isinstance(part, str)) if isinstance(parts, list) else parts
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if random.random() < self.error_rate:
+            raise RuntimeError("Fake model error: 503 Service Unavailable")
+        answer = _fake_model_answer(prompt)
+        echoed = sorted(set(_ECHO_ID_RE.findall(prompt)))
+        if echoed:
+            answer += "\n" + " ".join(f"[echo {request_id}]" for request_id in echoed)
+        return FakeResponse(answer)
+
+
+_ECHO_ID_RE = re.compile(r"\b(?:Request|Visit) ([0-9a-f]{8})\b")
+_ECHOED_ID_RE = re.compile(r"\[echo ([0-9a-f]{8})\]")
+
+
+def _fake_model_answer(prompt):
+    if "Generate the neurology note structure" in prompt:
+        return ("UT Health San Antonio\n## HPI\n" + "The patient reports gradual memory decline. " * 40 +
+                "\n[YOUR SEPARATELY GENERATED DETAILED MEDICAL EXPLANATION AND PLAN WILL BE INSERTED HERE BY THE SCRIPT]\n"
+                "--- Alzheimer's Disease Candidate Checklist ---\nplaceholder\n--- (End Checklist Template) ---\n"
+                "### Supporting Criteria from Diagnostic Algorithm\nGeneric criteria.\n")
+    if "comprehensive neurological assessment" in prompt:
+        return ("## Medical Explanation\n**Most Likely Diagnosis:** 1- Mild Dementia, 2- Amnestic Presentation, "
+                "3- Alzheimer's Disease.\n## Plan\n1. Amyloid PET.\n2. Follow up in 3 months.")
+    if "Populate the checklist now" in prompt:
+        return ("--- Alzheimer's Disease Candidate Checklist ---\nFilled checklist.\n"
+                "--- (End Checklist Template) ---")
+    if "Patient-Specific Elaboration" in prompt:
+        return "### Patient-Specific Elaboration of Diagnostic Criteria for Alzheimer's Disease\n* Gradual onset."
+    if "Recent Literature Summary" in prompt:
+        return "### Recent Literature Summary\n1. Guideline summary."
+    if "Summarize this excerpt" in prompt or "CHUNK" in prompt:
+        return "## Diagnoses\n- Memory loss"
+    return "### Missing Information\n- None"
+
+
+class FakeEntrez:
+    """Stands in for Bio.Entrez: esearch/efetch/read with the configured latency."""
+
+    email = None
+
+    class _Handle:
+        def __init__(self, data):
+            self.data = data
+
+        def read(self):
+            return self.data
+
+        def close(self):
+            pass
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def esearch(self, **kwargs):
+        time.sleep(self.latency)
+        return self._Handle({"IdList": ["100001", "100002", "100003"], "Count": "3"})
+
+    def efetch(self, **kwargs):
+        time.sleep(self.latency)
+        return self._Handle("\n\n".join(f"{i}. " + "Guideline recommendation text. " * 30 for i in range(1, 4)))
+
+    def read(self, handle):
+        return handle.read()
+
+
+def synthetic_pdf(lines):
+    """A minimal single-page PDF (Helvetica text objects) with the given lines."""
+    content = "BT /F1 10 Tf 50 780 Td 12 TL " + " ".join(
+        "(" + line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ") '" for line in lines) + " ET"
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R "
+        "/Resources << /Font << /F1 5 0 R >> >> >>",
+        f"<< /Length {len(content)} >>\nstream\n{content}\nendstream",
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    out = "%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out.encode("latin-1")))
+        out += f"{number} 0 obj\n{body}\nendobj\n"
+    xref_at = len(out.encode("latin-1"))
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n" + "".join(f"{o:010d} 00000 n \n" for o in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_at}\n%%EOF\n"
+    return out.encode("latin-1")
+
+
+def synthetic_visit(rng, background_paragraphs=40):
+    """Unique, realistic-looking section texts for one request."""
+    visit_id = uuid.uuid4().hex[:8]
+    age = rng.randint(58, 88)
+    mmse = rng.randint(14, 29)
+    background = "\n\n".join(
+        f"Visit {visit_id}-{i}: {age}-year-old seen for progressive memory loss over {rng.randint(1, 6)} years. "
+        f"MMSE {mmse}/30, MoCA {max(0, mmse - 4)}/30. BMI {rng.randint(19, 34)}. INR {rng.choice(['1.0', '1.1'])}. "
+        f"MRI shows {rng.choice(['mild', 'moderate'])} hippocampal atrophy and {rng.randint(0, 3)} microhemorrhages. "
+        f"Medications: donepezil 10 mg daily, atorvastatin." for i in range(background_paragraphs))
+    transcription = " ".join(
+        f"Doctor: How has the memory been? Daughter: She repeats questions, misplaced keys {rng.randint(2, 9)} times."
+        for _ in range(60))
+    additional = f"Consider lecanemab eligibility. Request {visit_id}."
+    return background, transcription, additional
+
+
+def encode_multipart(fields, files):
+    """fields: {name: value}; files: {name: (filename, bytes, content_type)}. Returns (body, content_type)."""
+    boundary = uuid.uuid4().hex
+    chunks = []
+    for name, value in fields.items():
+        chunks.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8"))
+    for name, (filename, data, content_type) in files.items():
+        chunks.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                      f'Content-Type: {content_type}\r\n\r\n'.encode("utf-8") + data + b"\r\n")
+    chunks.append(f"--{boundary}--\r\n".encode("utf-8"))
+    return b"".join(chunks), f"multipart/form-data; boundary={boundary}"
+
+
+def available_upload_types():
+    """Upload types the installed text_extractor can handle; others are left out of the payloads."""
+    try:
+        import text_extractor
+    except ImportError:
+        return set()
+    return {ext for ext, fn in (("txt", "extract_text_from_txt"), ("pdf", "extract_text_from_pdf"))
+            if hasattr(text_extractor, fn)}
+
+
+def build_payload(rng, upload_types, deidentify):
+    background, transcription, additional = synthetic_visit(rng)
+    fields = {"background_text": background, "transcription_text": transcription, "additional_text": additional}
+    if deidentify:
+        fields["deidentify"] = "on"
+    files = {}
+    if "txt" in upload_types:
+        files["revised_file"] = ("followup.txt", ("Follow-up note. " + background[:4000]).encode("utf-8"), "text/plain")
+    if "pdf" in upload_types:
+        files["additional_file"] = ("outside_records.pdf", synthetic_pdf(background.split(". ")[:50]), "application/pdf")
+    return encode_multipart(fields, files)
+
+
+def current_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource  # Not Linux: ru_maxrss is the lifetime peak (bytes on macOS, kilobytes elsewhere).
+    except ImportError:
+        return 0  # Windows: RSS is not reported.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def send_request(port, body, content_type, timeout):
+    """One POST /generate_note. Returns (ok, status, latency_seconds)."""
+    started = time.perf_counter()
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        conn.request("POST", "/generate_note", body=body, headers={"Content-Type": content_type})
+        response = conn.getresponse()
+        response.read()
+        return response.status == 200, response.status, time.perf_counter() - started
+    except (OSError, http.client.HTTPException):
+        return False, None, time.perf_counter() - started
+    finally:
+        conn.close()
+
+
+def run_level(port, concurrency, duration, payload_factory, timeout):
+    """Closed-loop load with `concurrency` clients for `duration` seconds. Returns the level's report dict."""
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+    peak_rss = [current_rss_bytes()]
+    monitoring = threading.Event()
+
+    def monitor():
+        while not monitoring.wait(0.1):
+            peak_rss[0] = max(peak_rss[0], current_rss_bytes())
+
+    def client(seed):
+        rng = random.Random(seed)
+        while time.monotonic() < stop_at:
+            body, content_type = payload_factory(rng)
+            ok, status, latency = send_request(port, body, content_type, timeout)
+            with lock:
+                latencies.append((ok, latency))
+                statuses[status] = statuses.get(status, 0) + 1
+
+    monitor_thread = threading.Thread(target=monitor, daemon=True)
+    monitor_thread.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(client, [random.random() for _ in range(concurrency)]))
+    elapsed = time.perf_counter() - started
+    monitoring.set()
+    monitor_thread.join()
+
+    ok_latencies = sorted(latency for ok, latency in latencies if ok)
+    errors = sum(1 for ok, _ in latencies if not ok)
+    return {
+        "concurrency": concurrency, "requests": len(latencies), "errors": errors,
+        "error_rate": errors / len(latencies) if latencies else 0.0,
+        "throughput_rps": len(ok_latencies) / elapsed, "p50_s": _percentile(ok_latencies, 0.50),
+        "p95_s": _percentile(ok_latencies, 0.95), "p99_s": _percentile(ok_latencies, 0.99),
+        "peak_rss_mb": peak_rss[0] / 1e6, "statuses": {str(k): v for k, v in statuses.items()},
+    }
+
+
+def _install_fakes(work_dir, model, entrez):
+    """Redirects the stores to work_dir (before their modules are imported) and swaps in the fake clients."""
+    from model_traffic_replay import isolate_stores
+
+    isolate_stores(work_dir)
+    os.environ.setdefault("PREFIX_CACHE_BACKEND", "local")  # The in-process stand-in for Vertex AI context caching.
+    import note_processing_core as core
+
+    core._get_generative_model = lambda *args, **kwargs: model
+    core._get_entrez = lambda: entrez
+    core.initialize_vertex_ai = lambda: None
+    return core
+
+
+def start_app(work_dir, model, entrez, log_requests=False):
+    """Imports APP with stores redirected to work_dir, installs the fakes and serves it on a free port."""
+    _install_fakes(work_dir, model, entrez)
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    import APP
+
+    APP.app.config["UPLOAD_FOLDER"] = os.path.join(work_dir, "uploads")
+    os.makedirs(APP.app.config["UPLOAD_FOLDER"], exist_ok=True)
+    class RequestHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            if log_requests:
+                super().log_request(*args, **kwargs)
+
+    server = make_server("127.0.0.1", 0, APP.app, threaded=True, request_handler=RequestHandler)
+    threading.Thread(target=server.serve_forever, name="load-test-server", daemon=True).start()
+    return server
+
+
+def stress_reentrancy(work_dir, model, entrez, generations, threads):
+    """
+    Runs `generations` notes through core.generate_full_note on `threads` threads at once and checks every note
+    for IDs echoed from other requests' prompts. Returns the report dict; "cross_talk" lists offending runs.
+    """
+    core = _install_fakes(work_dir, model, entrez)
+    from run_store import new_run_id
+
+    def generate(seed):
+        background, transcription, additional = synthetic_visit(random.Random(seed), background_paragraphs=8)
+        own_ids = set(_ECHO_ID_RE.findall(background + additional))
+        run_id = new_run_id()
+        started = time.perf_counter()
+        note = core.generate_full_note(background, additional, transcription, "", run_id=run_id)
+        echoed = set(_ECHOED_ID_RE.findall(note))
+        return {"run_id": run_id, "seconds": time.perf_counter() - started,
+                "failed": note.startswith(("ERROR", "FAILED")), "missing_echo": not echoed,
+                "foreign_ids": sorted(echoed - own_ids)}
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(generate, range(generations)))
+    elapsed = time.perf_counter() - started
+    latencies = sorted(r["seconds"] for r in results)
+    return {
+        "generations": generations, "threads": threads, "seconds": elapsed,
+        "failed": sum(r["failed"] for r in results), "missing_echo": sum(r["missing_echo"] for r in results),
+        "cross_talk": [r for r in results if r["foreign_ids"]],
+        "p50_s": _percentile(latencies, 0.50), "p99_s": _percentile(latencies, 0.99),
+    }
+
+
+def batch_run(work_dir, model, entrez, cases):
+    """
+    Runs `cases` synthetic visits through batch_generation with the local batch backend and checks every note
+    for IDs echoed from other cases' prompts. Returns the report dict.
+    """
+    _install_fakes(work_dir, model, entrez)
+    import batch_generation
+
+    visits = [synthetic_visit(random.Random(seed), background_paragraphs=8) for seed in range(cases)]
+    batch_cases = [{"case_id": seed, "background_info_text": background, "additional_info_text": additional,
+                    "transcription_text": transcription, "revised_info_text": ""}
+                   for seed, (background, transcription, additional) in enumerate(visits)]
+    backend = batch_generation.LocalBatchBackend(os.path.join(work_dir, "batch_jobs"), workers=64)
+    started = time.perf_counter()
+    results, jobs = batch_generation.run_cases(batch_cases, backend)
+    elapsed = time.perf_counter() - started
+    cross_talk = []
+    for (background, _, additional), result in zip(visits, results):
+        own_ids = set(_ECHO_ID_RE.findall(background + additional))
+        foreign_ids = set(_ECHOED_ID_RE.findall(result.get("note", ""))) - own_ids
+        if foreign_ids:
+            cross_talk.append({"run_id": result["run_id"], "foreign_ids": sorted(foreign_ids)})
+    return {
+        "cases": cases, "seconds": elapsed, "failed": sum("error" in result for result in results),
+        "jobs": len(jobs), "model_calls": sum(job["requests"] for job in jobs),
+        "largest_job": max((job["requests"] for job in jobs), default=0), "cross_talk": cross_talk,
+    }
+
+
+def _prefix_cache_summary():
+    from prefix_cache import get_prefix_cache
+    prefix_cache = get_prefix_cache()
+    if prefix_cache is None:
+        return "Prefix cache off: every prompt prefix was sent inline."
+    stats = prefix_cache.stats()
+    return (f"Prefix cache ({stats['backend']}): {stats['hit_rate']:.1%} hit rate over "
+            f"{stats['hits'] + stats['misses'] + stats['inline']} lookups, {stats['misses']} created, "
+            f"{stats['refreshes']} refreshed, {stats['inline']} sent inline; "
+            f"~{stats['cached_tokens_served']} input tokens served from the cache.")
+
+
+def _silence_app_logging():
+    """The pipeline logs every step with print(); at load that output dominates the run. Keep the table only."""
+    import builtins
+    real_print = builtins.print
+    main_thread = threading.main_thread()
+
+    def quiet_print(*args, **kwargs):
+        if threading.current_thread() is main_thread:
+            real_print(*args, **kwargs)
+
+    builtins.print = quiet_print
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stepped-concurrency load test of /generate_note with a fake model.")
+    parser.add_argument("--levels", default="1,2,4,8,16", help="comma-separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds per level")
+    parser.add_argument("--model-latency", type=float, default=1.0, help="mean fake model latency (s)")
+    parser.add_argument("--model-jitter", type=float, default=0.2, help="std dev of fake model latency (s)")
+    parser.add_argument("--model-error-rate", type=float, default=0.0, help="fraction of model calls that fail")
+    parser.add_argument("--entrez-latency", type=float, default=0.3, help="fake PubMed latency per call (s)")
+    parser.add_argument("--deidentify", action="store_true", help="send the de-identify checkbox")
+    parser.add_argument("--timeout", type=float, default=300.0, help="client timeout per request (s)")
+    parser.add_argument("--json", dest="json_path", help="also write the report to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep the app's DEBUG output")
+    parser.add_argument("--stress", type=int, metavar="N",
+                        help="instead of the HTTP levels, run N concurrent in-process generations and check cross-talk")
+    parser.add_argument("--stress-threads", type=int, default=64, help="threads for --stress")
+    parser.add_argument("--batch", type=int, metavar="N",
+                        help="instead of the HTTP levels, generate N notes through batch_generation's local backend")
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix="load_test_")
+    model = FakeGenerativeModel(args.model_latency, args.model_jitter, args.model_error_rate)
+    if args.batch:
+        if not args.verbose:
+            _silence_app_logging()
+        report = batch_run(work_dir, model, FakeEntrez(args.entrez_latency), args.batch)
+        print(f"{report['cases']} notes through batch jobs in {report['seconds']:.1f}s: {report['failed']} failed, "
+              f"{len(report['cross_talk'])} with another case's IDs; {report['model_calls']} model calls in "
+              f"{report['jobs']} jobs (largest {report['largest_job']} requests).")
+        for result in report["cross_talk"][:10]:
+            print(f"ERROR: run {result['run_id']} contains IDs of other cases: {result['foreign_ids']}")
+        if args.json_path:
+            with open(args.json_path, "w", encoding="utf-8") as f:
+                json.dump({"config": vars(args), "batch": report}, f, indent=1)
+        if report["cross_talk"] or report["failed"]:
+            sys.exit(1)
+        return report
+    if args.stress:
+        if not args.verbose:
+            _silence_app_logging()
+        report = stress_reentrancy(work_dir, model, FakeEntrez(args.entrez_latency), args.stress, args.stress_threads)
+        print(f"{report['generations']} generations on {report['threads']} threads in {report['seconds']:.1f}s "
+              f"(p50 {report['p50_s']:.2f}s, p99 {report['p99_s']:.2f}s): {report['failed']} failed, "
+              f"{report['missing_echo']} without echoed IDs, {len(report['cross_talk'])} with another request's IDs.")
+        print(_prefix_cache_summary())
+        for result in report["cross_talk"][:10]:
+            print(f"ERROR: run {result['run_id']} contains IDs of other requests: {result['foreign_ids']}")
+        if args.json_path:
+            with open(args.json_path, "w", encoding="utf-8") as f:
+                json.dump({"config": vars(args), "stress": report}, f, indent=1)
+        if report["cross_talk"] or report["failed"] or report["missing_echo"]:
+            sys.exit(1)
+        return report
+    server = start_app(work_dir, model, FakeEntrez(args.entrez_latency), log_requests=args.verbose)
+    if not args.verbose:
+        _silence_app_logging()
+    upload_types = available_upload_types()
+    missing = {"txt", "pdf"} - upload_types
+    if missing:
+        print(f"WARNING: text_extractor cannot extract {sorted(missing)}; those uploads are left out of the payloads.")
+
+    print(f"Serving APP on port {server.server_port}; fake model {args.model_latency}s +/- {args.model_jitter}s, "
+          f"error rate {args.model_error_rate:.1%}; {args.duration:.0f}s per level; work dir {work_dir}")
+    print(f"{'conc':>5} {'reqs':>6} {'err%':>6} {'req/s':>7} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} {'peak RSS MB':>12}")
+    reports = []
+    for level in [int(x) for x in args.levels.split(",") if x.strip()]:
+        report = run_level(server.server_port, level, args.duration,
+                           lambda rng: build_payload(rng, upload_types, args.deidentify), args.timeout)
+        reports.append(report)
+        print(f"{level:>5} {report['requests']:>6} {report['error_rate']:>6.1%} {report['throughput_rps']:>7.2f} "
+              f"{report['p50_s']:>7.2f} {report['p95_s']:>7.2f} {report['p99_s']:>7.2f} {report['peak_rss_mb']:>12.1f}")
+    server.shutdown()
+    print(_prefix_cache_summary())
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "levels": reports}, f, indent=1)
+    return reports
+
+
+if __name__ == '__main__':
+    main()
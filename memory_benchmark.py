@@ -0,0 +1,116 @@
+# memory_benchmark.py
+# Peak-memory guard for one note-generation request, measured with tracemalloc.
+# Run from the project directory:  python memory_benchmark.py
+# A reference request (REFERENCE_SIZES: a large background, a long transcription) goes through
+# APP.process_sections and core.generate_full_note with the load_test fake model and PubMed clients (no
+# network, no latency), once alone and REFERENCE_CONCURRENCY times at once. Exits non-zero if a peak goes
+# over its budget, so it can be used as a check in CI alongside startup_benchmark.py.
+import contextlib
+import os
+import random
+import sys
+import tempfile
+import threading
+import tracemalloc
+
+# Peak traced allocations in MB (override with MEMORY_BUDGET_<CASE>_MB).
+MEMORY_BUDGETS_MB = {
+    "single": 16,
+    "concurrent": 32,
+}
+REFERENCE_CONCURRENCY = 4
+
+# Characters per section of the reference request.
+REFERENCE_SIZES = {
+    "background": 600_000,
+    "transcription": 120_000,
+    "additional": 4_000,
+    "revised": 2_000,
+}
+
+
+def reference_sections(seed=0):
+    """
+    Deterministic section texts of REFERENCE_SIZES, shaped like clinic notes (paragraphs, scores, meds). The
+    background starts with a "Patient:" header and the transcription names the patient, so the identifier
+    redaction runs as it does on real records.
+    """
+    rng = random.Random(seed)
+    sections = {}
+    for name, size in REFERENCE_SIZES.items():
+        paragraphs = []
+        total = 0
+        if name == "background":
+            paragraphs.append(f"Patient: Jane Doe{seed}\nMRN: {4482210 + seed}")
+        while total < size:
+            paragraph = (f"{name.title()} note {len(paragraphs)} for Jane Doe{seed}: "
+                         f"{rng.randint(58, 88)}-year-old with memory loss "
+                         f"over {rng.randint(1, 6)} years. MMSE {rng.randint(14, 29)}/30. Medications: donepezil "
+                         f"{rng.choice([5, 10])} mg daily. MRI: {rng.choice(['mild', 'moderate'])} atrophy. " * 4)
+            paragraphs.append(paragraph.strip())
+            total += len(paragraph) + 2
+        sections[name] = "\n\n".join(paragraphs)[:size]
+    return sections
+
+
+def _install(work_dir):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import load_test
+    core = load_test._install_fakes(work_dir, load_test.FakeGenerativeModel(0.0, 0.0, 0.0), load_test.FakeEntrez(0.0))
+    load_test._silence_app_logging()
+    import APP
+    return core, APP
+
+
+def _one_request(core, APP, sections, seed):
+    form = {f"{name}_text": text for name, text in sections.items()}
+    form["deidentify"] = "on"
+    # Sent as multipart/form-data, as the browser form does.
+    with APP.app.test_request_context("/generate_note", method="POST", data=form, content_type="multipart/form-data"):
+        from flask import request
+        processed, _ = APP.process_sections(request.form, request.files, True)
+    return core.generate_full_note(processed["background"], processed["additional"], processed["transcription"],
+                                   processed["revised"], run_id=f"memory-benchmark-{seed}")
+
+
+def measure_peak(case, core, APP):
+    """Peak traced MB above the baseline for `case` ("single" or "concurrent")."""
+    count = 1 if case == "single" else REFERENCE_CONCURRENCY
+    inputs = [reference_sections(seed) for seed in range(count)]
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    threads = [threading.Thread(target=_one_request, args=(core, APP, inputs[i], f"{case}-{i}")) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    input_mb = sum(len(text) for sections in inputs for text in sections.values()) / 1e6
+    return (peak - baseline) / 1e6, input_mb
+
+
+def check_memory_budget(budgets=None):
+    """Returns a list of human-readable failures (empty when every case is within budget)."""
+    budgets = budgets or MEMORY_BUDGETS_MB
+    work_dir = tempfile.mkdtemp(prefix="memory-benchmark-")
+    core, APP = _install(work_dir)
+    failures = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):  # The pipeline's DEBUG output.
+        _one_request(core, APP, reference_sections(99), "warmup")  # Imports, caches and lazy state are not counted.
+        peaks = {case: measure_peak(case, core, APP) for case in budgets}
+    for case, default_budget_mb in budgets.items():
+        budget_mb = float(os.getenv(f"MEMORY_BUDGET_{case.upper()}_MB", default_budget_mb))
+        peak_mb, input_mb = peaks[case]
+        print(f"{case}: peak {peak_mb:.1f} MB for {input_mb:.2f} MB of input text (budget {budget_mb:.0f} MB)")
+        if peak_mb > budget_mb:
+            failures.append(f"{case} peak was {peak_mb:.1f} MB, budget is {budget_mb:.0f} MB")
+    return failures
+
+
+if __name__ == '__main__':
+    memory_failures = check_memory_budget()
+    for failure in memory_failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if memory_failures else 0)
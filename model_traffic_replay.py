@@ -0,0 +1,345 @@
+# model_traffic_replay.py
+# Record-and-replay of the pipeline's model (generate_content) and PubMed (Entrez) traffic, so a change to the
+# prompts, scheduling or assembly in note_processing_core can be benchmarked and its output diffed offline,
+# deterministically, without live Vertex AI or PubMed calls.
+#
+# Recording: every call made through a PipelineContext with a TrafficRecorder is appended to a JSONL replay log
+# (traffic-*.jsonl in the log directory) with its request, its response (or error) and how long it took. Model
+# requests are logged as the stage payload plus the name and hash of the static prefix it was sent with, so a
+# recording made with provider-side prefix caching replays without it. The web app records the runs of
+# de-identified requests when MODEL_TRAFFIC_RECORD_DIR is set; requests without de-identification are never
+# recorded. The CLI records a corpus of cases directly (they should already be de-identified).
+#
+# Replay: a TrafficReplayer answers each call with the recorded response after the recorded latency (scaled by
+# --latency-scale). Identical requests are answered in recorded order. A request that was never recorded, e.g.
+# from a changed prompt, fails like a model error (--on-miss error) or goes to the live model (--on-miss live);
+# misses are counted per run. Record and replay both start from empty stores and caches in a temporary directory,
+# so a digest or literature cache hit never hides a call.
+#
+#     python model_traffic_replay.py record CASES.jsonl LOG_DIR [--out NOTES.jsonl]
+#     python model_traffic_replay.py replay CASES.jsonl LOG_DIR [--out NOTES.jsonl] [--latency-scale 1.0]
+#                                          [--on-miss error|live] [--workers N]
+#     python model_traffic_replay.py diff BASE_NOTES.jsonl NEW_NOTES.jsonl
+#
+# CASES.jsonl uses the batch_generation.py case format. NOTES.jsonl has one line per case with its note, end-to-end
+# seconds and metrics; `diff` compares two of them (e.g. replays before and after a change): latency per case and
+# in total, and a unified diff of every note that changed.
+import argparse
+import base64
+import difflib
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+MODEL_TRAFFIC_RECORD_DIR = os.getenv("MODEL_TRAFFIC_RECORD_DIR", "")
+
+# The stores and caches a run reads or writes; record and replay point them at a fresh directory.
+STORE_ENVIRONMENT = (
+    ("RUN_STORE_PATH", "runs.sqlite3"), ("BACKGROUND_DIGEST_CACHE_DIR", "digest_cache"),
+    ("LITERATURE_DIGEST_DIR", "literature"), ("UPLOAD_SESSION_DIR", "upload_sessions"), ("PROFILE_DIR", "profiles"),
+    ("PATIENT_FACT_STORE_PATH", "patient_facts.sqlite3"), ("NOTE_ARCHIVE_DIR", "note_archive"),
+)
+
+# What a replayed model call returns to the stage code, which only reads `.text`.
+ReplayedResponse = namedtuple("ReplayedResponse", ["text"])
+
+_recorder_lock = threading.Lock()
+_recorder = None
+
+
+class ReplayMiss(Exception):
+    """A request the replay log has no recording of."""
+
+
+class RecordedCallError(Exception):
+    """Replays a call that failed when it was recorded."""
+
+
+def isolate_stores(work_dir):
+    """Points every store and cache at work_dir (before note_processing_core and its stores are imported)."""
+    for name, sub in STORE_ENVIRONMENT:
+        os.environ.setdefault(name, os.path.join(work_dir, sub))
+
+
+def _hash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _model_request(model_name, prefix, payload):
+    return {"model": model_name, "prefix": prefix.name if prefix is not None else None,
+            "prefix_sha256": hashlib.sha256(prefix.text.encode("utf-8")).hexdigest() if prefix is not None else None,
+            "parts": [part for part in payload if isinstance(part, str)]}
+
+
+def _entrez_request(function_name, params):
+    # The contact email identifies the deployment, not the request.
+    return {"function": function_name, "params": {k: v for k, v in params.items() if k != "email"}}
+
+
+def _encode_entrez_data(data):
+    if isinstance(data, bytes):
+        return {"base64": base64.b64encode(data).decode("ascii")}
+    if isinstance(data, str):
+        return {"text": data}
+    return {"json": data}  # Already-parsed results (load_test.FakeEntrez).
+
+
+def _entrez_handle(encoded):
+    """A handle Entrez.read and handle.read accept, over recorded data."""
+    if "base64" in encoded:
+        return io.BytesIO(base64.b64decode(encoded["base64"]))
+    if "text" in encoded:
+        return io.StringIO(encoded["text"])
+    return _ObjectHandle(encoded["json"])
+
+
+class _ObjectHandle:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, *args):
+        return self.data
+
+    def close(self):
+        pass
+
+
+class TrafficRecorder:
+    """Appends every model and PubMed call to log_dir/traffic-<pid>-<start time>.jsonl. Thread-safe."""
+
+    def __init__(self, log_dir):
+        os.makedirs(log_dir, exist_ok=True)
+        self.path = os.path.join(log_dir, f"traffic-{os.getpid()}-{int(time.time())}.jsonl")
+        self._lock = threading.Lock()
+        self._file = open(self.path, "a", encoding="utf-8")
+        self.entries = 0
+
+    def _append(self, entry):
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self.entries += 1
+
+    def model_call(self, ctx, model_name, prefix, payload, send):
+        request = _model_request(model_name, prefix, payload)
+        entry = {"kind": "model", "key": _hash(request), "run_id": ctx.run_id, "request": request}
+        started = time.perf_counter()
+        try:
+            response = send()
+            entry["response"] = {"text": response.text}
+            return response
+        except Exception as e:
+            entry["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            entry["seconds"] = time.perf_counter() - started
+            self._append(entry)
+
+    def entrez_call(self, ctx, function_name, params, send):
+        request = _entrez_request(function_name, params)
+        entry = {"kind": "entrez", "key": _hash(request), "run_id": ctx.run_id, "request": request}
+        started = time.perf_counter()
+        try:
+            handle = send()
+            data = handle.read()  # Read now, so the log holds the whole response and its latency.
+            handle.close()
+            entry["response"] = _encode_entrez_data(data)
+            return _entrez_handle(entry["response"])
+        except Exception as e:
+            entry["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            entry["seconds"] = time.perf_counter() - started
+            self._append(entry)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class TrafficReplayer:
+    """
+    Serves calls from the traffic-*.jsonl logs in log_dir after their recorded latency times latency_scale.
+    on_miss: "error" raises ReplayMiss for an unrecorded request; "live" sends it (and counts the miss).
+    """
+
+    def __init__(self, log_dir, latency_scale=1.0, on_miss="error"):
+        self.latency_scale = latency_scale
+        self.on_miss = on_miss
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> [entry] in recorded order
+        self._served = {}  # key -> number of times served
+        self.stats = {"served": 0, "misses": 0}
+        for name in sorted(os.listdir(log_dir)):
+            if name.startswith("traffic-") and name.endswith(".jsonl"):
+                with open(os.path.join(log_dir, name), "r", encoding="utf-8") as f:
+                    for line in f:
+                        if line.strip():
+                            entry = json.loads(line)
+                            self._entries.setdefault(entry["key"], []).append(entry)
+        if not self._entries:
+            print(f"WARNING: No recorded traffic in {log_dir}; every call will be a replay miss.")
+
+    def _next_entry(self, key):
+        """The next recording of `key` (the last one again once all have been served), or None."""
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                self.stats["misses"] += 1
+                return None
+            served = self._served.get(key, 0)
+            self._served[key] = served + 1
+            self.stats["served"] += 1
+            return entries[min(served, len(entries) - 1)]
+
+    def _replay(self, ctx, kind, request, send):
+        entry = self._next_entry(_hash(request))
+        if entry is None:
+            ctx.count("replay_misses")
+            if self.on_miss == "live":
+                return None, send()
+            raise ReplayMiss(f"No recorded {kind} response for this request "
+                             f"({request.get('prefix') or request.get('function') or 'no prefix'}).")
+        time.sleep(entry["seconds"] * self.latency_scale)
+        if "error" in entry:
+            raise RecordedCallError(entry["error"])
+        return entry, None
+
+    def model_call(self, ctx, model_name, prefix, payload, send):
+        entry, live_response = self._replay(ctx, "model", _model_request(model_name, prefix, payload), send)
+        return live_response if entry is None else ReplayedResponse(entry["response"]["text"])
+
+    def entrez_call(self, ctx, function_name, params, send):
+        entry, live_handle = self._replay(ctx, "PubMed", _entrez_request(function_name, params), send)
+        return live_handle if entry is None else _entrez_handle(entry["response"])
+
+
+def get_traffic_recorder():
+    """The process-wide recorder writing to MODEL_TRAFFIC_RECORD_DIR, or None when recording is off."""
+    global _recorder
+    log_dir = os.getenv("MODEL_TRAFFIC_RECORD_DIR", MODEL_TRAFFIC_RECORD_DIR)
+    if not log_dir:
+        return None
+    with _recorder_lock:
+        if _recorder is None:
+            _recorder = TrafficRecorder(log_dir)
+            print(f"DEBUG: Recording model and PubMed traffic to {_recorder.path}.")
+        return _recorder
+
+
+def _read_jsonl(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def run_cases(cases, traffic, workers=1):
+    """
+    Runs generate_full_note for each case with `traffic` (a recorder or replayer) on its context.
+    Returns one result dict per case, in case order.
+    """
+    import note_processing_core as core
+    from batch_generation import CASE_TEXT_FIELDS
+    from run_store import new_run_id
+
+    replaying = isinstance(traffic, TrafficReplayer)
+
+    def inline_prefix_model(model_name, cached_content=None):
+        return core._get_generative_model(model_name)
+
+    def run(index):
+        case = cases[index]
+        run_id = case.get("run_id") or new_run_id()
+        # A replay never uses the provider's prefix cache: prefixes are sent inline, as the log records them.
+        ctx = core.new_pipeline_context(run_id=run_id, deadline_seconds=0,
+                                        model_factory=inline_prefix_model if replaying else None, traffic=traffic)
+        started = time.perf_counter()
+        note = core.generate_full_note(*(case.get(field) or "" for field in CASE_TEXT_FIELDS), run_id=run_id,
+                                       context=ctx, patient_id=case.get("patient_id"))
+        return {"case_id": case.get("case_id", index), "run_id": run_id, "seconds": time.perf_counter() - started,
+                "note": note, "metrics": dict(ctx.metrics)}
+
+    if replaying and traffic.on_miss == "error":
+        core.initialize_vertex_ai = lambda: None  # Every call is served from the log.
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(run, range(len(cases))))
+
+
+def diff_notes(base_results, new_results, context_lines=2):
+    """Returns report lines: per-case latency change and note diff, then totals."""
+    new_by_case = {str(result["case_id"]): result for result in new_results}
+    lines = []
+    changed = 0
+    base_total = new_total = 0.0
+    for base in base_results:
+        new = new_by_case.get(str(base["case_id"]))
+        if new is None:
+            lines.append(f"case {base['case_id']}: missing from the new results")
+            continue
+        base_total += base["seconds"]
+        new_total += new["seconds"]
+        same = base["note"] == new["note"]
+        changed += not same
+        lines.append(f"case {base['case_id']}: {base['seconds']:.2f}s -> {new['seconds']:.2f}s "
+                     f"({new['seconds'] - base['seconds']:+.2f}s), note {'unchanged' if same else 'CHANGED'}")
+        if not same:
+            lines.extend("    " + line.rstrip("\n") for line in difflib.unified_diff(
+                base["note"].splitlines(), new["note"].splitlines(), "base", "new", n=context_lines, lineterm=""))
+    if base_total:
+        lines.append(f"total: {base_total:.2f}s -> {new_total:.2f}s ({(new_total / base_total - 1):+.1%}); "
+                     f"{changed} of {len(base_results)} notes changed")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Record, replay and diff the pipeline's model and PubMed traffic.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name in ("record", "replay"):
+        command = commands.add_parser(name)
+        command.add_argument("cases", help="JSONL file with one case per line (batch_generation.py format)")
+        command.add_argument("log_dir", help="directory of the replay log")
+        command.add_argument("--out", help="notes JSONL (default: LOG_DIR/<command>-notes.jsonl)")
+        command.add_argument("--workers", type=int, default=1, help="cases run concurrently")
+    replay = commands.choices["replay"]
+    replay.add_argument("--latency-scale", type=float, default=1.0, help="multiplier for the recorded latencies")
+    replay.add_argument("--on-miss", choices=("error", "live"), default="error")
+    diff = commands.add_parser("diff")
+    diff.add_argument("base")
+    diff.add_argument("new")
+    args = parser.parse_args(argv)
+
+    if args.command == "diff":
+        for line in diff_notes(_read_jsonl(args.base), _read_jsonl(args.new)):
+            print(line)
+        return 0
+
+    isolate_stores(tempfile.mkdtemp(prefix=f"traffic_{args.command}_"))
+    cases = _read_jsonl(args.cases)
+    if args.command == "record":
+        traffic = TrafficRecorder(args.log_dir)
+    else:
+        traffic = TrafficReplayer(args.log_dir, latency_scale=args.latency_scale, on_miss=args.on_miss)
+    started = time.perf_counter()
+    results = run_cases(cases, traffic, workers=args.workers)
+    out_path = args.out or os.path.join(args.log_dir, f"{args.command}-notes.jsonl")
+    with open(out_path, "w", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+    summary = f"{len(results)} cases in {time.perf_counter() - started:.1f}s; notes written to {out_path}"
+    if args.command == "record":
+        traffic.close()
+        print(f"{summary}; {traffic.entries} calls recorded to {traffic.path}")
+    else:
+        print(f"{summary}; {traffic.stats['served']} calls replayed, {traffic.stats['misses']} misses")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,379 @@
+# note_archive.py
+# Append-only archive of generated notes: the final note and every stage output of a completed
+# generate_full_note run, so earlier notes can be looked up and compared without re-running the pipeline.
+#
+# Records are zlib-compressed JSON appended to segment files (segment-000001.dat, ...; a new segment is started
+# once the active one reaches NOTE_ARCHIVE_SEGMENT_BYTES). A SQLite index next to them holds, per run ID, the
+# segment and byte offset of its latest record, so a lookup is one indexed row plus one seek and read. The same
+# database holds an inverted index of tokens per search field, so searches such as diagnosis "FTLD-tau" in the
+# last 30 days never scan the segments:
+#   - diagnosis: the primary diagnosis (or, without one, the first-ranked entry of the "Most Likely Diagnosis"
+#     line), matched as a phrase, so a diagnosis that is only further down the differential does not match;
+#   - differential: every token of the whole "Most Likely Diagnosis" line;
+#   - heading: the section headings of the note.
+#
+# Notes older than NOTE_ARCHIVE_RETENTION_DAYS (0 = keep forever) are dropped from the index; compaction
+# rewrites sealed segments that are mostly dead records (expired, or superseded by a resumed run) and deletes
+# the old files. Both run at most once per NOTE_ARCHIVE_MAINTENANCE_SECONDS after an append, or from the CLI:
+#
+#     python note_archive.py get RUN_ID
+#     python note_archive.py search TERMS [--field diagnosis|differential|heading] [--since-days N] [--limit N]
+#     python note_archive.py purge | compact | rebuild-index | stats
+#
+# One process writes the archive (appends are serialized by a lock in this module); any number may read it.
+import json
+import os
+import re
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from sqlite_store import SQLiteStore
+
+NOTE_ARCHIVE_DIR = os.getenv("NOTE_ARCHIVE_DIR", os.path.join("data", "note_archive"))
+NOTE_ARCHIVE_SEGMENT_BYTES = int(os.getenv("NOTE_ARCHIVE_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+NOTE_ARCHIVE_RETENTION_DAYS = float(os.getenv("NOTE_ARCHIVE_RETENTION_DAYS", "0"))  # 0 = keep forever.
+NOTE_ARCHIVE_COMPACT_MAX_LIVE_RATIO = float(os.getenv("NOTE_ARCHIVE_COMPACT_MAX_LIVE_RATIO", "0.5"))
+NOTE_ARCHIVE_MAINTENANCE_SECONDS = int(os.getenv("NOTE_ARCHIVE_MAINTENANCE_SECONDS", "3600"))
+
+SEARCH_FIELDS = ("diagnosis", "differential", "heading")
+
+# Record framing: magic, payload length, CRC-32 of the payload; the payload is zlib-compressed JSON.
+_RECORD_HEADER = struct.Struct(">4sII")
+_RECORD_MAGIC = b"NOTE"
+_SEGMENT_RE = re.compile(r"^segment-(\d{6})\.dat$")
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_HEADING_RE = re.compile(r"^[ \t]*(?:#{1,6}[ \t]+(.+?)[ \t#]*$|\*\*([^*\n]{2,80}?):?\*\*:?)", re.MULTILINE)
+_MOST_LIKELY_RE = re.compile(r"most likely diagnosis:?\**:?[ \t]*\**[ \t]*(.*)", re.IGNORECASE)
+_RANK_MARKER_RE = re.compile(r"(?:^|[\s,;])\(?\d{1,2}\s*[-.)]\s+")  # "1- FTLD-tau, 2- AD", "1) ... 2) ..."
+
+_append_lock = threading.Lock()
+_last_maintenance = {"at": 0.0}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS notes (
+    run_id TEXT PRIMARY KEY,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    patient_id TEXT,
+    primary_diagnosis TEXT,
+    most_likely TEXT,
+    diagnosis_terms TEXT NOT NULL  -- Tokens of the indexed diagnosis, space-joined, for phrase matching.
+);
+CREATE TABLE IF NOT EXISTS postings (
+    field TEXT NOT NULL,
+    token TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    run_id TEXT NOT NULL REFERENCES notes(run_id) ON DELETE CASCADE,
+    PRIMARY KEY (field, token, created_at, run_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS notes_created_at ON notes(created_at);
+CREATE INDEX IF NOT EXISTS notes_segment ON notes(segment);
+CREATE INDEX IF NOT EXISTS postings_run_id ON postings(run_id);
+"""
+_store = SQLiteStore(_SCHEMA)
+
+
+def tokenize(text):
+    """Lowercased alphanumeric tokens: "FTLD-tau" -> ["ftld", "tau"]. Queries are tokenized the same way."""
+    return _TOKEN_RE.findall((text or "").lower())
+
+
+def most_likely_diagnosis_line(assessment_text):
+    """The text after the "Most Likely Diagnosis:" label of an assessment (first line only), or ""."""
+    match = _MOST_LIKELY_RE.search(assessment_text or "")
+    return match.group(1).strip(" *") if match else ""
+
+
+def first_ranked_diagnosis(most_likely_line):
+    """The first entry of a ranked "Most Likely Diagnosis" line ("1- FTLD-tau, 2- AD" -> "FTLD-tau")."""
+    entries = [entry.strip(" ,;.") for entry in _RANK_MARKER_RE.split(most_likely_line or "")]
+    return next((entry for entry in entries if entry), "")
+
+
+def _indexed_diagnosis(record):
+    return record.get("primary_diagnosis") or first_ranked_diagnosis(record.get("most_likely"))
+
+
+def note_headings(note_text):
+    return [(markdown or bold).strip() for markdown, bold in _HEADING_RE.findall(note_text or "")]
+
+
+def _index_path():
+    return os.path.join(NOTE_ARCHIVE_DIR, "index.sqlite3")
+
+
+def _segment_path(number):
+    return os.path.join(NOTE_ARCHIVE_DIR, f"segment-{number:06d}.dat")
+
+
+def _segment_numbers():
+    try:
+        names = os.listdir(NOTE_ARCHIVE_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted(int(match.group(1)) for match in map(_SEGMENT_RE.match, names) if match)
+
+
+def _transaction():
+    return _store.transaction(_index_path())
+
+
+def _encode_record(record):
+    payload = zlib.compress(json.dumps(record, ensure_ascii=False).encode("utf-8"), 6)
+    return _RECORD_HEADER.pack(_RECORD_MAGIC, len(payload), zlib.crc32(payload)) + payload
+
+
+def _decode_record(data):
+    magic, length, crc = _RECORD_HEADER.unpack_from(data)
+    payload = data[_RECORD_HEADER.size:_RECORD_HEADER.size + length]
+    if magic != _RECORD_MAGIC or len(payload) != length or zlib.crc32(payload) != crc:
+        raise ValueError("corrupt note archive record")
+    return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+
+def _append(data):
+    """Appends one encoded record to the active segment. Returns (segment, offset). Caller holds _append_lock."""
+    os.makedirs(NOTE_ARCHIVE_DIR, exist_ok=True)
+    numbers = _segment_numbers()
+    number = numbers[-1] if numbers else 1
+    path = _segment_path(number)
+    if os.path.exists(path) and os.path.getsize(path) + len(data) > NOTE_ARCHIVE_SEGMENT_BYTES:
+        number += 1
+        path = _segment_path(number)
+    with open(path, "ab") as f:
+        offset = f.tell()
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return number, offset
+
+
+def _postings(record):
+    tokens = {("diagnosis", token) for token in tokenize(_indexed_diagnosis(record))}
+    tokens |= {("differential", token) for token in tokenize(record.get("most_likely"))}
+    tokens |= {("heading", token) for heading in record.get("headings", []) for token in tokenize(heading)}
+    return tokens
+
+
+def _index_record(conn, record, segment, offset, length):
+    conn.execute("DELETE FROM postings WHERE run_id = ?", (record["run_id"],))
+    conn.execute("INSERT OR REPLACE INTO notes (run_id, segment, offset, length, created_at, patient_id, "
+                 "primary_diagnosis, most_likely, diagnosis_terms) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                 (record["run_id"], segment, offset, length, record["created_at"], record.get("patient_id"),
+                  record.get("primary_diagnosis"), record.get("most_likely"),
+                  " ".join(tokenize(_indexed_diagnosis(record)))))
+    conn.executemany("INSERT OR IGNORE INTO postings (field, token, created_at, run_id) VALUES (?, ?, ?, ?)",
+                     [(field, token, record["created_at"], record["run_id"]) for field, token in _postings(record)])
+
+
+def archive_note(run_id, final_note, stage_outputs, primary_diagnosis=None, patient_id=None):
+    """
+    Appends a completed run's note and stage outputs ({stage: output}) and indexes it. Archiving a run ID
+    again (a resumed run) supersedes the earlier record. Returns the record's size in bytes.
+    """
+    record = {
+        "run_id": run_id,
+        "created_at": time.time(),
+        "patient_id": patient_id,
+        "primary_diagnosis": primary_diagnosis,
+        "most_likely": most_likely_diagnosis_line(stage_outputs.get("diagnostic_assessment")),
+        "headings": note_headings(final_note),
+        "final_note": final_note,
+        "stages": stage_outputs,
+    }
+    data = _encode_record(record)
+    with _append_lock:
+        segment, offset = _append(data)
+        with _transaction() as conn:
+            _index_record(conn, record, segment, offset, len(data))
+    maybe_run_maintenance()
+    return len(data)
+
+
+def _read_at(segment, offset, length):
+    with open(_segment_path(segment), "rb") as f:
+        f.seek(offset)
+        return _decode_record(f.read(length))
+
+
+def get_note(run_id):
+    """The archived record of a run ({"run_id", "created_at", "final_note", "stages", ...}) or None."""
+    with _transaction() as conn:
+        row = conn.execute("SELECT segment, offset, length FROM notes WHERE run_id = ?", (run_id,)).fetchone()
+    return _read_at(*row) if row else None
+
+
+def search_notes(query, field="diagnosis", since=None, until=None, limit=50):
+    """
+    Notes whose `field` (one of SEARCH_FIELDS) contains every token of `query` (for "diagnosis", as a phrase),
+    newest first, created between the `since` and `until` Unix timestamps. Returns index metadata only;
+    get_note() loads a note.
+    """
+    if field not in SEARCH_FIELDS:
+        raise ValueError(f"Unknown search field '{field}' (expected one of {', '.join(SEARCH_FIELDS)}).")
+    query_tokens = tokenize(query)
+    tokens = sorted(set(query_tokens))
+    if not tokens:
+        return []
+    placeholders = ", ".join("?" for _ in tokens)
+    phrase_filter, phrase_params = "", []
+    if field == "diagnosis":  # Tokens are [a-z0-9] only, so the phrase needs no LIKE escaping.
+        phrase_filter, phrase_params = "AND ' ' || n.diagnosis_terms || ' ' LIKE ? ", [f"% {' '.join(query_tokens)} %"]
+    with _transaction() as conn:
+        rows = conn.execute(
+            f"SELECT n.run_id, n.created_at, n.patient_id, n.primary_diagnosis, n.most_likely "
+            f"FROM postings p JOIN notes n ON n.run_id = p.run_id "
+            f"WHERE p.field = ? AND p.token IN ({placeholders}) AND p.created_at >= ? AND p.created_at <= ? "
+            f"{phrase_filter}GROUP BY p.run_id HAVING COUNT(*) = ? ORDER BY n.created_at DESC LIMIT ?",
+            [field, *tokens, since or 0, until or float("inf"), *phrase_params, len(tokens), limit]).fetchall()
+    return [{"run_id": run_id, "created_at": created_at, "patient_id": patient_id,
+             "primary_diagnosis": primary_diagnosis, "most_likely": most_likely}
+            for run_id, created_at, patient_id, primary_diagnosis, most_likely in rows]
+
+
+def purge_expired_notes(retention_days=NOTE_ARCHIVE_RETENTION_DAYS):
+    """Drops notes older than the retention period from the index (compaction reclaims their bytes)."""
+    if not retention_days:
+        return 0
+    cutoff = time.time() - retention_days * 86400
+    with _transaction() as conn:
+        deleted = conn.execute("DELETE FROM notes WHERE created_at < ?", (cutoff,)).rowcount
+    if deleted:
+        print(f"DEBUG: Purged {deleted} expired notes from the note archive index.")
+    return deleted
+
+
+def compact(max_live_ratio=NOTE_ARCHIVE_COMPACT_MAX_LIVE_RATIO):
+    """
+    Rewrites the live records of each sealed segment whose live bytes are at most `max_live_ratio` of its size
+    into the active segment, repoints the index and deletes the old file. Returns the bytes reclaimed.
+    """
+    reclaimed = 0
+    with _append_lock:
+        numbers = _segment_numbers()
+        for number in numbers[:-1]:  # The active (last) segment is never compacted.
+            path = _segment_path(number)
+            size = os.path.getsize(path)
+            with _transaction() as conn:
+                rows = conn.execute("SELECT run_id, offset, length FROM notes WHERE segment = ? ORDER BY offset",
+                                    (number,)).fetchall()
+            live = sum(length for _, _, length in rows)
+            if size and live / size > max_live_ratio:
+                continue
+            with open(path, "rb") as f:
+                moved = []
+                for run_id, offset, length in rows:
+                    f.seek(offset)
+                    data = f.read(length)
+                    _decode_record(data)  # Never copy a corrupt record forward.
+                    moved.append((run_id, data))
+            new_locations = [(run_id, *_append(data)) for run_id, data in moved]
+            with _transaction() as conn:
+                conn.executemany("UPDATE notes SET segment = ?, offset = ? WHERE run_id = ? AND segment = ?",
+                                 [(segment, offset, run_id, number) for run_id, segment, offset in new_locations])
+            os.remove(path)
+            reclaimed += size - live
+            print(f"DEBUG: Compacted note archive segment {number}: moved {len(moved)} notes, "
+                  f"reclaimed {size - live} bytes.")
+    return reclaimed
+
+
+def maybe_run_maintenance():
+    """Retention purge and compaction, at most once per NOTE_ARCHIVE_MAINTENANCE_SECONDS, piggybacking on appends."""
+    now = time.monotonic()
+    if _last_maintenance["at"] and now - _last_maintenance["at"] < NOTE_ARCHIVE_MAINTENANCE_SECONDS:
+        return
+    _last_maintenance["at"] = now
+    try:
+        purge_expired_notes()
+        compact()
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print(f"WARNING: Note archive maintenance failed: {e}")
+
+
+def _scan_segment(number):
+    """Yields (offset, length, record) for every readable record of a segment, stopping at a torn tail."""
+    with open(_segment_path(number), "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset + _RECORD_HEADER.size <= len(data):
+        _, payload_length, _ = _RECORD_HEADER.unpack_from(data, offset)
+        length = _RECORD_HEADER.size + payload_length
+        try:
+            record = _decode_record(data[offset:offset + length])
+        except (ValueError, zlib.error, struct.error):
+            print(f"WARNING: Note archive segment {number} is unreadable from offset {offset}; skipping the rest.")
+            return
+        yield offset, length, record
+        offset += length
+
+
+def rebuild_index():
+    """Recreates the index from the segments (the latest record of each run wins). Returns the notes indexed."""
+    cutoff = time.time() - NOTE_ARCHIVE_RETENTION_DAYS * 86400 if NOTE_ARCHIVE_RETENTION_DAYS else 0
+    with _append_lock:
+        latest = {}
+        for number in _segment_numbers():
+            for offset, length, record in _scan_segment(number):
+                latest[record["run_id"]] = (record, number, offset, length)
+        with _transaction() as conn:
+            conn.execute("DELETE FROM notes")
+            for record, number, offset, length in latest.values():
+                if record["created_at"] >= cutoff:
+                    _index_record(conn, record, number, offset, length)
+    return sum(1 for record, *_ in latest.values() if record["created_at"] >= cutoff)
+
+
+def archive_stats():
+    numbers = _segment_numbers()
+    with _transaction() as conn:
+        notes, live_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM notes").fetchone()
+        postings = conn.execute("SELECT COUNT(*) FROM postings").fetchone()[0]
+    return {"notes": notes, "segments": len(numbers), "postings": postings, "live_bytes": live_bytes,
+            "segment_bytes": sum(os.path.getsize(_segment_path(number)) for number in numbers)}
+
+
+def _option(args, name, default=None):
+    if name in args:
+        i = args.index(name)
+        value = args[i + 1]
+        del args[i:i + 2]
+        return value
+    return default
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    command = args.pop(0) if args else None
+    if command == "get" and args:
+        note = get_note(args[0])
+        print(json.dumps(note, indent=2, ensure_ascii=False) if note else f"Run {args[0]} is not archived.")
+    elif command == "search" and args:
+        field = _option(args, "--field", "diagnosis")
+        since_days = _option(args, "--since-days")
+        limit = int(_option(args, "--limit", "50"))
+        started = time.perf_counter()
+        results = search_notes(" ".join(args), field=field, limit=limit,
+                               since=time.time() - float(since_days) * 86400 if since_days else None)
+        for result in results:
+            print(f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(result['created_at']))}  {result['run_id']}  "
+                  f"{result['primary_diagnosis'] or '-'}  |  {result['most_likely'] or '-'}")
+        print(f"{len(results)} notes in {(time.perf_counter() - started) * 1000:.1f} ms")
+    elif command == "purge":
+        print(f"{purge_expired_notes()} notes purged.")
+    elif command == "compact":
+        print(f"{compact()} bytes reclaimed.")
+    elif command == "rebuild-index":
+        print(f"{rebuild_index()} notes indexed.")
+    elif command == "stats":
+        print(json.dumps(archive_stats(), indent=2))
+    else:
+        print("Usage: python note_archive.py get RUN_ID | search TERMS [--field diagnosis|differential|heading] "
+              "[--since-days N] [--limit N] | purge | compact | rebuild-index | stats")
+        sys.exit(2)
@@ -1,21 +1,29 @@
 # note_processing_core.py
+# Heavy SDKs (google.cloud.aiplatform, vertexai, Bio.Entrez) are imported at their first point
+# of use rather than here, so importing this module (and APP.py) stays fast.
+# Every stage takes the run's PipelineContext (see pipeline_context.py) for its clients, logging, deadline
+# and metrics; nothing here mutates process-wide state per call, so runs can execute concurrently in threads.
 import sys
 import io
-
-# --- UTF-8 Setup ---
-if sys.stdout.encoding != 'utf-8':
-    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
-if sys.stderr.encoding != 'utf-8':
-    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
-# --- End UTF-8 Setup ---
-
-from google.cloud import aiplatform  # Ensure this is imported
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part
 import re
-from Bio import Entrez
 import os
 
+from background_digest import prepare_background_for_prompts
+from checklist_extractor import (extract_checklist_facts, prefill_checklist, count_unresolved_items,
+                                 describe_extracted_facts, CHECKLIST_FACT_NEEDS)
+import note_archive
+import patient_fact_store
+from literature_digest_store import lookup_literature_digest, record_digest_use, record_digest_miss
+from prefix_cache import StaticPrefix, get_prefix_cache
+from prompt_builder import PromptSegment, build_prompt, format_size_report
+from pipeline_context import (PipelineConfig, PipelineContext, ENTREZ_EMAIL, PIPELINE_DEADLINE_SECONDS,
+                              ensure_vertex_initialized)
+from request_profiler import profile_stage
+from retrieval_index import InputRetrievalIndex, RETRIEVAL_CONTEXT_ENABLED, STAGE_INFORMATION_NEEDS
+import run_store
+from transcript_compaction import (TRANSCRIPT_COMPACTION_ENABLED, TRANSCRIPT_KEEP_RAW, compact_transcript,
+                                   describe_report)
+
 PROJECT_ID = os.getenv("AI_PROJECT_ID", "amy-lloyd")
 LOCATION = os.getenv("AI_LOCATION", "us-central1")
 
@@ -62,95 +70,14 @@ End with a gentle summary of next steps and encouragement.
 If MMSE, FAQ, or CDR are present in the input, results should be formatted in visually clean and readable tables. If any section (excluding the placeholder for Medical Explanation, Plan, and related Patient Instructions) lacks data from the input, write “NO INFORMATION FOUND.” When content is ambiguous, ask clarifying questions. Section headings should be the same size as body text. Tables should use alternating row shading and bold headers. Emojis and icons must not be used. The note must begin with the header "UT Health San Antonio" styled to be visually prominent.
 Do not include dates in the note.
 
-**Alzheimer's Disease Candidate Checklist Instructions (Revised):**
-Include the 'Alzheimer's Disease Candidate Checklist' section (using the template below verbatim)
+**Alzheimer's Disease Candidate Checklist Instructions:**
 IF your initial assessment of the provided 'PATIENT DATA' (especially Background Info, Transcription, and User Insights) suggests that
-'Alzheimer's Disease' or 'Mild Cognitive Impairment due to Alzheimer's Disease' is a probable or possible consideration for this patient.
-This checklist should appear immediately BEFORE the final signature section of this main note.
-If Alzheimer's Disease is not considered probable or possible based on the *initial input data and your initial assessment*, OMIT this entire checklist section.
-
-When including the checklist, Critically review the input text provided.
-If specific data corresponding to a checklist item (e.g., MMSE score, GDS score, APOE status, BMI, specific exclusionary criteria answers)
-is present in the input, YOU MUST replace the '***' placeholder or select the correct 'No / YES' option using that data.
-If the specific data for an item is NOT in the input, leave the '***' placeholder or the 'No *** YES' options exactly as they appear in the template. Do not make up data.
-
-**Alzheimer's Disease Candidate Checklist Template (This is the template the first LLM might include if AD is suspected. The script will then use a clean version for dynamic filling):**
+'Alzheimer's Disease' or 'Mild Cognitive Impairment due to Alzheimer's Disease' is a probable or possible consideration for this patient,
+output the following two marker lines, exactly as written and with nothing between them, immediately BEFORE the final signature section of this main note.
+The script replaces them with an Alzheimer's Disease Candidate Checklist that it fills in from the patient data separately.
 --- Alzheimer's Disease Candidate Checklist ---
-<INCLUSION CRITERIA>
-1- Age between 50 - 90 years,
-2- Mild cognitive impairment (MCI) OR Mild Dementia due to Alzheimer's Disease
-3- Amyloid PET or CSF Biomarkers positive for beta Amyloid.
-4- MMSE > 19.
-</INCLUSION CRITERIA>
-
-<OTHER DATA- include ONLY if INCLUSION CRITERIA SATISFIED>
-- MMSE score >21: ***/30. List the subsection scores if available. IF NOT insert a template to assess MMSE.
-- MoCA: *** /30 List the subsection scores if available. IF NOT insert a template to assess MOCA
-- CDR-global: 0.5 *** 1.0 List the subsection scores if available to assess CDR
-- FAQ: ***/30 List the subsection scores if available to assess FAQ.
-Baseline laboratory date: CBC, CMP, TSH, B12, Folate,
-Vitamin D, INR, aPTT. List results or list labs to be ordered.
-APOE status: *** (e.g., e3/e4, e4/e4, or "Information not found" or "To be ordered")
-If APOE status known, state associated ARIA risk: ***
-</OTHER DATA>
-
-<EXCLUSION CRITERIA- include ONLY if INCLUSION CRITERIA SATISFIED>
-Does the patient have any of the following (A
-"YES" is exclusionary):
-
-No *** YES Physical, Mental, or Neurological Issue
-Contribution to Cognitive Impairment
-No *** YES Age Criteria: Individuals younger than
-50 years old or older than 90 years.
-No *** YES MRI Contraindication: Any medical or
-physiological condition that would make undergoing Magnetic Resonance Imaging
-(MRI) inadvisable or dangerous for the patient. Some of these contraindications
-are older pacemakers, neurostimulators, cochlear implants, insulin pumps,
-intrathecal drug pumps, metallic foreign bodies, older aneurysm clips, older
-tattoos, and claustrophobia.
-No *** YES MRI
-Evidence of Neurological Abnormalities: MRI results displaying more than four
-microhemorrhages, superficial siderosis, the presence of vasogenic edema,
-indications of recent or ongoing strokes, aneurysms, vascular malformations,
-extensive white matter disease, neoplasms, evidence of infections, or any other
-neurological anomaly that, in the opinion of the physician, significantly
-heighten the risk of medical complications.
-No *** YES Bleeding
-Risks and Medication: Exclusionary conditions include untreated disorders that
-lead to excessive bleeding, a platelet count that is below 50 or an
-International Normalized Ratio (INR) above 1.5. Anticoagulation is also
-exclusionary.
-No *** YES Oncological
-Status: The presence of an active cancerous condition or malignancy, except
-after prolonged remission at the discretion of the prescribing physician.
-No *** YES Mental
-Health Conditions: The presence of untreated or uncontrolled depression or
-anxiety disorders, any other unstable psychiatric conditions, any current
-history of suicidal thoughts or actions in the preceding five years, or a
-Geriatric Depression Scale (GDS) score exceeding 8 will lead to exclusion. GDS:
-***/15
-No *** YES Substance Dependency: Any ongoing misuse or
-dependence on drugs or alcohol.
-N/A *** YES Reproductive
-Status: Women who are currently pregnant or are in the lactation phase
-post-childbirth.
-No *** YES Body Mass Index (BMI) Range: Individuals
-with a BMI that exceeds 35 or is less than 17. Estimated body mass index is
-*** kg/m² as calculated from the following: ***
-No *** YES Immunological Disease Diagnosis:
-Individuals diagnosed with a systemic immunological disorder, irrespective of
-the treatment they are on.
-No *** YES HIV Status: The presence of Human
-Immunodeficiency Virus (HIV) infection – if unknown and the patient is in a
-high risk group, please order an HIV test [needs a consent]
-No *** YES Recent Neurological Episodes: Any history
-of strokes, seizures, or transient ischemic attacks occurring within the last
-year. Or seizure with late life onset.
-No *** YES Current Use of Specific Medications:
-Ongoing usage of systemic monoclonal antibodies, immunoglobulin, and other
-biological treatments.
-</EXCLUSION CRITERIA>
 --- (End Checklist Template) ---
+If Alzheimer's Disease is not considered probable or possible based on the *initial input data and your initial assessment*, OMIT both marker lines.
 
 Conclude every note with this signature.
 """
@@ -196,6 +123,122 @@ Overall Exclusion Criteria Summary: *** (e.g., "No exclusionary criteria definit
 </EXCLUSION CRITERIA>
 --- (End Checklist Template) ---"""
 
+DIAGNOSTIC_PROMPT_INSTRUCTIONS = """You are an AI Neurological Diagnostic Assistant. Based on the patient history, neurological examination findings, and any available ancillary data that have been provided to you, please provide a comprehensive neurological assessment focused on cognitive disorders.
+Requested Output:
+Please structure your response as follows (This entire response will form the "Medical Explanation", "Plan Rationale", and "Plan" sections of a larger note, so ensure appropriate subheadings like "## Medical Explanation", "## Plan Rationale", "## Plan"):
+
+## Medical Explanation
+
+**Summary of Key Patient Findings:** Briefly summarize the most pertinent positive and negative findings from the patient's history, examination, and ancillary data that were provided.
+
+**Most Likely Diagnosis:** YOU MUST STATE THE DIAGNOSIS IN THE FOLLOWING 3-PART FORMAT, EVEN IF SOME PARTS ARE UNKNOWN:
+1- [Severity of dementia/impairment, e.g., Mild Dementia, Mild Cognitive Impairment, Moderate Dementia, Unknown Severity], 2- [Clinical Syndrome, e.g., Amnestic Presentation, Non-fluent PPA, Behavioral Variant FTD, Alzheimer's Clinical Syndrome, Unknown Syndrome], 3- [Suspected Underlying Pathology, e.g., Alzheimer's Disease, FTLD-tau, Vascular Disease, Unknown Pathology]. Example: "1- Mild Dementia, 2- Amnestic and Language Presentation, 3- Alzheimer's Disease." If a part is truly unknown from context, state "Unknown [PartName]".
+
+    Pathophysiology: Describe the underlying biological mechanisms and structural/functional changes associated with this disorder.
+    Natural History: Outline the typical untreated course of the disorder from onset over time.
+    Semiology (Clinical Manifestations): Detail the common signs, symptoms, and clinical features characteristic of this disorder across its stages.
+    Treatment (General Approaches): Describe the current standard therapeutic interventions, including pharmacological and non-pharmacological strategies. Do not prescribe, but describe general approaches.
+    Progression: Explain the typical pattern and rate of decline or change associated with this disorder.
+**Differential Diagnoses:** List other possible diagnoses in order of likelihood. For each differential diagnosis, include:
+    Pathophysiology, Natural History, Semiology, Treatment (General Approaches), Progression (as above).
+    Pros (Specific to this Patient): Specific findings from the provided patient information that support this diagnosis for this particular patient.
+    Cons (Specific to this Patient): Specific findings from the provided patient information that argue against this diagnosis for this particular patient, or features that are atypical for this diagnosis based on the patient's presentation.
+**Reasoning for Most Likely Diagnosis (Specific to this Patient):** Provide a detailed explanation.
+**Missing Information and Recommended Next Steps (Specific to this Patient):** Identify crucial pieces of information.
+**Prognostic Considerations (Specific to this Patient, if applicable based on likely diagnoses):** Briefly mention.
+
+**## Plan Rationale**
+Conclude this entire section with a paragraph explaining the rationale for the proposed clinical plan based on the assessment.
+
+**## Plan**
+Following the rationale, list the proposed clinical plan as a numbered list.
+
+Important Caveats: Include a disclaimer that this is an AI-generated assessment based on the provided information and is not a substitute for evaluation and diagnosis by a qualified human neurologist. Emphasize that clinical correlation and further investigation are essential.
+"""
+
+NOTE_BODY_TASK_INSTRUCTIONS = """Generate the neurology note structure now based on ALL the provided patient data and the general instructions.
+Ensure the HPI draws from the "CURRENT VISIT CONTEXT" including any transcription.
+Use "BACKGROUND INFORMATION" for historical context.
+Consider "USER INSIGHTS" for nuances, emphasis, or potential diagnoses to explore.
+Remember to include the placeholder "[YOUR SEPARATELY GENERATED DETAILED MEDICAL EXPLANATION AND PLAN WILL BE INSERTED HERE BY THE SCRIPT]"
+Do not generate the detailed medical explanation, differentials, or plan itself in this step.
+The Patient Instructions section should also be generated based on the understanding that a detailed Medical Explanation and Plan will be inserted later by the script.
+Do not include dates."""
+
+DIAGNOSIS_EXTRACTION_INSTRUCTIONS = """From the following clinical assessment text, find the section explicitly titled "**Most Likely Diagnosis:**" or "Most Likely Diagnosis:".
+Extract the single most specific primary diagnosis stated immediately after this title.
+Prioritize a diagnosis that includes "Alzheimer's Disease" or "Mild Cognitive Impairment due to Alzheimer's Disease" if present and clearly stated as the most likely.
+If a 3-part diagnosis (Severity, Syndrome, Pathology) is given, extract the most clinically relevant part, usually the Pathology (e.g., "Alzheimer's Disease" from "..., 3- Alzheimer's Disease"). If pathology is "Unknown" but syndrome points to AD, use that.
+Respond with ONLY the diagnosis name (e.g., "Alzheimer's Disease", "Mild Cognitive Impairment due to Alzheimer's Disease", "Frontotemporal Dementia").
+Do not include "1-", "2-", "3-", surrounding text, explanations, or the heading "Most Likely Diagnosis:" itself.
+If this specific section or a clear single diagnosis after the title is not found, or if it says "Leave blank if uncertain" and is blank, respond with "NONE".
+"""
+
+CHECKLIST_PROMPT_INSTRUCTIONS = """You are tasked with meticulously populating an Alzheimer's Disease Candidate Checklist based on ALL provided patient information and the diagnostic assessment.
+The checklist template is provided below.
+
+**Instructions for populating the checklist:**
+
+1.  **Review ALL provided patient data and the diagnostic assessment (provided in CONTEXT below).**
+2.  **Analyze INCLUSION CRITERIA first:**
+    *   For each item (1-4) in the `<INCLUSION CRITERIA>` section, determine if the patient meets the criterion based *solely* on the information provided IN THE CONTEXT.
+    *   Replace `***` with specific data if found (e.g., "YES (Age: 72)" or "NO (MMSE: 15)" or "UNKNOWN"). For item 3 (Biomarker), if PET/CSF data is mentioned, state result (e.g., "YES (Amyloid PET positive for beta Amyloid)" or "NO (CSF normal for beta Amyloid)" or "UNKNOWN (No biomarker data for beta Amyloid)").
+    *   For "Overall Inclusion Criteria Met:", explicitly state "YES" if all items 1-4 are definitively met. State "NO" if any item 1-4 is definitively not met. State "UNCERTAIN" if one or more items are unknown but others are met (especially if AD is the primary diagnosis).
+
+3.  **If "Overall Inclusion Criteria Met:" is "YES" or "UNCERTAIN" (and AD is the primary suspected diagnosis from the assessment):**
+    *   Proceed to populate the `<OTHER DATA>` section. Replace `***` with specific values if found from CONTEXT. For subsection scores or lab results, list them if available or state "Not available" or "Not specified". For APOE, state genotype and then the ARIA risk on the next line if applicable based on the genotype shown in the template. If APOE is not available, state "Not available" or "To be ordered".
+    *   Proceed to populate the `<EXCLUSION CRITERIA>` section. For each "No / YES / UNKNOWN" item:
+        *   Carefully evaluate the patient data IN THE CONTEXT against the criterion.
+        *   Replace "No / YES / UNKNOWN" with **ONLY ONE** of these three options: "No", "YES", or "UNKNOWN".
+        *   Fill in any other `***` placeholders (like Actual Age, GDS Score, BMI) with data if available from CONTEXT, otherwise leave them as `***` or state "Not available".
+    *   For "Overall Exclusion Criteria Summary:", provide a concise statement like: "No exclusionary criteria definitively met based on available information.", or "Exclusionary criterion X met.", or "Insufficient information to rule out all potential exclusions (see UNKNOWN items above)."
+
+4.  **If "Overall Inclusion Criteria Met:" is "NO":**
+    *   Populate the `<INCLUSION CRITERIA>` section, clearly indicating why they are not met (e.g., "NO (Age: 45)").
+    *   For the `<OTHER DATA>` and `<EXCLUSION CRITERIA>` sections, replace their entire content with a single line: "NOT APPLICABLE - Inclusion criteria not met."
+
+5.  **General Formatting:**
+    *   Retain the exact structure and headings of the template.
+    *   Be precise. Do not infer information. Use only the provided text from CONTEXT.
+"""
+
+ELABORATION_PROMPT_INSTRUCTIONS = """Based on ALL the provided patient data and the diagnostic assessment (see CONTEXT below), provide a section titled "### Patient-Specific Elaboration of Diagnostic Criteria for Alzheimer's Disease".
+
+Instructions:
+1.  List the key diagnostic criteria for Alzheimer's Disease (e.g., from NIA-AA or DSM-5 for Major/Mild Neurocognitive Disorder due to AD). You can choose a standard set of criteria (e.g., NIA-AA for probable AD).
+2.  For EACH key criterion, briefly explain the criterion itself in one sentence.
+3.  Then, for EACH criterion, analyze the provided patient information IN THE CONTEXT (history, cognitive scores, imaging, biomarkers if mentioned, symptoms) and explicitly state how the patient's specific findings either SUPPORT or DO NOT SUPPORT (or if information is LACKING for) that particular criterion. Be specific and quote or refer to data points from the context.
+4.  Use bullet points for each main criterion. Under each main criterion, use sub-bullets for its explanation and then for the patient-specific analysis.
+5.  Maintain a clinical and objective tone.
+
+Example for one criterion:
+*   **Insidious onset and gradual progression of cognitive impairment:**
+    *   *Explanation:* This criterion means the cognitive symptoms started slowly and have worsened steadily over time, rather than appearing abruptly or having a fluctuating course.
+    *   *Patient Specifics:* The patient's family reports a decline "over the past two years" with "worsening memory and word-finding" (SUPPORTS gradual progression). The provided history does not mention any sudden neurological events that would suggest an acute onset (SUPPORTS insidious onset).
+"""
+
+# The static instructions of the large stages, sent once as provider-cached prefixes (see prefix_cache.py);
+# each call then carries only the patient payload. Editing an instruction text creates a new cache entry.
+NOTE_BODY_PREFIX = StaticPrefix("note_body", YOUR_DETAILED_INSTRUCTIONS)
+DIAGNOSTIC_PREFIX = StaticPrefix("diagnostic_assessment", DIAGNOSTIC_PROMPT_INSTRUCTIONS)
+CHECKLIST_PREFIX = StaticPrefix("checklist", CHECKLIST_PROMPT_INSTRUCTIONS)
+ELABORATION_PREFIX = StaticPrefix("elaboration", ELABORATION_PROMPT_INSTRUCTIONS)
+
+# The parts of the diagnostic assessment each later stage needs (matched against the assessment's bold or
+# "##" headings, ignoring any parenthetical). Differentials, pathophysiology and prognosis are left out of
+# those prompts; a stage gets the whole assessment only if none of its parts can be found.
+STAGE_ASSESSMENT_SECTIONS = {
+    "primary_diagnosis": ("most likely diagnosis",),
+    "checklist": ("summary of key patient findings", "most likely diagnosis",
+                  "missing information and recommended next steps", "plan"),
+    "elaboration": ("summary of key patient findings", "most likely diagnosis",
+                    "reasoning for most likely diagnosis"),
+}
+# Of these sections only the first paragraph (the 3-part diagnosis) is patient-specific; the rest is textbook.
+ASSESSMENT_HEADLINE_ONLY_SECTIONS = {"most likely diagnosis"}
+
+_ASSESSMENT_HEADING_RE = re.compile(r"^[ \t]*(?:\*\*[ \t]*#*|#+)[ \t]*([^*:\n]+)", re.MULTILINE)
+
 SIGNATURE = """
 Arash Salardini, MD
 Klesse Foundation Distinguished Chair in Alzheimer and Neurodegenerative Diseases
@@ -221,54 +264,141 @@ Fax: 210-450-6039
 # generate_missing_info_summary
 # --- Ensure they are all here ---
 
+def ensure_utf8_stdio():
+    """
+    Rewraps sys.stdout/sys.stderr as UTF-8 if needed.
+    Previously done at import time; now left to the entry point (CLI or APP.py) to call once.
+    """
+    if sys.stdout.encoding != 'utf-8':
+        sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+    if sys.stderr.encoding != 'utf-8':
+        sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+
+
+def _get_generative_model(model_name=STABLE_MODEL_NAME, cached_content=None):
+    # Deferred import: vertexai pulls in google.cloud.aiplatform, which takes seconds to import.
+    if cached_content is not None:
+        # A model bound to a context-cached prompt prefix (prefix_cache.VertexPrefixCache).
+        from vertexai.preview.generative_models import GenerativeModel as CachedContentModel
+        return CachedContentModel.from_cached_content(cached_content=cached_content)
+    from vertexai.generative_models import GenerativeModel
+    return GenerativeModel(model_name)
+
+
+def _get_entrez():
+    # Deferred import: Bio.Entrez is only needed once a diagnosis has been extracted.
+    from Bio import Entrez
+    return Entrez
+
+
+def new_pipeline_context(run_id=None, deadline_seconds=None, model_factory=None, traffic=None):
+    """
+    A PipelineContext with this module's configuration; deadline_seconds overrides PIPELINE_DEADLINE_SECONDS.
+    model_factory: replaces the online Vertex AI model (batch_generation queues the calls into batch jobs); prompt
+    prefixes are then sent inline, since the replacement has no access to the provider's context cache.
+    traffic: a model_traffic_replay recorder or replayer that the run's model and PubMed calls go through.
+    """
+    config = PipelineConfig(project_id=PROJECT_ID, location=LOCATION, model_name=STABLE_MODEL_NAME,
+                            entrez_email=ENTREZ_EMAIL,
+                            deadline_seconds=PIPELINE_DEADLINE_SECONDS if deadline_seconds is None else deadline_seconds)
+    if model_factory is not None:
+        return PipelineContext(config, model_factory, lambda: _get_entrez(), run_id=run_id, traffic=traffic)
+    # The factories look the client getters up at call time, so replacing them (as load_test.py does) takes effect.
+    return PipelineContext(config,
+                           lambda model_name, cached_content=None: _get_generative_model(model_name, cached_content),
+                           lambda: _get_entrez(), run_id=run_id, prefix_cache=get_prefix_cache(), traffic=traffic)
+
+
 def initialize_vertex_ai():
-    # ... (same as before)
-    print("DEBUG: Initializing Vertex AI...")
+    """Initializes Vertex AI for PROJECT_ID/LOCATION once per process; later calls return immediately."""
     try:
-        vertexai.init(project=PROJECT_ID, location=LOCATION)
-        print(f"Vertex AI initialized for project '{PROJECT_ID}' in location '{LOCATION}'.")
+        ensure_vertex_initialized(PROJECT_ID, LOCATION)
     except Exception as e:
         print(f"CRITICAL ERROR initializing Vertex AI: {e}")
         raise
 
 
-def fetch_recent_guidelines(diagnosis, email="salardini@uthscsa.edu", max_results=5):
-    # ... (same as before)
-    print(f"DEBUG: Searching PubMed for guidelines related to: {diagnosis}")
-    Entrez.email = email
+def search_guideline_pmids(diagnosis, email=None, max_results=5, ctx=None):
+    """
+    Returns the PubMed IDs of guideline publications for `diagnosis`, most relevant first.
+    email: the contact address sent with the request; defaults to the context's entrez_email.
+    """
+    ctx = ctx or new_pipeline_context()
+    Entrez = ctx.entrez()
     search_term = f'("{diagnosis}"[MeSH Terms] OR "{diagnosis}"[Title/Abstract]) AND ("guideline"[Publication Type] OR "practice guideline"[Publication Type])'
+    handle = Entrez.esearch(db="pubmed", term=search_term, retmax=str(max_results), sort="relevance",
+                            email=email or ctx.config.entrez_email)
+    search_results = Entrez.read(handle)
+    handle.close()
+    ids = list(search_results["IdList"])
+    count = int(search_results["Count"])
+    ctx.log(f"DEBUG: Found {count} potential guidelines, fetching details for up to {len(ids)}.")
+    return ids
+
+
+def fetch_guideline_abstracts(ids, email=None, ctx=None):
+    """Fetches and cleans the plain-text abstracts for the given PubMed IDs."""
+    ctx = ctx or new_pipeline_context()
+    Entrez = ctx.entrez()
+    handle = Entrez.efetch(db="pubmed", id=ids, rettype="abstract", retmode="text",
+                           email=email or ctx.config.entrez_email)
+    abstracts_text = handle.read()
+    handle.close()
+    raw_abstracts = abstracts_text.strip().split("\n\n")
+    processed_abstracts = []
+    for i, abst in enumerate(raw_abstracts):
+        clean_abst = re.sub(r"^\s*\d+\.\s*", "", abst)
+        clean_abst = re.sub(r"^\s*PMID-\s*\d+\s*", "", clean_abst)
+        if len(clean_abst) > 50:
+            processed_abstracts.append(clean_abst.strip())
+        if i < 10:  # Log only a few for brevity
+            ctx.log(f"DEBUG: Raw abstract part {i}: {abst[:100]}...")
+    ctx.log(f"DEBUG: Fetched and processed {len(processed_abstracts)} abstracts from {len(raw_abstracts)} raw parts.")
+    return processed_abstracts
+
+
+def fetch_abstracts_by_pmid(ids, email=None, ctx=None):
+    """
+    Fetches the abstracts of all `ids` in one XML efetch and returns {pmid: [abstract]} (an empty list for a PMID
+    without a usable abstract), so a batch job costs one PubMed round-trip instead of one per PMID.
+    """
+    ctx = ctx or new_pipeline_context()
+    Entrez = ctx.entrez()
+    handle = Entrez.efetch(db="pubmed", id=list(ids), retmode="xml", email=email or ctx.config.entrez_email)
+    records = Entrez.read(handle)
+    handle.close()
+    abstracts_by_pmid = {str(pmid): [] for pmid in ids}
+    for article in records.get("PubmedArticle", []):
+        citation = article["MedlineCitation"]
+        paragraphs = [f"{text.attributes['Label']}: {text}" if text.attributes.get("Label") else str(text)
+                      for text in citation["Article"].get("Abstract", {}).get("AbstractText", [])]
+        abstract = "\n".join([str(citation["Article"].get("ArticleTitle", ""))] + paragraphs).strip()
+        if len(abstract) > 50 and paragraphs:
+            abstracts_by_pmid[str(citation["PMID"])] = [abstract]
+    fetched = sum(1 for abstracts in abstracts_by_pmid.values() if abstracts)
+    ctx.log(f"DEBUG: Fetched {fetched} abstracts for {len(abstracts_by_pmid)} PMIDs.")
+    return abstracts_by_pmid
+
+
+def fetch_recent_guidelines(diagnosis, email=None, max_results=5, ctx=None):
+    # ... (same as before)
+    ctx = ctx or new_pipeline_context()
+    ctx.log(f"DEBUG: Searching PubMed for guidelines related to: {diagnosis}")
     try:
-        handle = Entrez.esearch(db="pubmed", term=search_term, retmax=str(max_results), sort="relevance")
-        search_results = Entrez.read(handle)
-        handle.close()
-        ids = search_results["IdList"]
-        count = int(search_results["Count"])
-        print(f"DEBUG: Found {count} potential guidelines, fetching details for up to {len(ids)}.")
+        ids = search_guideline_pmids(diagnosis, email=email, max_results=max_results, ctx=ctx)
         if not ids:
-            print("DEBUG: No relevant guideline IDs found on PubMed.")
+            ctx.log("DEBUG: No relevant guideline IDs found on PubMed.")
             return []
-        handle = Entrez.efetch(db="pubmed", id=ids, rettype="abstract", retmode="text")
-        abstracts_text = handle.read()
-        handle.close()
-        raw_abstracts = abstracts_text.strip().split("\n\n")
-        processed_abstracts = []
-        for i, abst in enumerate(raw_abstracts):
-            clean_abst = re.sub(r"^\s*\d+\.\s*", "", abst)
-            clean_abst = re.sub(r"^\s*PMID-\s*\d+\s*", "", clean_abst)
-            if len(clean_abst) > 50:
-                processed_abstracts.append(clean_abst.strip())
-            if i < 10:  # Log only a few for brevity
-                print(f"DEBUG: Raw abstract part {i}: {abst[:100]}...")
-        print(f"DEBUG: Fetched and processed {len(processed_abstracts)} abstracts from {len(raw_abstracts)} raw parts.")
-        return processed_abstracts
+        return fetch_guideline_abstracts(ids, email=email, ctx=ctx)
     except Exception as e:
-        print(f"ERROR during PubMed search/fetch: {e}")
+        ctx.log(f"ERROR during PubMed search/fetch: {e}")
         return []
 
 
-def summarize_literature_with_gemini(abstracts, diagnosis):
+def summarize_literature_with_gemini(abstracts, diagnosis, ctx=None):
     # ... (same as before)
-    print("DEBUG: Summarizing literature with Gemini...")
+    ctx = ctx or new_pipeline_context()
+    ctx.log("DEBUG: Summarizing literature with Gemini...")
     if not abstracts:
         return "### Recent Literature Summary\n\nNo recent relevant literature found or summarized."
     context_abstracts = []
@@ -283,158 +413,153 @@ def summarize_literature_with_gemini(abstracts, diagnosis):
     if not context_abstracts:
         return "### Recent Literature Summary\n\nAbstracts were too long or none suitable for summary."
     context = "\n\n---\n\n".join(context_abstracts)
-    literature_summary_instructions = f"""
-    Based on the following abstracts related to '{diagnosis}', please provide a summary for a "Recent Literature Summary" section of a clinical note.
-    Instructions:
-    1. Review the provided abstracts, focusing on clinical guidelines or practice guidelines if present.
-    2. Select 2-3 of the most relevant and recent guidelines mentioned in the abstracts.
-    3. For each selected guideline, provide a concise summary of its key recommendations pertinent to '{diagnosis}'.
-    4. Briefly comment on the relevance of each guideline to the diagnosis, prognosis, or management of a typical case involving '{diagnosis}'.
-    5. Format the output as a numbered list, ensuring the section starts with the heading "### Recent Literature Summary".
-    6. If fewer than 2 relevant guidelines are found in the provided abstracts, state that under the heading.
-    Abstracts Provided:
-    ---
-    {context}
-    ---
-    Generate the "Recent Literature Summary" section now:
-    """
+    literature_summary_instructions = f"""Based on the following abstracts related to '{diagnosis}', please provide a summary for a "Recent Literature Summary" section of a clinical note.
+Instructions:
+1. Review the provided abstracts, focusing on clinical guidelines or practice guidelines if present.
+2. Select 2-3 of the most relevant and recent guidelines mentioned in the abstracts.
+3. For each selected guideline, provide a concise summary of its key recommendations pertinent to '{diagnosis}'.
+4. Briefly comment on the relevance of each guideline to the diagnosis, prognosis, or management of a typical case involving '{diagnosis}'.
+5. Format the output as a numbered list, ensuring the section starts with the heading "### Recent Literature Summary".
+6. If fewer than 2 relevant guidelines are found in the provided abstracts, state that under the heading."""
+    prompt = build_prompt("literature", [
+        PromptSegment("instructions", literature_summary_instructions, required=True),
+        PromptSegment("abstracts", context, header="Abstracts Provided:\n---\n"),
+        PromptSegment("task", 'Generate the "Recent Literature Summary" section now:', header="---\n", required=True),
+    ], ctx=ctx)
     try:
-        model = GenerativeModel(STABLE_MODEL_NAME)
-        response = model.generate_content([literature_summary_instructions])
-        print("DEBUG: Received literature summary from Gemini.")
+        model = ctx.model()
+        response = model.generate_content(prompt.parts)
+        ctx.log("DEBUG: Received literature summary from Gemini.")
         generated_summary = response.text.strip()
         if not generated_summary.lower().startswith("### recent literature summary"):
             generated_summary = "### Recent Literature Summary\n\n" + generated_summary
         return generated_summary
     except Exception as e:
-        print(f"ERROR during Gemini literature summarization: {e}")
+        ctx.log(f"ERROR during Gemini literature summarization: {e}")
         return "### Recent Literature Summary\n\nError summarizing literature."
 
 
-def generate_neurology_note_body(gnb_historical_text, gnb_current_visit_context, gnb_user_insights):
+def assessment_excerpt(diagnostic_assessment_text, stage):
+    """The sections of the diagnostic assessment listed for `stage` in STAGE_ASSESSMENT_SECTIONS, in order."""
+    wanted = STAGE_ASSESSMENT_SECTIONS[stage]
+    headings = list(_ASSESSMENT_HEADING_RE.finditer(diagnostic_assessment_text))
+    parts = []
+    for i, heading in enumerate(headings):
+        label = heading.group(1).split("(")[0].strip().lower()
+        if label not in wanted:
+            continue
+        end = headings[i + 1].start() if i + 1 < len(headings) else len(diagnostic_assessment_text)
+        section = diagnostic_assessment_text[heading.start():end].strip()
+        if label in ASSESSMENT_HEADLINE_ONLY_SECTIONS:
+            paragraphs = re.split(r"\n\s*\n", section, maxsplit=2)
+            heading_only = not re.sub(r"[*#:\s]", "", paragraphs[0][len(heading.group(0).strip()):])
+            section = "\n\n".join(paragraphs[:2] if heading_only else paragraphs[:1])
+        parts.append(section)
+    return "\n\n".join(parts) if parts else diagnostic_assessment_text
+
+
+def _patient_data_segments(background_info, transcription_context, user_insights, diagnostic_assessment_text, stage):
+    """The CONTEXT segments shared by the checklist and elaboration prompts."""
+    return [
+        PromptSegment("background", background_info or "Not provided.", priority=1, dedupe=True,
+                      header="**CONTEXT (Patient Data and Diagnostic Assessment):**\n---\nPATIENT DATA:\n"
+                             "I. BACKGROUND INFORMATION (Prior to this visit):\n"),
+        PromptSegment("transcription", transcription_context or "Not provided.", priority=2, dedupe=True,
+                      header="---\nII. CURRENT VISIT TRANSCRIPTION (and other current visit context):\n"),
+        PromptSegment("user_insights", user_insights or "Not provided.", priority=4, dedupe=True,
+                      header="---\nIII. USER INSIGHTS (Clinician's additional thoughts, emphasis, potential diagnoses, "
+                             "revisions):\n"),
+        PromptSegment("assessment", assessment_excerpt(diagnostic_assessment_text, stage), priority=3,
+                      header="---\nIV. DIAGNOSTIC ASSESSMENT (key findings, 'Most Likely Diagnosis' and the parts "
+                             "relevant to this task):\n"),
+    ]
+
+
+def generate_neurology_note_body(gnb_historical_text, gnb_current_visit_context, gnb_user_insights, ctx=None):
     """
     Generates the main body of the neurology note.
     gnb_historical_text: Corresponds to "Background Information".
     gnb_current_visit_context: Corresponds to "Transcription" and other current visit elements.
     gnb_user_insights: Corresponds to "Additional Info" and "Revised Info".
     """
-    print("DEBUG: Inside generate_neurology_note_body function.")
+    ctx = ctx or new_pipeline_context()
+    ctx.log("DEBUG: Inside generate_neurology_note_body function.")
+    prompt_content = build_prompt("note_body", [
+        PromptSegment("background", gnb_historical_text or "Not provided.", priority=1, dedupe=True,
+                      header="PATIENT DATA START\n---\nI. BACKGROUND INFORMATION (Prior to this visit):\n"),
+        PromptSegment("current_visit", gnb_current_visit_context or "Not provided.", priority=3, dedupe=True,
+                      header="---\nII. CURRENT VISIT CONTEXT (Includes transcription if available, and reason for visit):\n"),
+        PromptSegment("user_insights", gnb_user_insights or "Not provided.", priority=4, dedupe=True,
+                      header="---\nIII. USER INSIGHTS (Clinician's additional thoughts, emphasis, potential diagnoses, "
+                             "revisions):\n"),
+        PromptSegment("task", NOTE_BODY_TASK_INSTRUCTIONS, header="---\nPATIENT DATA END\n\n", required=True),
+    ], ctx=ctx, prefix=NOTE_BODY_PREFIX)
     try:
-        model = GenerativeModel(STABLE_MODEL_NAME)
-        # Updated prompt to reflect new input structure
-        prompt_content = f"""
-        {YOUR_DETAILED_INSTRUCTIONS} 
-
-        PATIENT DATA START
-        ---
-        I. BACKGROUND INFORMATION (Prior to this visit):
-        {gnb_historical_text if gnb_historical_text else "Not provided."}
-        ---
-        II. CURRENT VISIT CONTEXT (Includes transcription if available, and reason for visit):
-        {gnb_current_visit_context if gnb_current_visit_context else "Not provided."}
-        ---
-        III. USER INSIGHTS (Clinician's additional thoughts, emphasis, potential diagnoses, revisions):
-        {gnb_user_insights if gnb_user_insights else "Not provided."}
-        ---
-        PATIENT DATA END
-
-        Generate the neurology note structure now based on ALL the provided patient data and the general instructions.
-        Ensure the HPI draws from the "CURRENT VISIT CONTEXT" including any transcription.
-        Use "BACKGROUND INFORMATION" for historical context.
-        Consider "USER INSIGHTS" for nuances, emphasis, or potential diagnoses to explore.
-        Remember to include the placeholder "[YOUR SEPARATELY GENERATED DETAILED MEDICAL EXPLANATION AND PLAN WILL BE INSERTED HERE BY THE SCRIPT]"
-        Do not generate the detailed medical explanation, differentials, or plan itself in this step.
-        The Patient Instructions section should also be generated based on the understanding that a detailed Medical Explanation and Plan will be inserted later by the script.
-        Do not include dates.
-        """
-        print("\n--- Sending main note body prompt to Gemini ---")
-        response = model.generate_content([prompt_content])
-        print("--- Received main note body response from Gemini ---")
+        model = ctx.model(prefix=NOTE_BODY_PREFIX)
+        ctx.log("\n--- Sending main note body prompt to Gemini ---")
+        response = model.generate_content(prompt_content.parts)
+        ctx.log("--- Received main note body response from Gemini ---")
         return response.text
     except Exception as e:
-        print(f"An error occurred during main note body Gemini API call: {e}")
+        ctx.log(f"An error occurred during main note body Gemini API call: {e}")
         return f"Error generating main note body: {e}"
 
 
 def generate_diagnostic_assessment_llm(diag_historical_context, diag_reason_for_visit,
-                                       diag_user_insights_and_revisions):
+                                       diag_user_insights_and_revisions, diag_transcription=None, ctx=None):
     """
     Generates the detailed diagnostic assessment.
-    diag_historical_context: Background Info + Transcription.
+    diag_historical_context: Background Info (+ Transcription when diag_transcription is not given).
     diag_reason_for_visit: High-level reason (can be generic as context is rich).
     diag_user_insights_and_revisions: Additional Info + Revised Info.
+    diag_transcription: the current visit transcription, as its own (more important) prompt segment.
     """
-    print("DEBUG: Attempting to generate diagnostic assessment (Medical Explanation, Plan) using LLM...")
-    diagnostic_prompt_instructions = """You are an AI Neurological Diagnostic Assistant. Based on the patient history, neurological examination findings, and any available ancillary data that have been provided to you, please provide a comprehensive neurological assessment focused on cognitive disorders.
-Requested Output:
-Please structure your response as follows (This entire response will form the "Medical Explanation", "Plan Rationale", and "Plan" sections of a larger note, so ensure appropriate subheadings like "## Medical Explanation", "## Plan Rationale", "## Plan"):
-
-## Medical Explanation
-
-**Summary of Key Patient Findings:** Briefly summarize the most pertinent positive and negative findings from the patient's history, examination, and ancillary data that were provided.
-
-**Most Likely Diagnosis:** YOU MUST STATE THE DIAGNOSIS IN THE FOLLOWING 3-PART FORMAT, EVEN IF SOME PARTS ARE UNKNOWN:
-1- [Severity of dementia/impairment, e.g., Mild Dementia, Mild Cognitive Impairment, Moderate Dementia, Unknown Severity], 2- [Clinical Syndrome, e.g., Amnestic Presentation, Non-fluent PPA, Behavioral Variant FTD, Alzheimer's Clinical Syndrome, Unknown Syndrome], 3- [Suspected Underlying Pathology, e.g., Alzheimer's Disease, FTLD-tau, Vascular Disease, Unknown Pathology]. Example: "1- Mild Dementia, 2- Amnestic and Language Presentation, 3- Alzheimer's Disease." If a part is truly unknown from context, state "Unknown [PartName]".
-
-    Pathophysiology: Describe the underlying biological mechanisms and structural/functional changes associated with this disorder.
-    Natural History: Outline the typical untreated course of the disorder from onset over time.
-    Semiology (Clinical Manifestations): Detail the common signs, symptoms, and clinical features characteristic of this disorder across its stages.
-    Treatment (General Approaches): Describe the current standard therapeutic interventions, including pharmacological and non-pharmacological strategies. Do not prescribe, but describe general approaches.
-    Progression: Explain the typical pattern and rate of decline or change associated with this disorder.
-**Differential Diagnoses:** List other possible diagnoses in order of likelihood. For each differential diagnosis, include:
-    Pathophysiology, Natural History, Semiology, Treatment (General Approaches), Progression (as above).
-    Pros (Specific to this Patient): Specific findings from the provided patient information that support this diagnosis for this particular patient.
-    Cons (Specific to this Patient): Specific findings from the provided patient information that argue against this diagnosis for this particular patient, or features that are atypical for this diagnosis based on the patient's presentation.
-**Reasoning for Most Likely Diagnosis (Specific to this Patient):** Provide a detailed explanation.
-**Missing Information and Recommended Next Steps (Specific to this Patient):** Identify crucial pieces of information.
-**Prognostic Considerations (Specific to this Patient, if applicable based on likely diagnoses):** Briefly mention.
-
-**## Plan Rationale**
-Conclude this entire section with a paragraph explaining the rationale for the proposed clinical plan based on the assessment.
-
-**## Plan**
-Following the rationale, list the proposed clinical plan as a numbered list.
-
-Important Caveats: Include a disclaimer that this is an AI-generated assessment based on the provided information and is not a substitute for evaluation and diagnosis by a qualified human neurologist. Emphasize that clinical correlation and further investigation are essential.
-"""
+    ctx = ctx or new_pipeline_context()
+    ctx.log("DEBUG: Attempting to generate diagnostic assessment (Medical Explanation, Plan) using LLM...")
+    if diag_transcription is None:
+        patient_segments = [
+            PromptSegment("background_and_visit", diag_historical_context or "Not provided.", priority=2, dedupe=True,
+                          header="I. BACKGROUND AND CURRENT VISIT INFORMATION (Includes prior history and current "
+                                 "visit transcription):\n"),
+        ]
+    else:
+        patient_segments = [
+            PromptSegment("background", diag_historical_context or "Not provided.", priority=1, dedupe=True,
+                          header="I. BACKGROUND INFORMATION (Prior to this visit):\n"),
+            PromptSegment("transcription", diag_transcription or "Not provided.", priority=3, dedupe=True,
+                          header="---\nII. CURRENT VISIT TRANSCRIPTION:\n"),
+        ]
+    prompt = build_prompt("diagnostic_assessment", [
+        PromptSegment("data_start", "# Base your assessment on ALL the following provided patient data:\n\n"
+                                    "PATIENT DATA START\n---", required=True),
+        *patient_segments,
+        PromptSegment("reason_for_visit", diag_reason_for_visit or "Not provided.", required=True,
+                      header="---\nHIGH-LEVEL REASON FOR VISIT (For context, full details are above):\n"),
+        PromptSegment("user_insights", diag_user_insights_and_revisions or "Not provided.", priority=4, dedupe=True,
+                      header="---\nUSER INSIGHTS (Clinician's additional thoughts, emphasis, potential diagnoses, "
+                             "revisions):\n"),
+        PromptSegment("task", "Please generate the comprehensive neurological assessment now.\n"
+                              'Ensure the "Most Likely Diagnosis" STRICTLY follows the "1- Severity, 2- Syndrome, '
+                              '3- Pathology" format.', header="---\nPATIENT DATA END\n\n", required=True),
+    ], ctx=ctx, prefix=DIAGNOSTIC_PREFIX)
     try:
-        model = GenerativeModel(STABLE_MODEL_NAME)
-        # Updated prompt to reflect new input structure
-        prompt = f"""{diagnostic_prompt_instructions}
-
-        # Base your assessment on ALL the following provided patient data:
-
-        PATIENT DATA START
-        ---
-        I. BACKGROUND AND CURRENT VISIT INFORMATION (Includes prior history and current visit transcription):
-        {diag_historical_context if diag_historical_context else "Not provided."} 
-        ---
-        II. HIGH-LEVEL REASON FOR VISIT (For context, full details are above):
-        {diag_reason_for_visit if diag_reason_for_visit else "Not provided."}
-        ---
-        III. USER INSIGHTS (Clinician's additional thoughts, emphasis, potential diagnoses, revisions):
-        {diag_user_insights_and_revisions if diag_user_insights_and_revisions else "Not provided."}
-        ---
-        PATIENT DATA END
-
-        Please generate the comprehensive neurological assessment now.
-        Ensure the "Most Likely Diagnosis" STRICTLY follows the "1- Severity, 2- Syndrome, 3- Pathology" format.
-        """
-        print("DEBUG: Sending prompt to LLM for detailed diagnostic assessment...")
-        response = model.generate_content([prompt])
+        model = ctx.model(prefix=DIAGNOSTIC_PREFIX)
+        ctx.log("DEBUG: Sending prompt to LLM for detailed diagnostic assessment...")
+        response = model.generate_content(prompt.parts)
         generated_assessment_text = response.text.strip()
-        print(f"DEBUG: Received diagnostic assessment (length: {len(generated_assessment_text)})")
+        ctx.log(f"DEBUG: Received diagnostic assessment (length: {len(generated_assessment_text)})")
         if not generated_assessment_text.strip().lower().startswith("## medical explanation"):
             generated_assessment_text = "## Medical Explanation\n\n" + generated_assessment_text
         return generated_assessment_text
     except Exception as e:
-        print(f"ERROR during LLM diagnostic assessment generation: {e}")
+        ctx.log(f"ERROR during LLM diagnostic assessment generation: {e}")
         return "## Medical Explanation\n\n[Error generating diagnostic assessment.]\n\n## Plan Rationale\n\n[Error generating plan rationale.]\n\n## Plan\n\n[Error generating plan.]"
 
 
-def extract_diagnosis_with_llm(diagnostic_assessment_text):
+def extract_diagnosis_with_llm(diagnostic_assessment_text, ctx=None):
     # ... (same as before, relies on the output of generate_diagnostic_assessment_llm)
-    print("DEBUG: Attempting to extract diagnosis from diagnostic_assessment_text...")
+    ctx = ctx or new_pipeline_context()
+    ctx.log("DEBUG: Attempting to extract diagnosis from diagnostic_assessment_text...")
     mld_regex = re.compile(
         r"^\s*\*\*(?:Most\s+Likely\s+Diagnosis|MOST\s+LIKELY\s+DIAGNOSIS):\s*\*\*"
         r"\s*1-\s*(?P<severity>[^,]+(?:,\s*[^,]+)*?)\s*,"
@@ -448,7 +573,7 @@ def extract_diagnosis_with_llm(diagnostic_assessment_text):
             severity = match.group("severity").strip()
             syndrome = match.group("syndrome").strip()
             pathology = match.group("pathology").strip()
-            print(f"DEBUG: Regex MLD parts: Severity='{severity}', Syndrome='{syndrome}', Pathology='{pathology}'")
+            ctx.log(f"DEBUG: Regex MLD parts: Severity='{severity}', Syndrome='{syndrome}', Pathology='{pathology}'")
             if "unknown pathology" not in pathology.lower() and pathology and "unknown" not in pathology.lower():
                 if "alzheimer's disease" in pathology.lower() or "ad" in pathology.lower():
                     if "mci" in severity.lower() or "mild cognitive impairment" in severity.lower():
@@ -462,35 +587,28 @@ def extract_diagnosis_with_llm(diagnostic_assessment_text):
             elif severity and "unknown severity" not in severity.lower():
                 return severity
             else:
-                print(
+                ctx.log(
                     "DEBUG: Regex matched MLD line structure but parts were empty, unsuitable, or only contained terms like 'unknown'.")
                 break
 
-    print("DEBUG: Regex for structured MLD failed or did not yield a clear diagnosis. Falling back to LLM extraction.")
+    ctx.log("DEBUG: Regex for structured MLD failed or did not yield a clear diagnosis. Falling back to LLM extraction.")
+    # Only the "Most Likely Diagnosis" part of the assessment is sent (all of it if that part cannot be found).
+    prompt = build_prompt("primary_diagnosis", [
+        PromptSegment("instructions", DIAGNOSIS_EXTRACTION_INSTRUCTIONS, required=True),
+        PromptSegment("assessment", assessment_excerpt(diagnostic_assessment_text, "primary_diagnosis"),
+                      header="Clinical Assessment Text to Analyze:\n---\n"),
+        PromptSegment("task", "Primary diagnosis:", header="---\n\n", required=True),
+    ], ctx=ctx)
     try:
-        model = GenerativeModel(STABLE_MODEL_NAME)
-        prompt = f"""From the following clinical assessment text, find the section explicitly titled "**Most Likely Diagnosis:**" or "Most Likely Diagnosis:".
-        Extract the single most specific primary diagnosis stated immediately after this title.
-        Prioritize a diagnosis that includes "Alzheimer's Disease" or "Mild Cognitive Impairment due to Alzheimer's Disease" if present and clearly stated as the most likely.
-        If a 3-part diagnosis (Severity, Syndrome, Pathology) is given, extract the most clinically relevant part, usually the Pathology (e.g., "Alzheimer's Disease" from "..., 3- Alzheimer's Disease"). If pathology is "Unknown" but syndrome points to AD, use that.
-        Respond with ONLY the diagnosis name (e.g., "Alzheimer's Disease", "Mild Cognitive Impairment due to Alzheimer's Disease", "Frontotemporal Dementia").
-        Do not include "1-", "2-", "3-", surrounding text, explanations, or the heading "Most Likely Diagnosis:" itself.
-        If this specific section or a clear single diagnosis after the title is not found, or if it says "Leave blank if uncertain" and is blank, respond with "NONE".
-
-        Clinical Assessment Text to Analyze:
-        ---
-        {diagnostic_assessment_text}
-        ---
-
-        Primary diagnosis:"""
-        print("DEBUG: Sending prompt to LLM for diagnosis extraction from assessment...")
-        response = model.generate_content([prompt])
+        model = ctx.model()
+        ctx.log("DEBUG: Sending prompt to LLM for diagnosis extraction from assessment...")
+        response = model.generate_content(prompt.parts)
         extracted_text = response.text.strip()
-        print(f"DEBUG: LLM raw response for diagnosis: '{extracted_text}'")
+        ctx.log(f"DEBUG: LLM raw response for diagnosis: '{extracted_text}'")
         if extracted_text.endswith('.'):
             extracted_text = extracted_text[:-1].strip()
         if not extracted_text or extracted_text.upper() == "NONE" or len(extracted_text) > 150:
-            print(f"DEBUG: LLM indicated no clear primary diagnosis found or response unsuitable: '{extracted_text}'")
+            ctx.log(f"DEBUG: LLM indicated no clear primary diagnosis found or response unsuitable: '{extracted_text}'")
             return None
         else:
             extracted_text = re.sub(r"^\s*\d+-\s*", "", extracted_text).strip()
@@ -502,10 +620,10 @@ def extract_diagnosis_with_llm(diagnostic_assessment_text):
                     extracted_text = "Mild Cognitive Impairment due to Alzheimer's Disease"
                 else:
                     extracted_text = "Alzheimer's Disease"
-            print(f"DEBUG: Extracted diagnosis (LLM fallback): {extracted_text}")
+            ctx.log(f"DEBUG: Extracted diagnosis (LLM fallback): {extracted_text}")
             return extracted_text
     except Exception as e:
-        print(f"ERROR during LLM diagnosis extraction from assessment: {e}")
+        ctx.log(f"ERROR during LLM diagnosis extraction from assessment: {e}")
         return None
 
 
@@ -524,71 +642,30 @@ def is_alzheimers_primary_diagnosis(diagnosis_text):
 
 
 def process_alzheimers_checklist_with_llm(checklist_template_to_fill, background_info, transcription_context,
-                                          user_insights, diagnostic_assessment_text):
-    # ... (Prompt inside uses these distinct parameters)
-    print("DEBUG: Processing Alzheimer's Checklist with LLM (New Exclusion Format)...")
-    full_context = f"""
-    PATIENT DATA:
-    I. BACKGROUND INFORMATION (Prior to this visit):
-    {background_info if background_info else "Not provided."}
-    ---
-    II. CURRENT VISIT TRANSCRIPTION (and other current visit context):
-    {transcription_context if transcription_context else "Not provided."}
-    ---
-    III. USER INSIGHTS (Clinician's additional thoughts, emphasis, potential diagnoses, revisions):
-    {user_insights if user_insights else "Not provided."}
-    ---
-    IV. FULL DIAGNOSTIC ASSESSMENT (includes 'Most Likely Diagnosis', 'Plan', etc.):
-    {diagnostic_assessment_text}
-    """
-    # The prompt for this function (as provided in the previous full script)
-    # should already be structured to take this `full_context`.
-    # I'm re-pasting the prompt here for completeness of this function.
-    prompt = f"""
-    You are tasked with meticulously populating an Alzheimer's Disease Candidate Checklist based on ALL provided patient information and the comprehensive diagnostic assessment.
-    The checklist template is provided below.
-
-    **Instructions for populating the checklist:**
-
-    1.  **Review ALL provided patient data and the full diagnostic assessment (provided in CONTEXT below).**
-    2.  **Analyze INCLUSION CRITERIA first:**
-        *   For each item (1-4) in the `<INCLUSION CRITERIA>` section, determine if the patient meets the criterion based *solely* on the information provided IN THE CONTEXT.
-        *   Replace `***` with specific data if found (e.g., "YES (Age: 72)" or "NO (MMSE: 15)" or "UNKNOWN"). For item 3 (Biomarker), if PET/CSF data is mentioned, state result (e.g., "YES (Amyloid PET positive for beta Amyloid)" or "NO (CSF normal for beta Amyloid)" or "UNKNOWN (No biomarker data for beta Amyloid)").
-        *   For "Overall Inclusion Criteria Met:", explicitly state "YES" if all items 1-4 are definitively met. State "NO" if any item 1-4 is definitively not met. State "UNCERTAIN" if one or more items are unknown but others are met (especially if AD is the primary diagnosis).
-
-    3.  **If "Overall Inclusion Criteria Met:" is "YES" or "UNCERTAIN" (and AD is the primary suspected diagnosis from the assessment):**
-        *   Proceed to populate the `<OTHER DATA>` section. Replace `***` with specific values if found from CONTEXT. For subsection scores or lab results, list them if available or state "Not available" or "Not specified". For APOE, state genotype and then the ARIA risk on the next line if applicable based on the genotype shown in the template. If APOE is not available, state "Not available" or "To be ordered".
-        *   Proceed to populate the `<EXCLUSION CRITERIA>` section. For each "No / YES / UNKNOWN" item:
-            *   Carefully evaluate the patient data IN THE CONTEXT against the criterion.
-            *   Replace "No / YES / UNKNOWN" with **ONLY ONE** of these three options: "No", "YES", or "UNKNOWN".
-            *   Fill in any other `***` placeholders (like Actual Age, GDS Score, BMI) with data if available from CONTEXT, otherwise leave them as `***` or state "Not available".
-        *   For "Overall Exclusion Criteria Summary:", provide a concise statement like: "No exclusionary criteria definitively met based on available information.", or "Exclusionary criterion X met.", or "Insufficient information to rule out all potential exclusions (see UNKNOWN items above)."
-
-    4.  **If "Overall Inclusion Criteria Met:" is "NO":**
-        *   Populate the `<INCLUSION CRITERIA>` section, clearly indicating why they are not met (e.g., "NO (Age: 45)").
-        *   For the `<OTHER DATA>` and `<EXCLUSION CRITERIA>` sections, replace their entire content with a single line: "NOT APPLICABLE - Inclusion criteria not met."
-
-    5.  **General Formatting:**
-        *   Retain the exact structure and headings of the template.
-        *   Be precise. Do not infer information. Use only the provided text from CONTEXT.
-
-    **CONTEXT (Patient Data and Full Diagnostic Assessment):**
-    ---
-    {full_context}
-    ---
-
-    **ALZHEIMER'S DISEASE CANDIDATE CHECKLIST TEMPLATE TO POPULATE:**
-    ---
-    {checklist_template_to_fill}
-    ---
-
-    Populate the checklist now:
-    """
+                                          user_insights, diagnostic_assessment_text, prefilled_facts_text=None,
+                                          ctx=None):
+    # prefilled_facts_text: items already filled in `checklist_template_to_fill` by checklist_extractor, with sources.
+    ctx = ctx or new_pipeline_context()
+    ctx.log("DEBUG: Processing Alzheimer's Checklist with LLM (New Exclusion Format)...")
+    prefilled_instructions = ""
+    if prefilled_facts_text:
+        prefilled_instructions = f"""**PRE-FILLED ITEMS:** The following values were extracted directly from the patient data and are already
+filled into the template below. Keep those entries exactly as written; resolve only the remaining `***`
+placeholders and "No / YES / UNKNOWN" selections.
+{prefilled_facts_text}"""
+    prompt = build_prompt("checklist", [
+        PromptSegment("prefilled_items", prefilled_instructions, required=True),
+        *_patient_data_segments(background_info, transcription_context, user_insights, diagnostic_assessment_text,
+                                "checklist"),
+        PromptSegment("template", checklist_template_to_fill, required=True,
+                      header="---\n\n**ALZHEIMER'S DISEASE CANDIDATE CHECKLIST TEMPLATE TO POPULATE:**\n---\n"),
+        PromptSegment("task", "Populate the checklist now:", header="---\n\n", required=True),
+    ], ctx=ctx, prefix=CHECKLIST_PREFIX)
     try:
-        model = GenerativeModel(STABLE_MODEL_NAME)
-        response = model.generate_content([prompt])
+        model = ctx.model(prefix=CHECKLIST_PREFIX)
+        response = model.generate_content(prompt.parts)
         processed_checklist = response.text.strip()
-        print("DEBUG: Received processed Alzheimer's checklist from LLM (New Exclusion Format).")
+        ctx.log("DEBUG: Received processed Alzheimer's checklist from LLM (New Exclusion Format).")
 
         checklist_start_index = processed_checklist.find("--- Alzheimer's Disease Candidate Checklist ---")
         if checklist_start_index != -1:
@@ -597,73 +674,42 @@ def process_alzheimers_checklist_with_llm(checklist_template_to_fill, background
             processed_checklist = "--- Alzheimer's Disease Candidate Checklist ---\n" + processed_checklist + "\n--- (End Checklist Template) ---"
         return processed_checklist
     except Exception as e:
-        print(f"ERROR during LLM checklist processing: {e}")
+        ctx.log(f"ERROR during LLM checklist processing: {e}")
         return checklist_template_to_fill
 
 
 def generate_patient_specific_criteria_elaboration(primary_diagnosis, background_info, transcription_context,
-                                                   user_insights, diagnostic_assessment_text):
-    # ... (Prompt inside uses these distinct parameters)
+                                                   user_insights, diagnostic_assessment_text, ctx=None):
+    ctx = ctx or new_pipeline_context()
     if not is_alzheimers_primary_diagnosis(primary_diagnosis):
         return ""
 
-    print(f"DEBUG: Generating patient-specific criteria elaboration for Dx: {primary_diagnosis}...")
-    full_context_for_elaboration = f"""
-    PATIENT DATA:
-    I. BACKGROUND INFORMATION (Prior to this visit):
-    {background_info if background_info else "Not provided."}
-    ---
-    II. CURRENT VISIT TRANSCRIPTION (and other current visit context):
-    {transcription_context if transcription_context else "Not provided."}
-    ---
-    III. USER INSIGHTS (Clinician's additional thoughts, emphasis, potential diagnoses, revisions):
-    {user_insights if user_insights else "Not provided."}
-    ---
-    IV. FULL DIAGNOSTIC ASSESSMENT (includes 'Most Likely Diagnosis', 'Plan', etc.):
-    {diagnostic_assessment_text}
-    """
-    # The prompt for this function (as provided in the previous full script)
-    # should already be structured to take this `full_context_for_elaboration`.
-    # I'm re-pasting the prompt here for completeness of this function.
-    prompt = f"""
-    The patient's primary diagnosis appears to be '{primary_diagnosis}'.
-    Based on ALL the provided patient data and the full diagnostic assessment (see CONTEXT below), provide a section titled "### Patient-Specific Elaboration of Diagnostic Criteria for Alzheimer's Disease".
-
-    Instructions:
-    1.  List the key diagnostic criteria for Alzheimer's Disease (e.g., from NIA-AA or DSM-5 for Major/Mild Neurocognitive Disorder due to AD). You can choose a standard set of criteria (e.g., NIA-AA for probable AD).
-    2.  For EACH key criterion, briefly explain the criterion itself in one sentence.
-    3.  Then, for EACH criterion, analyze the provided patient information IN THE CONTEXT (history, cognitive scores, imaging, biomarkers if mentioned, symptoms) and explicitly state how the patient's specific findings either SUPPORT or DO NOT SUPPORT (or if information is LACKING for) that particular criterion. Be specific and quote or refer to data points from the context.
-    4.  Use bullet points for each main criterion. Under each main criterion, use sub-bullets for its explanation and then for the patient-specific analysis.
-    5.  Maintain a clinical and objective tone.
-
-    Example for one criterion:
-    *   **Insidious onset and gradual progression of cognitive impairment:**
-        *   *Explanation:* This criterion means the cognitive symptoms started slowly and have worsened steadily over time, rather than appearing abruptly or having a fluctuating course.
-        *   *Patient Specifics:* The patient's family reports a decline "over the past two years" with "worsening memory and word-finding" (SUPPORTS gradual progression). The provided history does not mention any sudden neurological events that would suggest an acute onset (SUPPORTS insidious onset).
-
-    CONTEXT (Patient Data and Full Diagnostic Assessment):
-    ---
-    {full_context_for_elaboration}
-    ---
-
-    Generate the "### Patient-Specific Elaboration of Diagnostic Criteria for Alzheimer's Disease" section now:
-    """
+    ctx.log(f"DEBUG: Generating patient-specific criteria elaboration for Dx: {primary_diagnosis}...")
+    prompt = build_prompt("elaboration", [
+        PromptSegment("diagnosis", f"The patient's primary diagnosis appears to be '{primary_diagnosis}'.",
+                      required=True),
+        *_patient_data_segments(background_info, transcription_context, user_insights, diagnostic_assessment_text,
+                                "elaboration"),
+        PromptSegment("task", 'Generate the "### Patient-Specific Elaboration of Diagnostic Criteria for '
+                              'Alzheimer\'s Disease" section now:', header="---\n\n", required=True),
+    ], ctx=ctx, prefix=ELABORATION_PREFIX)
     try:
-        model = GenerativeModel(STABLE_MODEL_NAME)
-        response = model.generate_content([prompt])
+        model = ctx.model(prefix=ELABORATION_PREFIX)
+        response = model.generate_content(prompt.parts)
         elaboration_text = response.text.strip()
-        print(f"DEBUG: Received 'Patient-Specific Criteria Elaboration' from Gemini.")
+        ctx.log(f"DEBUG: Received 'Patient-Specific Criteria Elaboration' from Gemini.")
         if not elaboration_text.lower().startswith("### patient-specific elaboration"):
             elaboration_text = "### Patient-Specific Elaboration of Diagnostic Criteria for Alzheimer's Disease\n" + elaboration_text
         return elaboration_text
     except Exception as e:
-        print(f"ERROR during patient-specific criteria elaboration generation: {e}")
+        ctx.log(f"ERROR during patient-specific criteria elaboration generation: {e}")
         return "### Patient-Specific Elaboration of Diagnostic Criteria for Alzheimer's Disease\n\n[Error generating this section.]"
 
 
-def generate_missing_info_summary(note_text_to_analyze):
+def generate_missing_info_summary(note_text_to_analyze, ctx=None):
     # ... (same as before)
-    print("DEBUG: Generating Summary of Missing Information from combined note...")
+    ctx = ctx or new_pipeline_context()
+    ctx.log("DEBUG: Generating Summary of Missing Information from combined note...")
     missing_sections = []
     pattern = r"^\s*(?:[#\*]+\s*)?(.*?)(?:\s*:\s*)?[\r\n]+\s*NO INFORMATION FOUND"
     matches = re.findall(pattern, note_text_to_analyze, re.MULTILINE | re.IGNORECASE)
@@ -695,7 +741,7 @@ def generate_missing_info_summary(note_text_to_analyze):
                     if '\n' not in clean_header and len(clean_header) < 100:
                         missing_sections.append(clean_header)
                     else:
-                        print(
+                        ctx.log(
                             f"DEBUG: Skipped potential multi-line/long header capture for missing info: '{clean_header[:100]}...'")
 
     summary_text = "## Summary of Missing Information\n\n"
@@ -704,37 +750,234 @@ def generate_missing_info_summary(note_text_to_analyze):
         summary_text += "The following sections were marked 'NO INFORMATION FOUND' in the initial note generation or specific data points were not available in the provided context:\n"
         for section in unique_missing_sections:
             summary_text += f"* {section}\n"
-        print(f"DEBUG: Found missing sections for summary: {unique_missing_sections}")
+        ctx.log(f"DEBUG: Found missing sections for summary: {unique_missing_sections}")
     else:
         summary_text += "All relevant sections in the main note appeared to contain information or did not match 'NO INFORMATION FOUND' criteria for this summary.\n"
-        print(
+        ctx.log(
             "DEBUG: No specific 'NO INFORMATION FOUND' markers matched for summary, or all matched sections were excluded.")
 
     summary_text += "\nFor the Alzheimer's Checklist (if included), please review it directly for any '***' placeholders or items marked 'UNKNOWN' indicating data not found in the provided context for those specific checklist items."
     return summary_text.strip()
 
 
-def generate_full_note(background_info_text, additional_info_text, transcription_text, revised_info_text):
+def _patient_context_for_stage(stage, input_index, background_text, transcription_text, user_insights_text,
+                               needs=None, ctx=None):
+    """
+    Returns the (background, transcription, user insights) texts a stage should see:
+    the passages retrieved for that stage when an index is given, otherwise the full texts.
+    `needs` overrides the stage's declared information needs (e.g. after some facts were already resolved).
+    """
+    ctx = ctx or new_pipeline_context()
+    if input_index is None:
+        return background_text, transcription_text, user_insights_text
+    header, section_texts = input_index.context_for_stage(stage, needs=needs)
+    ctx.log(f"DEBUG: Retrieval context for '{stage}': {header}")
+    return (f"{header}\n\n{section_texts['background']}", section_texts['transcription'],
+            section_texts['user_insights'])
+
+
+def build_literature_summary_section(diagnosis, note_ref=None, ctx=None):
+    """
+    The "### Recent Literature Summary" section for a diagnosis: the stored offline digest when there is one,
+    otherwise a live PubMed search and Gemini summary.
+    """
+    ctx = ctx or new_pipeline_context()
+    stored_literature_digest = lookup_literature_digest(diagnosis)
+    if stored_literature_digest:
+        # Pre-built offline by `python literature_digest_store.py rebuild`; no PubMed or model call needed.
+        ctx.log(f"DEBUG: Using stored literature digest for '{diagnosis}' "
+                f"(store {stored_literature_digest['store_version']}, entry {stored_literature_digest['entry_version']}).")
+        record_digest_use(diagnosis, stored_literature_digest, note_ref=note_ref)
+        return stored_literature_digest["summary"]
+
+    ctx.log(f"DEBUG: No stored literature digest; proceeding with live PubMed search for: {diagnosis}")
+    record_digest_miss(diagnosis)
+    abstracts = fetch_recent_guidelines(diagnosis, ctx=ctx)
+    if abstracts:
+        return summarize_literature_with_gemini(abstracts, diagnosis, ctx=ctx)
+    return f"### Recent Literature Summary\n\nNo recent relevant guidelines found on PubMed for '{diagnosis}'."
+
+
+# Upstream stages of each checkpointed stage. On resume, a stored output is reused only if none of
+# its upstream stages had to be executed again in this attempt.
+STAGE_DEPENDENCIES = {
+    "note_body": (),
+    "diagnostic_assessment": (),
+    "primary_diagnosis": ("diagnostic_assessment",),
+    "checklist": ("note_body", "diagnostic_assessment", "primary_diagnosis"),
+    "elaboration": ("diagnostic_assessment", "primary_diagnosis"),
+    "literature": ("primary_diagnosis",),
+}
+
+
+class _StageCheckpoints:
+    """Per-run stage outputs: reused when resuming, saved to the run store as each stage succeeds."""
+
+    def __init__(self, run_id, stored_stages, ctx):
+        self.run_id = run_id
+        self.stored_stages = stored_stages
+        self.ctx = ctx  # Logs through the run's context, so lines are tagged with the run ID.
+        self.executed = set()
+        self.failed_stages = []
+        self.outputs = {}  # Output of every stage of this attempt, reused or executed (archived at the end).
+
+    def run(self, stage, compute, failed=None):
+        """Returns the stage output, from the checkpoint if still valid, otherwise by calling compute()."""
+        if stage in self.stored_stages and not any(dep in self.executed for dep in STAGE_DEPENDENCIES[stage]):
+            self.ctx.log(f"DEBUG: Reusing checkpointed '{stage}' output.")
+            self.outputs[stage] = self.stored_stages[stage]
+            return self.stored_stages[stage]
+        with profile_stage(stage):
+            output = compute()
+        self.executed.add(stage)
+        self.outputs[stage] = output
+        if failed is not None and failed(output):
+            self.failed_stages.append(stage)
+            self.ctx.log(f"DEBUG: Stage '{stage}' failed; it will be re-executed on resume.")
+        else:
+            self.save(stage, output)
+        return output
+
+    def record(self, name, output):
+        """Archives `output` with the note without checkpointing it (derived data that is cheap to recompute)."""
+        self.outputs[name] = output
+
+    def save(self, stage, output):
+        if not self.run_id:
+            return
+        try:
+            run_store.save_stage_output(self.run_id, stage, output)
+        except Exception as e:
+            self.ctx.log(f"WARNING: Could not checkpoint stage '{stage}': {e}")
+
+    def archive(self, final_note, primary_diagnosis, patient_id=None):
+        """Appends the completed run to the note archive (see note_archive)."""
+        if not self.run_id:
+            return
+        try:
+            with profile_stage("note_archive"):
+                note_archive.archive_note(self.run_id, final_note, self.outputs,
+                                          primary_diagnosis=primary_diagnosis, patient_id=patient_id)
+        except Exception as e:
+            self.ctx.log(f"WARNING: Could not archive the note: {e}")
+
+    def set_status(self, status):
+        if not self.run_id:
+            return
+        try:
+            run_store.set_run_status(self.run_id, status)
+        except Exception as e:
+            self.ctx.log(f"WARNING: Could not update the run status: {e}")
+
+
+def _record_patient_visit(patient_id, run_id, background_info_text, patient_background, visit_texts,
+                          primary_diagnosis, diagnostic_assessment_text, final_note, ctx, document_hashes=None):
+    """Adds the completed run's facts to the patient fact store; failures only cost the reuse at the next visit."""
+    try:
+        with profile_stage("patient_facts"):
+            patient_fact_store.record_visit(
+                patient_id, run_id, background_info_text, patient_background.new_document_hashes, visit_texts,
+                ctx.generate_text, STABLE_MODEL_NAME, primary_diagnosis=primary_diagnosis,
+                assessment=diagnostic_assessment_text, final_note=final_note, document_hashes=document_hashes)
+    except Exception as e:
+        ctx.log(f"WARNING: Could not update the fact store for patient {patient_id}: {e}")
+
+
+def resume_full_note(run_id, context=None):
+    """
+    Resumes a stored run: completed stages are reused and only failed or missing stages are executed.
+    Returns the note text, or an "ERROR: ..." string if the run is unknown or has been purged.
+    """
+    stored_run = run_store.load_run(run_id)
+    if stored_run is None:
+        return f"ERROR: Run {run_id} was not found (unknown ID or purged after the retention period)."
+    ctx = context or new_pipeline_context(run_id=run_id)
+    if stored_run["status"] == "completed" and "final_note" in stored_run["stages"]:
+        ctx.log("DEBUG: Run already completed; returning its stored note.")
+        return stored_run["stages"]["final_note"]
+    ctx.log(f"DEBUG: Resuming run with {len(stored_run['stages'])} checkpointed stages.")
+    return generate_full_note(run_id=run_id, context=ctx, **stored_run["inputs"])
+
+
+def generate_full_note(background_info_text, additional_info_text, transcription_text, revised_info_text,
+                       run_id=None, context=None, patient_id=None, background_document_hashes=None):
     """
     Main function to generate the complete neurology note.
     Takes text from the four input categories.
+    run_id: optional; when given, every stage output is checkpointed in the run store under this ID
+    (and already-checkpointed stages of that run are reused), so a failed run can be resumed.
+    context: optional PipelineContext (e.g. with a deadline); a fresh one is created for the run otherwise.
+    patient_id: optional pseudonymous ID; background documents processed at earlier visits of this patient are
+    replaced by their stored facts, and a completed run adds its facts to the store (see patient_fact_store).
+    background_document_hashes: patient_fact_store.uploaded_document_hashes of the background documents before
+    de-identification, so documents are recognized across visits whatever surrogates they were given.
+    Safe to call concurrently from several threads.
     """
-    print("DEBUG: Core note processing started.")
-    # Vertex AI should ideally be initialized once when the Flask app starts.
-    # If this function is called multiple times per app run, initializing here is okay too.
-    # For a CLI tool, initializing here is standard.
+    ctx = context or new_pipeline_context(run_id=run_id)
+    ctx.log("DEBUG: Core note processing started.")
+    stored_stages = {}
+    if run_id:
+        try:
+            stored_run = run_store.load_run(run_id)
+            if stored_run is None:
+                run_store.create_run(run_id, {
+                    "background_info_text": background_info_text, "additional_info_text": additional_info_text,
+                    "transcription_text": transcription_text, "revised_info_text": revised_info_text,
+                    "patient_id": patient_id, "background_document_hashes": background_document_hashes,
+                })
+            else:
+                stored_stages = stored_run["stages"]
+        except Exception as e:
+            ctx.log(f"WARNING: Run store unavailable for run {run_id}; continuing without checkpoints: {e}")
+    checkpoints = _StageCheckpoints(run_id, stored_stages, ctx)
+    # Initializes Vertex AI on the first run of the process only.
     try:
-        initialize_vertex_ai()
+        with profile_stage("vertex_init"):
+            initialize_vertex_ai()
     except Exception as e_init:
-        print(f"ERROR: Vertex AI Initialization Failed in generate_full_note: {e_init}")
+        ctx.log(f"ERROR: Vertex AI Initialization Failed in generate_full_note: {e_init}")
         return f"ERROR: Vertex AI Initialization Failed: {e_init}"
 
     # --- Prepare context for LLMs ---
-    gnb_historical_text = f"BACKGROUND INFORMATION (Prior to this visit):\n{background_info_text if background_info_text else 'Not provided.'}"
-    gnb_current_visit_context = f"CURRENT VISIT CONTEXT (Includes transcription if available, and reason for visit):\n{transcription_text if transcription_text else 'Not provided.'}\n"
-    if not transcription_text and not (
-            "reason for visit" in gnb_current_visit_context.lower()):  # Add a placeholder if no transcription
-        gnb_current_visit_context += "Primary reason for visit to be inferred from other context or user insights."
+    # Oversized outside records are replaced by a structured digest in every downstream prompt.
+    # For a known patient, documents processed at earlier visits are replaced by the stored facts.
+    patient_background = None
+    with profile_stage("background_digest"):
+        if patient_id:
+            try:
+                patient_background = patient_fact_store.prepare_patient_background(
+                    patient_id, background_info_text, ctx.generate_text, STABLE_MODEL_NAME, run_id=run_id,
+                    document_hashes=background_document_hashes)
+            except Exception as e:
+                ctx.log(f"WARNING: Patient fact store unavailable for patient {patient_id}; "
+                        f"using the full background: {e}")
+        if patient_background is not None:
+            background_context_text = patient_background.context_text
+        else:
+            background_context_text = prepare_background_for_prompts(background_info_text, ctx.generate_text,
+                                                                     STABLE_MODEL_NAME)
+    if background_context_text is not background_info_text:
+        ctx.log(f"DEBUG: Using background digest ({len(background_context_text)} chars) "
+                f"instead of raw background ({len(background_info_text)} chars).")
+
+    # Fillers, timestamps, repeated sentences and per-line speaker labels are compacted out of the transcription
+    # before it is copied into the prompts (see transcript_compaction); the checklist prefill reads the raw text.
+    visit_transcript_text = transcription_text
+    if TRANSCRIPT_COMPACTION_ENABLED and transcription_text:
+        with profile_stage("transcript_compaction"):
+            visit_transcript_text, compaction_report = compact_transcript(transcription_text)
+        ctx.log(f"DEBUG: Transcript compaction: {describe_report(compaction_report)}.")
+        ctx.count("transcript_tokens_saved", compaction_report.raw_tokens - compaction_report.compact_tokens)
+        checkpoints.record("transcript_compaction", compaction_report._asdict())
+        if TRANSCRIPT_KEEP_RAW:
+            checkpoints.record("transcription_raw", transcription_text)
+
+    # Section headers are added by the stage prompts (see prompt_builder); these are the bare section texts.
+    gnb_historical_text = background_context_text
+    gnb_current_visit_context = visit_transcript_text
+    if not visit_transcript_text:  # Add a placeholder if no transcription
+        gnb_current_visit_context = ("Not provided.\n"
+                                     "Primary reason for visit to be inferred from other context or user insights.")
 
     gnb_user_insights = (
         f"USER'S ADDITIONAL INFORMATION/EMPHASIS (Clinician's thoughts, potential diagnoses, etc.):\n"
@@ -743,46 +986,58 @@ def generate_full_note(background_info_text, additional_info_text, transcription
         f"{revised_info_text if revised_info_text else 'Not provided.'}"
     )
 
-    print(f"\nDEBUG: Generating main note body...")
-    main_note_body_content = generate_neurology_note_body(
-        gnb_historical_text,
-        gnb_current_visit_context,
-        gnb_user_insights
+    ctx.log(f"\nDEBUG: Generating main note body...")
+    main_note_body_content = checkpoints.run(
+        "note_body",
+        lambda: generate_neurology_note_body(gnb_historical_text, gnb_current_visit_context, gnb_user_insights,
+                                             ctx=ctx),
+        failed=lambda output: "Error generating main note body:" in output
     )
 
     if "Error generating main note body:" in main_note_body_content:
+        checkpoints.set_status("failed")
         return f"FAILED TO GENERATE MAIN NOTE BODY: {main_note_body_content}"
-    print("--- END DEBUG: Main Note Body content generated ---")
+    ctx.log("--- END DEBUG: Main Note Body content generated ---")
 
-    diag_historical_context = (
-        f"I. BACKGROUND INFORMATION (Prior to this visit):\n"
-        f"{background_info_text if background_info_text else 'Not provided.'}\n\n"
-        f"II. CURRENT VISIT TRANSCRIPTION:\n"
-        f"{transcription_text if transcription_text else 'Not provided.'}"
-    )
-    diag_user_insights_and_revisions = (
-        f"III. USER'S ADDITIONAL INFORMATION/EMPHASIS (Clinician's thoughts, etc.):\n"
-        f"{additional_info_text if additional_info_text else 'Not provided.'}\n\n"
-        f"IV. USER'S REVISED INFORMATION/FURTHER COMMENTS:\n"
-        f"{revised_info_text if revised_info_text else 'Not provided.'}"
-    )
+    diag_historical_context = background_context_text
+    diag_user_insights_and_revisions = gnb_user_insights
     diag_reason_for_visit = "Comprehensive neurological assessment based on all provided information."
 
-    print("\nDEBUG: Running diagnostic assessment...")
-    diagnostic_assessment_text = generate_diagnostic_assessment_llm(
-        diag_historical_context,
-        diag_reason_for_visit,
-        diag_user_insights_and_revisions
+    ctx.log("\nDEBUG: Running diagnostic assessment...")
+    diagnostic_assessment_text = checkpoints.run(
+        "diagnostic_assessment",
+        lambda: generate_diagnostic_assessment_llm(diag_historical_context, diag_reason_for_visit,
+                                                   diag_user_insights_and_revisions,
+                                                   diag_transcription=visit_transcript_text, ctx=ctx),
+        failed=lambda output: "[Error generating diagnostic assessment.]" in output
     )
 
     if "Error generating diagnostic assessment:" in diagnostic_assessment_text:
+        checkpoints.set_status("failed")
         return f"FAILED TO GENERATE DIAGNOSTIC ASSESSMENT: {diagnostic_assessment_text}"
-    print("--- END DEBUG: Diagnostic Assessment content generated ---")
+    ctx.log("--- END DEBUG: Diagnostic Assessment content generated ---")
 
     extracted_primary_diagnosis = None
     if diagnostic_assessment_text and "Error generating diagnostic assessment:" not in diagnostic_assessment_text:
-        extracted_primary_diagnosis = extract_diagnosis_with_llm(diagnostic_assessment_text)
-    print(f"DEBUG: Final extracted_primary_diagnosis for downstream tasks: '{extracted_primary_diagnosis}'")
+        extracted_primary_diagnosis = checkpoints.run(
+            "primary_diagnosis",
+            lambda: extract_diagnosis_with_llm(diagnostic_assessment_text, ctx=ctx)
+        )
+    ctx.log(f"DEBUG: Final extracted_primary_diagnosis for downstream tasks: '{extracted_primary_diagnosis}'")
+
+    # The checklist and elaboration stages only need specific facts; they get retrieved passages
+    # from a per-request index instead of the full inputs (NOTE_RETRIEVAL_CONTEXT=0 disables this).
+    # The literature stage already receives only the extracted diagnosis.
+    user_insights_text = f"Additional Info:\n{additional_info_text}\n\nRevised Info:\n{revised_info_text}"
+    input_index = None
+    if RETRIEVAL_CONTEXT_ENABLED and extracted_primary_diagnosis and is_alzheimers_primary_diagnosis(
+            extracted_primary_diagnosis):
+        with profile_stage("retrieval_index"):
+            input_index = InputRetrievalIndex({
+                "background": background_context_text,
+                "transcription": visit_transcript_text,
+                "user_insights": user_insights_text,
+            })
 
     final_alz_checklist_text = ""
     checklist_marker_in_main_note = "--- Alzheimer's Disease Candidate Checklist ---"
@@ -799,42 +1054,78 @@ def generate_full_note(background_info_text, additional_info_text, transcription
             actual_template_block_end = raw_template_end_index + len(raw_template_end_marker)
             part_after_template = main_note_body_content[actual_template_block_end:]
             main_note_body_content = (part_before_template.strip() + "\n\n" + part_after_template.strip()).strip()
-            print(
+            ctx.log(
                 "DEBUG: Raw Alzheimer's checklist template was initially present and has been removed pending processing.")
         else:
-            print(
+            ctx.log(
                 "DEBUG: Checklist start marker found, but end marker missing in main_note_body_content. Raw template may not be fully formed or removed correctly.")
             raw_checklist_present_in_main_note = False
 
     if raw_checklist_present_in_main_note and extracted_primary_diagnosis and is_alzheimers_primary_diagnosis(
             extracted_primary_diagnosis):
-        print(
+        ctx.log(
             f"DEBUG: Alzheimer's is considered a primary diagnosis ('{extracted_primary_diagnosis}'). Processing checklist.")
-        final_alz_checklist_text = process_alzheimers_checklist_with_llm(
-            ALZHEIMERS_CHECKLIST_TEMPLATE_FOR_PROCESSING,
-            background_info_text,
-            transcription_text,
-            f"Additional Info:\n{additional_info_text}\n\nRevised Info:\n{revised_info_text}",
-            diagnostic_assessment_text
-        )
+        # Scores, labs, age, BMI, APOE and anticoagulants are filled deterministically from the raw inputs;
+        # the LLM only resolves what is left, and is skipped when nothing is.
+        with profile_stage("checklist_prefill"):
+            checklist_facts = extract_checklist_facts([
+                ("background", background_info_text), ("transcription", transcription_text),
+                ("additional info", additional_info_text), ("revised info", revised_info_text),
+            ])
+            prefilled_checklist, used_checklist_facts = prefill_checklist(
+                ALZHEIMERS_CHECKLIST_TEMPLATE_FOR_PROCESSING, checklist_facts)
+            del checklist_facts  # Every candidate fact with its source excerpt; only the used ones are kept.
+        unresolved_checklist_items = count_unresolved_items(prefilled_checklist)
+        ctx.log(f"DEBUG: Checklist prefill applied {len(used_checklist_facts)} extracted facts; "
+                f"{unresolved_checklist_items} items left for the LLM.")
+        if unresolved_checklist_items == 0:
+            final_alz_checklist_text = prefilled_checklist
+        else:
+            resolved_needs = {CHECKLIST_FACT_NEEDS[fact.name] for fact in used_checklist_facts
+                              if fact.name in CHECKLIST_FACT_NEEDS}
+            checklist_background, checklist_transcription, checklist_insights = _patient_context_for_stage(
+                "checklist", input_index, background_context_text, visit_transcript_text, user_insights_text,
+                needs=[need for need in STAGE_INFORMATION_NEEDS["checklist"] if need not in resolved_needs], ctx=ctx)
+            final_alz_checklist_text = checkpoints.run(
+                "checklist",
+                lambda: process_alzheimers_checklist_with_llm(
+                    prefilled_checklist,
+                    checklist_background,
+                    checklist_transcription,
+                    checklist_insights,
+                    diagnostic_assessment_text,
+                    prefilled_facts_text=describe_extracted_facts(used_checklist_facts),
+                    ctx=ctx
+                ),
+                failed=lambda output: output == prefilled_checklist  # The LLM call failed and returned its input
+            )
     elif raw_checklist_present_in_main_note:
-        print(
+        ctx.log(
             f"DEBUG: Checklist template was present in initial note, but AD not confirmed as primary by detailed assessment ('{extracted_primary_diagnosis}'). Checklist will be omitted.")
     else:
-        print(
+        ctx.log(
             "DEBUG: Alzheimer's checklist template was not included by the initial LLM, or AD is not primary. Checklist will be omitted.")
 
     patient_criteria_elaboration_text = ""
     generic_criteria_header = "### Supporting Criteria from Diagnostic Algorithm"
 
     if extracted_primary_diagnosis and is_alzheimers_primary_diagnosis(extracted_primary_diagnosis):
-        patient_criteria_elaboration_text = generate_patient_specific_criteria_elaboration(
-            extracted_primary_diagnosis,
-            background_info_text,
-            transcription_text,
-            f"Additional Info:\n{additional_info_text}\n\nRevised Info:\n{revised_info_text}",
-            diagnostic_assessment_text
+        elaboration_background, elaboration_transcription, elaboration_insights = _patient_context_for_stage(
+            "elaboration", input_index, background_context_text, visit_transcript_text, user_insights_text,
+            ctx=ctx)
+        patient_criteria_elaboration_text = checkpoints.run(
+            "elaboration",
+            lambda: generate_patient_specific_criteria_elaboration(
+                extracted_primary_diagnosis,
+                elaboration_background,
+                elaboration_transcription,
+                elaboration_insights,
+                diagnostic_assessment_text,
+                ctx=ctx
+            ),
+            failed=lambda output: "[Error generating this section.]" in output
         )
+    input_index = None  # The retrieval index holds chunked copies of the inputs; no later stage uses it.
 
     placeholder_med_exp = "[YOUR SEPARATELY GENERATED DETAILED MEDICAL EXPLANATION AND PLAN WILL BE INSERTED HERE BY THE SCRIPT]"
     note_with_medical_explanation = main_note_body_content
@@ -842,9 +1133,9 @@ def generate_full_note(background_info_text, additional_info_text, transcription
     if placeholder_med_exp in note_with_medical_explanation:
         note_with_medical_explanation = note_with_medical_explanation.replace(placeholder_med_exp,
                                                                               diagnostic_assessment_text.strip())
-        print(f"DEBUG: Successfully replaced '{placeholder_med_exp}'.")
+        ctx.log(f"DEBUG: Successfully replaced '{placeholder_med_exp}'.")
     else:
-        print(f"DEBUG: Placeholder '{placeholder_med_exp}' not found. Appending diagnostic assessment.")
+        ctx.log(f"DEBUG: Placeholder '{placeholder_med_exp}' not found. Appending diagnostic assessment.")
         note_with_medical_explanation = note_with_medical_explanation.strip() + "\n\n" + diagnostic_assessment_text.strip()
 
     current_note_assembly = note_with_medical_explanation.strip()
@@ -869,35 +1160,49 @@ def generate_full_note(background_info_text, additional_info_text, transcription
             part_before_generic = current_note_assembly[:idx_generic_criteria]
             part_after_generic = current_note_assembly[end_idx_generic:]
             current_note_assembly = part_before_generic.strip() + "\n\n" + patient_criteria_elaboration_text.strip() + "\n\n" + part_after_generic.strip()
-            print("DEBUG: Replaced generic 'Supporting Criteria' with patient-specific AD criteria elaboration.")
+            ctx.log("DEBUG: Replaced generic 'Supporting Criteria' with patient-specific AD criteria elaboration.")
         else:
             current_note_assembly += "\n\n" + patient_criteria_elaboration_text.strip()
-            print("DEBUG: Added patient-specific AD criteria elaboration (generic header not found or empty).")
+            ctx.log("DEBUG: Added patient-specific AD criteria elaboration (generic header not found or empty).")
     elif idx_generic_criteria != -1 and generic_criteria_header:
-        print("DEBUG: Kept generic 'Supporting Criteria' as AD not primary or specific elaboration not generated.")
+        ctx.log("DEBUG: Kept generic 'Supporting Criteria' as AD not primary or specific elaboration not generated.")
 
     if final_alz_checklist_text:
         current_note_assembly += "\n\n" + final_alz_checklist_text.strip()
-        print("DEBUG: Added processed Alzheimer's checklist.")
+        ctx.log("DEBUG: Added processed Alzheimer's checklist.")
 
     literature_summary_section_text = "### Recent Literature Summary\n\nNO INFORMATION FOUND (Diagnosis not extracted or PubMed search failed)"
     if extracted_primary_diagnosis:
-        print(f"DEBUG: Proceeding with PubMed search for: {extracted_primary_diagnosis}")
-        abstracts = fetch_recent_guidelines(extracted_primary_diagnosis)
-        if abstracts:
-            literature_summary_section_text = summarize_literature_with_gemini(abstracts, extracted_primary_diagnosis)
-        else:
-            literature_summary_section_text = f"### Recent Literature Summary\n\nNo recent relevant guidelines found on PubMed for '{extracted_primary_diagnosis}'."
+        literature_summary_section_text = checkpoints.run(
+            "literature",
+            lambda: build_literature_summary_section(extracted_primary_diagnosis, note_ref=run_id, ctx=ctx),
+            failed=lambda output: "Error summarizing literature." in output
+        )
     else:
-        print("DEBUG: Skipping PubMed search as no diagnosis was extracted for literature summary.")
+        ctx.log("DEBUG: Skipping PubMed search as no diagnosis was extracted for literature summary.")
 
     note_with_literature = current_note_assembly.strip() + "\n\n" + literature_summary_section_text.strip()
 
-    missing_info_summary_text = generate_missing_info_summary(note_with_literature)
+    with profile_stage("missing_info"):
+        missing_info_summary_text = generate_missing_info_summary(note_with_literature, ctx=ctx)
 
     final_note = note_with_literature.strip() + \
                  "\n\n" + SIGNATURE.strip() + \
                  "\n\n" + missing_info_summary_text.strip()
 
-    print("DEBUG: Core note processing finished.")
+    if checkpoints.failed_stages:
+        # The note is still returned with the error placeholders; resuming the run retries those stages.
+        checkpoints.set_status("partial")
+    else:
+        checkpoints.save("final_note", final_note.strip())
+        checkpoints.set_status("completed")
+        checkpoints.archive(final_note.strip(), extracted_primary_diagnosis, patient_id=patient_id)
+        if patient_background is not None:
+            _record_patient_visit(patient_id, run_id, background_info_text, patient_background,
+                                  [visit_transcript_text, additional_info_text, revised_info_text],
+                                  extracted_primary_diagnosis, diagnostic_assessment_text, final_note.strip(), ctx,
+                                  document_hashes=background_document_hashes)
+    for line in format_size_report(ctx.prompt_reports):
+        ctx.log(f"DEBUG: Prompt sizes (est. tokens): {line}")
+    ctx.log(f"DEBUG: Core note processing finished ({ctx.metrics_summary()}).")
     return final_note.strip()
\ No newline at end of file
@@ -0,0 +1,130 @@
+# note_rendering.py
+# Server-side markdown -> HTML rendering of generated notes, so the browser displays a finished note without
+# parsing it. Covers what the pipeline's notes contain: headings, **bold**, bullet and numbered lists (nested
+# by indentation), pipe tables, horizontal rules and paragraphs with their line breaks. All text is
+# HTML-escaped first; checklist placeholders such as "***" are kept literally.
+# Rendered HTML is cached in memory by the SHA-256 of the markdown (NOTE_RENDER_CACHE_ENTRIES, LRU), so a note
+# that is fetched again (archive lookups, idempotent retries) is rendered once.
+import hashlib
+import html
+import os
+import re
+import threading
+from collections import OrderedDict
+
+NOTE_RENDER_CACHE_ENTRIES = int(os.getenv("NOTE_RENDER_CACHE_ENTRIES", "256"))
+
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.*?)\s*#*$")
+_LIST_ITEM_RE = re.compile(r"^(\s*)(?:([-*+])|(\d+)[.)])\s+(.*)$")
+_RULE_RE = re.compile(r"^\s*(?:-{3,}|\*{3,}|_{3,})\s*$")
+_TABLE_ROW_RE = re.compile(r"^\s*\|.*\|\s*$")
+_TABLE_SEPARATOR_RE = re.compile(r"^\s*\|?\s*:?-{3,}:?\s*(?:\|\s*:?-{3,}:?\s*)*\|?\s*$")
+_BOLD_RE = re.compile(r"\*\*(?=\S)(.+?)(?<=\S)\*\*")
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0}
+
+
+def _inline(text):
+    return _BOLD_RE.sub(r"<strong>\1</strong>", html.escape(text, quote=False))
+
+
+def _table_cells(line):
+    return [cell.strip() for cell in line.strip().strip("|").split("|")]
+
+
+def _render_table(rows):
+    header, body = rows[0], rows[2:] if len(rows) > 1 and _TABLE_SEPARATOR_RE.match(rows[1]) else rows[1:]
+    parts = ["<table><thead><tr>" + "".join(f"<th>{_inline(c)}</th>" for c in _table_cells(header)) + "</tr></thead>"]
+    parts.append("<tbody>" + "".join("<tr>" + "".join(f"<td>{_inline(c)}</td>" for c in _table_cells(row)) + "</tr>"
+                                     for row in body) + "</tbody></table>")
+    return "".join(parts)
+
+
+def _render_list(items):
+    """items: [(indent, ordered, text)] of consecutive list lines; deeper indentation nests a list."""
+    out = []
+    stack = []  # (indent, tag) of the open lists
+    for indent, ordered, text in items:
+        tag = "ol" if ordered else "ul"
+        while stack and indent < stack[-1][0]:
+            out.append(f"</li></{stack.pop()[1]}>")
+        if not stack or indent > stack[-1][0]:
+            stack.append((indent, tag))
+            out.append(f"<{tag}><li>")
+        else:
+            out.append("</li><li>")
+        out.append(_inline(text))
+    while stack:
+        out.append(f"</li></{stack.pop()[1]}>")
+    return "".join(out)
+
+
+def markdown_to_html(markdown_text):
+    """Renders the markdown subset described above. Unrecognized syntax is shown as text."""
+    lines = (markdown_text or "").replace("\r\n", "\n").split("\n")
+    out = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if not line.strip():
+            i += 1
+            continue
+        heading = _HEADING_RE.match(line.strip())
+        if heading:
+            level = len(heading.group(1))
+            out.append(f"<h{level}>{_inline(heading.group(2))}</h{level}>")
+            i += 1
+        elif _RULE_RE.match(line):
+            out.append("<hr>")
+            i += 1
+        elif _TABLE_ROW_RE.match(line):
+            rows = []
+            while i < len(lines) and _TABLE_ROW_RE.match(lines[i]):
+                rows.append(lines[i])
+                i += 1
+            out.append(_render_table(rows))
+        elif _LIST_ITEM_RE.match(line):
+            items = []
+            while i < len(lines) and lines[i].strip():
+                item = _LIST_ITEM_RE.match(lines[i])
+                if item:
+                    items.append((len(item.group(1).expandtabs(4)), item.group(3) is not None, item.group(4)))
+                elif items:  # A wrapped continuation line of the previous item.
+                    indent, ordered, text = items[-1]
+                    items[-1] = (indent, ordered, text + " " + lines[i].strip())
+                i += 1
+            out.append(_render_list(items))
+        else:
+            paragraph = []
+            while (i < len(lines) and lines[i].strip() and not _HEADING_RE.match(lines[i].strip())
+                   and not _LIST_ITEM_RE.match(lines[i]) and not _RULE_RE.match(lines[i])
+                   and not _TABLE_ROW_RE.match(lines[i])):
+                paragraph.append(_inline(lines[i].strip()))
+                i += 1
+            out.append("<p>" + "<br>\n".join(paragraph) + "</p>")
+    return "\n".join(out)
+
+
+def render_note_html(markdown_text):
+    """markdown_to_html, cached by content hash."""
+    key = hashlib.sha256((markdown_text or "").encode("utf-8")).hexdigest()
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None:
+            _cache.move_to_end(key)
+            _cache_stats["hits"] += 1
+            return cached
+        _cache_stats["misses"] += 1
+    rendered = markdown_to_html(markdown_text)
+    with _cache_lock:
+        _cache[key] = rendered
+        while len(_cache) > NOTE_RENDER_CACHE_ENTRIES:
+            _cache.popitem(last=False)
+    return rendered
+
+
+def render_cache_stats():
+    with _cache_lock:
+        return dict(_cache_stats, entries=len(_cache))
@@ -0,0 +1,329 @@
+# patient_fact_store.py
+# Local SQLite store of longitudinal facts per patient, keyed by a clinician-supplied pseudonymous patient ID.
+# For follow-up visits the "Background Information" is mostly the same prior notes uploaded again. Each
+# background document (the parts APP joins with SECTION_SEPARATOR) is hashed; at the end of a run the facts of
+# the documents not seen before, and of the visit's own inputs, are extracted into the background digest
+# headings (diagnoses, medications, imaging, cognitive scores with their visit date, labs) and stored together
+# with the generated diagnostic assessment. The note generated for the visit is registered as already processed.
+# At the next visit only new documents are sent as text; everything else reaches the prompts as the stored
+# facts (capped per heading) plus the previous assessment, so the prompt size stays roughly flat as the
+# patient's history grows.
+#
+# Patient IDs must be pseudonymous (no names or MRNs); stored texts are whatever the run received, i.e.
+# de-identified when de-identification was requested. Two things keep them comparable across visits although
+# de-identification runs per request:
+# - APP hashes the background documents as uploaded, before redaction (see document_hash), and passes the hashes
+#   through, so a prior note is recognized whatever surrogates the rest of the upload caused.
+# - The identifier redaction of a patient's runs uses surrogate_key(patient_id), so a person has the same
+#   surrogate at every visit and the stored facts and previous assessment keep referring to the right person.
+import hashlib
+import hmac
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from background_digest import (BACKGROUND_DIGEST_MAX_WORKERS, DIGEST_SECTIONS, collect_section_lines,
+                               prepare_background_for_prompts, raw_chunk_summary, split_background_into_chunks,
+                               summarize_background_chunk)
+from checklist_extractor import extract_checklist_facts
+from prompt_builder import truncate_body
+from run_store import new_run_id
+from sqlite_store import SQLiteStore
+
+PATIENT_FACT_STORE_PATH = os.getenv("PATIENT_FACT_STORE_PATH", os.path.join("data", "patient_facts.sqlite3"))
+PATIENT_FACTS_MAX_PER_SECTION = int(os.getenv("PATIENT_FACTS_MAX_PER_SECTION", "40"))  # Most recent are kept.
+PATIENT_PREVIOUS_ASSESSMENT_TOKENS = int(os.getenv("PATIENT_PREVIOUS_ASSESSMENT_TOKENS", "1500"))
+# Secret for the per-patient surrogate keys. Without PATIENT_SURROGATE_SECRET a random one is created once in
+# PATIENT_SURROGATE_SECRET_PATH; losing it only renumbers surrogates in facts stored from then on.
+PATIENT_SURROGATE_SECRET = os.getenv("PATIENT_SURROGATE_SECRET", "")
+PATIENT_SURROGATE_SECRET_PATH = os.getenv("PATIENT_SURROGATE_SECRET_PATH",
+                                          os.path.join("data", "patient_surrogate_secret"))
+
+DOCUMENT_SEPARATOR = "\n\n---\n\n"  # APP.SECTION_SEPARATOR: how the texts of one input section are joined.
+PATIENT_ID_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]{0,63}$")
+
+# Scores recorded per visit, so the facts show their trend over time.
+_SCORE_LABELS = {"mmse": ("MMSE", "/30"), "moca": ("MoCA", "/30"), "cdr": ("CDR", ""), "faq": ("FAQ", "/30"),
+                 "gds": ("GDS", "/15")}
+
+# context_text replaces the raw background in the prompts; new_document_hashes identifies the documents
+# (of the run's background text) that were not processed at an earlier visit.
+PatientBackground = namedtuple("PatientBackground", ["context_text", "new_document_hashes", "known_documents",
+                                                     "stored_facts"])
+
+_secret_lock = threading.Lock()
+_secret = None
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS patient_documents (
+    patient_id TEXT NOT NULL REFERENCES patients(patient_id) ON DELETE CASCADE,
+    document_hash TEXT NOT NULL,
+    chars INTEGER NOT NULL,
+    run_id TEXT,
+    processed_at REAL NOT NULL,
+    PRIMARY KEY (patient_id, document_hash)
+);
+CREATE TABLE IF NOT EXISTS patient_facts (
+    patient_id TEXT NOT NULL REFERENCES patients(patient_id) ON DELETE CASCADE,
+    section TEXT NOT NULL,
+    fact_key TEXT NOT NULL,
+    fact TEXT NOT NULL,
+    run_id TEXT,
+    first_seen_at REAL NOT NULL,
+    last_seen_at REAL NOT NULL,
+    PRIMARY KEY (patient_id, section, fact_key)
+);
+CREATE TABLE IF NOT EXISTS patient_visits (
+    run_id TEXT PRIMARY KEY,
+    patient_id TEXT NOT NULL REFERENCES patients(patient_id) ON DELETE CASCADE,
+    visited_at REAL NOT NULL,
+    primary_diagnosis TEXT,
+    assessment TEXT
+);
+CREATE INDEX IF NOT EXISTS patient_visits_patient ON patient_visits(patient_id, visited_at);
+"""
+_store = SQLiteStore(_SCHEMA)
+
+
+def is_valid_patient_id(patient_id):
+    return bool(patient_id) and bool(PATIENT_ID_RE.match(patient_id))
+
+
+def _transaction():
+    return _store.transaction(PATIENT_FACT_STORE_PATH)
+
+
+def _normalize(text):
+    return " ".join(text.split()).lower()
+
+
+def document_hash(text):
+    """Hash of a document's whitespace-normalized text, so re-extracted copies of the same file match."""
+    return hashlib.sha256(" ".join(text.split()).encode("utf-8")).hexdigest()
+
+
+def split_documents(background_text):
+    return [document.strip() for document in (background_text or "").split(DOCUMENT_SEPARATOR) if document.strip()]
+
+
+def uploaded_document_hashes(texts):
+    """document_hash of each background text as uploaded (APP, before de-identification), in split_documents order."""
+    return [document_hash(text) for text in texts if text and text.strip()]
+
+
+def _document_hashes(documents, uploaded_hashes):
+    """The uploaded-text hashes when they line up with `documents`, otherwise hashes of the documents themselves."""
+    if uploaded_hashes is not None:
+        if len(uploaded_hashes) == len(documents):
+            return list(uploaded_hashes)
+        print(f"WARNING: {len(uploaded_hashes)} uploaded document hashes for {len(documents)} background documents; "
+              f"hashing the documents as received instead.")
+    return [document_hash(document) for document in documents]
+
+
+def _surrogate_secret():
+    global _secret
+    with _secret_lock:
+        if _secret is None:
+            if PATIENT_SURROGATE_SECRET:
+                _secret = PATIENT_SURROGATE_SECRET.encode("utf-8")
+            else:
+                try:
+                    with open(PATIENT_SURROGATE_SECRET_PATH, "rb") as f:
+                        _secret = f.read()
+                except FileNotFoundError:
+                    directory = os.path.dirname(PATIENT_SURROGATE_SECRET_PATH)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    _secret = os.urandom(32)
+                    with open(os.open(PATIENT_SURROGATE_SECRET_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600),
+                              "wb") as f:
+                        f.write(_secret)
+        return _secret
+
+
+def surrogate_key(patient_id):
+    """The key identifier_redactor numbers this patient's surrogates with (stable across visits)."""
+    return hmac.new(_surrogate_secret(), patient_id.encode("utf-8"), hashlib.sha256).digest()
+
+
+def _fact_key(fact):
+    return _normalize(fact.lstrip("-*• "))
+
+
+def _load_facts(conn, patient_id):
+    """{section: [fact, ...]} with at most PATIENT_FACTS_MAX_PER_SECTION most recently seen facts per section."""
+    facts = {section: [] for section in DIGEST_SECTIONS}
+    rows = conn.execute("SELECT section, fact FROM patient_facts WHERE patient_id = ? "
+                        "ORDER BY last_seen_at DESC, first_seen_at DESC, rowid DESC", (patient_id,))
+    for section, fact in rows:
+        if section in facts and len(facts[section]) < PATIENT_FACTS_MAX_PER_SECTION:
+            facts[section].append(fact)
+    return {section: list(reversed(lines)) for section, lines in facts.items()}  # Oldest first, as in the digest.
+
+
+def _format_facts(facts, previous_visit, known_documents, visits):
+    since = time.strftime("%Y-%m-%d", time.localtime(previous_visit[0])) if previous_visit else "an earlier visit"
+    parts = [f"PATIENT FACT STORE (facts extracted at {visits} earlier visit(s), last on {since}, from "
+             f"{known_documents} documents that are not repeated below; only explicitly documented facts are listed):"]
+    for section in DIGEST_SECTIONS:
+        lines = facts[section] or ["- None documented in earlier records."]
+        parts.append(f"### {section}\n" + "\n".join(lines))
+    if previous_visit and previous_visit[2]:
+        diagnosis = f"; primary diagnosis: {previous_visit[1]}" if previous_visit[1] else ""
+        parts.append(f"### Previous Assessment ({since}{diagnosis})\n"
+                     + truncate_body(previous_visit[2].strip(), PATIENT_PREVIOUS_ASSESSMENT_TOKENS))
+    return "\n\n".join(parts)
+
+
+def prepare_patient_background(patient_id, background_text, generate_fn, model_name, run_id=None,
+                               document_hashes=None):
+    """
+    The background context for a run of `patient_id`: the stored facts and previous assessment, followed by
+    only the documents of `background_text` not processed at an earlier visit (digested when oversized).
+    Without stored visits this is prepare_background_for_prompts(background_text), as for anonymous runs.
+    document_hashes: uploaded_document_hashes of the documents before de-identification, if any.
+    """
+    documents = split_documents(background_text)
+    hashes = _document_hashes(documents, document_hashes)
+    with _transaction() as conn:
+        known = {row[0] for row in conn.execute(
+            "SELECT document_hash FROM patient_documents WHERE patient_id = ? AND (run_id IS NULL OR run_id != ?)",
+            (patient_id, run_id or ""))}
+        visits = conn.execute("SELECT COUNT(*) FROM patient_visits WHERE patient_id = ? AND run_id != ?",
+                              (patient_id, run_id or "")).fetchone()[0]
+        previous_visit = conn.execute(
+            "SELECT visited_at, primary_diagnosis, assessment FROM patient_visits WHERE patient_id = ? AND run_id != ? "
+            "ORDER BY visited_at DESC LIMIT 1", (patient_id, run_id or "")).fetchone()
+        facts = _load_facts(conn, patient_id) if visits else None
+
+    new_documents = [document for document, h in zip(documents, hashes) if h not in known]
+    new_hashes = [h for h in hashes if h not in known]
+    if not visits:
+        return PatientBackground(prepare_background_for_prompts(background_text, generate_fn, model_name),
+                                 new_hashes, 0, 0)
+
+    new_text = DOCUMENT_SEPARATOR.join(new_documents)
+    new_context = prepare_background_for_prompts(new_text, generate_fn, model_name) if new_text else ""
+    known_documents = len(known)
+    stored_facts = sum(len(lines) for lines in facts.values())
+    print(f"DEBUG: Patient {patient_id}: {len(documents) - len(new_documents)} of {len(documents)} background "
+          f"documents already processed; using {stored_facts} stored facts and {len(new_documents)} new documents.")
+    context_text = (_format_facts(facts, previous_visit, known_documents, visits)
+                    + "\n\nNEW BACKGROUND DOCUMENTS SINCE THE LAST VISIT:\n"
+                    + (new_context or "None."))
+    return PatientBackground(context_text, new_hashes, known_documents, stored_facts)
+
+
+def _summarize_documents(documents, generate_fn, model_name):
+    """
+    Chunk summaries (cached by content hash, see background_digest) of each document.
+    Returns [(document, summaries or None if a chunk could not be summarized)].
+    """
+    jobs = [(i, chunk) for i, document in enumerate(documents) for chunk in split_background_into_chunks(document)]
+    if not jobs:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(BACKGROUND_DIGEST_MAX_WORKERS, len(jobs)))) as executor:
+        results = list(executor.map(lambda job: summarize_background_chunk(job[1], generate_fn, model_name), jobs))
+    summaries = {i: [] for i in range(len(documents))}
+    for (i, chunk), (summary, _) in zip(jobs, results):
+        if summaries[i] is not None:
+            summaries[i] = None if summary == raw_chunk_summary(chunk) else summaries[i] + [summary]
+    return [(document, summaries[i]) for i, document in enumerate(documents)]
+
+
+def _score_facts(texts, visit_date):
+    """Cognitive scores found by the checklist extractor, labelled with the visit they were recorded at."""
+    lines = []
+    extracted = extract_checklist_facts([(f"text {i}", text) for i, text in enumerate(texts)])
+    for name, (label, suffix) in _SCORE_LABELS.items():
+        for value in dict.fromkeys(fact.value for fact in extracted.get(name, [])):
+            number = f"{value:g}" if isinstance(value, float) else str(value)
+            lines.append(f"- {label} {number}{suffix} (in records available at the {visit_date} visit)")
+    return lines
+
+
+def record_visit(patient_id, run_id, background_text, new_document_hashes, visit_texts, generate_fn, model_name,
+                 primary_diagnosis=None, assessment=None, final_note=None, document_hashes=None):
+    """
+    Stores what a completed run learned about the patient: facts of its new background documents and of the
+    visit's own inputs (`visit_texts`), the assessment, and the generated note as an already-processed document
+    (as returned to the clinician, which is what is uploaded at the next visit).
+    A document whose summary failed is not marked processed, so it is sent as text again next time.
+    document_hashes: as for prepare_patient_background.
+    Idempotent per run_id (a resumed run updates its visit). Returns the number of new facts.
+    """
+    run_id = run_id or new_run_id()  # Runs without checkpoints still get a visit of their own.
+    new_document_hashes = set(new_document_hashes)
+    background_documents = split_documents(background_text)
+    documents = [(document, h) for document, h in
+                 zip(background_documents, _document_hashes(background_documents, document_hashes))
+                 if h in new_document_hashes]
+    documents += [(text.strip(), document_hash(text)) for text in visit_texts if text and text.strip()]
+    summarized = _summarize_documents([document for document, _ in documents], generate_fn, model_name)
+    visit_date = time.strftime("%Y-%m-%d")
+    section_lines = collect_section_lines([summary for _, summaries in summarized if summaries
+                                           for summary in summaries])
+    section_lines["Cognitive Scores"] += _score_facts([document for document, _ in summarized], visit_date)
+    processed = [(document, h) for (document, summaries), (_, h) in zip(summarized, documents) if summaries is not None]
+    if final_note:
+        processed.append((final_note, document_hash(final_note)))
+
+    now = time.time()
+    added = 0
+    with _transaction() as conn:
+        conn.execute("INSERT INTO patients (patient_id, created_at, updated_at) VALUES (?, ?, ?) "
+                     "ON CONFLICT(patient_id) DO UPDATE SET updated_at = excluded.updated_at",
+                     (patient_id, now, now))
+        for section, lines in section_lines.items():
+            for line in lines:
+                key = _fact_key(line)
+                if not key:
+                    continue
+                added += conn.execute(
+                    "INSERT OR IGNORE INTO patient_facts (patient_id, section, fact_key, fact, run_id, first_seen_at, "
+                    "last_seen_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (patient_id, section, key, line, run_id, now, now)).rowcount
+                conn.execute("UPDATE patient_facts SET last_seen_at = ? WHERE patient_id = ? AND section = ? "
+                             "AND fact_key = ?", (now, patient_id, section, key))
+        conn.executemany(
+            "INSERT OR IGNORE INTO patient_documents (patient_id, document_hash, chars, run_id, processed_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(patient_id, h, len(document), run_id, now) for document, h in processed])
+        conn.execute("INSERT OR REPLACE INTO patient_visits (run_id, patient_id, visited_at, primary_diagnosis, "
+                     "assessment) VALUES (?, ?, ?, ?, ?)", (run_id, patient_id, now, primary_diagnosis, assessment))
+    print(f"DEBUG: Patient {patient_id}: stored {added} new facts from {len(summarized)} documents of run {run_id} "
+          f"({len(summarized) + bool(final_note) - len(processed)} left unprocessed).")
+    return added
+
+
+def patient_summary(patient_id):
+    """Counts and visits stored for a patient (for the /patients route), or None if unknown."""
+    with _transaction() as conn:
+        row = conn.execute("SELECT created_at, updated_at FROM patients WHERE patient_id = ?", (patient_id,)).fetchone()
+        if row is None:
+            return None
+        documents = conn.execute("SELECT COUNT(*), COALESCE(SUM(chars), 0) FROM patient_documents "
+                                 "WHERE patient_id = ?", (patient_id,)).fetchone()
+        facts = dict(conn.execute("SELECT section, COUNT(*) FROM patient_facts WHERE patient_id = ? GROUP BY section",
+                                  (patient_id,)).fetchall())
+        visits = [{"run_id": run_id, "visited_at": visited_at, "primary_diagnosis": diagnosis}
+                  for run_id, visited_at, diagnosis in conn.execute(
+                      "SELECT run_id, visited_at, primary_diagnosis FROM patient_visits WHERE patient_id = ? "
+                      "ORDER BY visited_at", (patient_id,))]
+    return {"patient_id": patient_id, "created_at": row[0], "updated_at": row[1], "documents": documents[0],
+            "document_chars": documents[1], "facts": facts, "visits": visits}
+
+
+def delete_patient(patient_id):
+    """Removes everything stored for a patient. Returns True if the patient was known."""
+    with _transaction() as conn:
+        return conn.execute("DELETE FROM patients WHERE patient_id = ?", (patient_id,)).rowcount > 0
@@ -0,0 +1,205 @@
+# pipeline_context.py
+# Per-request state of one note-generation run: configuration, model/PubMed clients, a run-tagged logger,
+# a deadline and call metrics (including estimated input tokens). note_processing_core threads a
+# PipelineContext through every stage instead of mutating SDK globals (Entrez.email, vertexai.init,
+# sys.stdout) per call, so many runs can share one process and its threads without stepping on each other.
+import os
+import threading
+import time
+from collections import namedtuple
+
+from prompt_builder import estimate_tokens, estimate_tokens_of_parts
+from request_profiler import profile_stage
+
+PIPELINE_DEADLINE_SECONDS = float(os.getenv("PIPELINE_DEADLINE_SECONDS", "0"))  # 0 = no deadline.
+ENTREZ_EMAIL = os.getenv("ENTREZ_EMAIL", "salardini@uthscsa.edu")
+
+PipelineConfig = namedtuple("PipelineConfig", ["project_id", "location", "model_name", "entrez_email",
+                                               "deadline_seconds"])
+
+_vertex_init_lock = threading.Lock()
+_vertex_initialized_for = None  # (project_id, location) vertexai.init was last called with.
+
+
+class PipelineDeadlineExceeded(Exception):
+    """Raised by a context's model/PubMed clients once the run's deadline has passed."""
+
+
+def ensure_vertex_initialized(project_id, location):
+    """
+    Calls vertexai.init once per process (again only if the project or location changes).
+    Returns True if this call initialized it.
+    """
+    global _vertex_initialized_for
+    if _vertex_initialized_for == (project_id, location):
+        return False
+    with _vertex_init_lock:
+        if _vertex_initialized_for == (project_id, location):
+            return False
+        import vertexai
+        vertexai.init(project=project_id, location=location)
+        _vertex_initialized_for = (project_id, location)
+        print(f"Vertex AI initialized for project '{project_id}' in location '{location}'.")
+        return True
+
+
+class _ContextModel:
+    """
+    A model client bound to a context: checks the deadline, counts calls and tokens and marks "model_call"
+    profile stages. With a prefix handle that is not cached, the prefix is sent inline as the first part.
+    With a traffic recorder or replayer on the context (see model_traffic_replay), every call goes through it.
+    """
+
+    def __init__(self, context, model, prefix_handle=None, model_name=None):
+        self._context = context
+        self._model = model
+        self._prefix_handle = prefix_handle
+        self._model_name = model_name
+
+    def generate_content(self, contents, *args, **kwargs):
+        self._context.check_deadline("model call")
+        payload = list(contents) if isinstance(contents, list) else [contents]
+        parts = list(payload)
+        handle = self._prefix_handle
+        if handle is not None and handle.cached:
+            self._context.count("cached_prefix_tokens", handle.tokens)
+        elif handle is not None:
+            parts.insert(0, handle.prefix.text + "\n")  # A part of its own; the prompt parts are not copied.
+        contents = parts
+        self._context.count("input_tokens", estimate_tokens_of_parts(parts))
+        started = time.perf_counter()
+        try:
+            with profile_stage("model_call"):
+                if self._context.traffic is not None:
+                    response = self._context.traffic.model_call(
+                        self._context, self._model_name, handle.prefix if handle is not None else None, payload,
+                        lambda: self._model.generate_content(contents, *args, **kwargs))
+                else:
+                    response = self._model.generate_content(contents, *args, **kwargs)
+        except Exception:
+            self._context.count("model_errors")
+            raise
+        finally:
+            self._context.count("model_calls")
+            self._context.count("model_seconds", time.perf_counter() - started)
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+
+def _inline_handle(prefix, model_name):
+    from prefix_cache import PrefixHandle
+    return PrefixHandle(prefix, model_name, estimate_tokens(prefix.text), False, None)
+
+
+class _ContextEntrez:
+    """Bio.Entrez bound to a context: passes the context's email with every request instead of setting Entrez.email."""
+
+    def __init__(self, context, entrez):
+        self._context = context
+        self._entrez = entrez
+
+    def _call(self, function, **params):
+        self._context.check_deadline("PubMed request")
+        params.setdefault("email", self._context.config.entrez_email)
+        started = time.perf_counter()
+        try:
+            if self._context.traffic is not None:
+                return self._context.traffic.entrez_call(self._context, function.__name__, params,
+                                                         lambda: function(**params))
+            return function(**params)
+        finally:
+            self._context.count("entrez_calls")
+            self._context.count("entrez_seconds", time.perf_counter() - started)
+
+    def esearch(self, **params):
+        return self._call(self._entrez.esearch, **params)
+
+    def efetch(self, **params):
+        return self._call(self._entrez.efetch, **params)
+
+    def __getattr__(self, name):
+        return getattr(self._entrez, name)
+
+
+class PipelineContext:
+    """
+    Everything one run needs that is not an input text.
+    model_factory(model_name, cached_content=None) and entrez_factory() return the raw SDK clients; they are
+    called per use, so the clients themselves never carry per-run state.
+    prefix_cache: the process-wide prefix_cache.PrefixCache used by model(prefix=...), or None to send every
+    prefix inline (counted as "prefix_inline").
+    traffic: optional model_traffic_replay.TrafficRecorder or TrafficReplayer that model and PubMed calls go through.
+    """
+
+    def __init__(self, config, model_factory, entrez_factory, run_id=None, prefix_cache=None, traffic=None):
+        self.config = config
+        self.prefix_cache = prefix_cache
+        self.traffic = traffic
+        self.run_id = run_id
+        self._model_factory = model_factory
+        self._entrez_factory = entrez_factory
+        self.started = time.monotonic()
+        self.deadline = self.started + config.deadline_seconds if config.deadline_seconds else None
+        self.metrics = {}
+        self.prompt_reports = []  # prompt_builder reports of the prompts built for this run, in order.
+        self._metrics_lock = threading.Lock()
+        self._log_prefix = f"[run {run_id}] " if run_id else ""
+
+    def log(self, *args, sep=" "):
+        """print() with the run ID prefixed, written in one call so lines of concurrent runs do not interleave."""
+        message = sep.join(str(arg) for arg in args)
+        body = message.lstrip("\n")
+        print(message[:len(message) - len(body)] + self._log_prefix + body + "\n", end="")
+
+    def count(self, name, amount=1):
+        with self._metrics_lock:
+            self.metrics[name] = self.metrics.get(name, 0) + amount
+
+    def record_prompt(self, report):
+        with self._metrics_lock:
+            self.prompt_reports.append(report)
+
+    def remaining_seconds(self):
+        """Seconds left before the deadline, or None without one."""
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def check_deadline(self, what):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            self.count("deadline_exceeded")
+            raise PipelineDeadlineExceeded(f"{what} skipped: run deadline of {self.config.deadline_seconds:g}s "
+                                           f"exceeded")
+
+    def model(self, model_name=None, prefix=None):
+        """
+        A model client for this run. With a prefix_cache.StaticPrefix, the caller sends only the per-request
+        payload: the prefix comes from the provider cache when it could be cached, and is prepended otherwise.
+        """
+        model_name = model_name or self.config.model_name
+        if prefix is None:
+            return _ContextModel(self, self._model_factory(model_name), model_name=model_name)
+        if self.prefix_cache is not None:
+            handle = self.prefix_cache.resolve(prefix, model_name)
+        else:
+            handle = _inline_handle(prefix, model_name)
+        self.count("prefix_cached" if handle.cached else "prefix_inline")
+        if handle.cached:
+            return _ContextModel(self, self.prefix_cache.model_for(handle, self._model_factory), handle, model_name)
+        return _ContextModel(self, self._model_factory(model_name), handle, model_name)
+
+    def entrez(self):
+        return _ContextEntrez(self, self._entrez_factory())
+
+    def generate_text(self, prompt):
+        """Single-prompt model call returning the stripped response text (exceptions propagate to the caller)."""
+        return self.model().generate_content([prompt]).text.strip()
+
+    def metrics_summary(self):
+        with self._metrics_lock:
+            metrics = dict(self.metrics)
+        parts = [f"{time.monotonic() - self.started:.2f}s total"]
+        for name in sorted(metrics):
+            value = metrics[name]
+            parts.append(f"{name}={value:.2f}" if isinstance(value, float) else f"{name}={value}")
+        return ", ".join(parts)
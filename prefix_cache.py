@@ -0,0 +1,230 @@
+# prefix_cache.py
+# Provider-side caching of the static instruction prefixes of the stage prompts.
+# The note body, diagnostic assessment, checklist and elaboration instructions are the same for every note.
+# Each is registered once as cached content and later calls send only the per-patient payload, referencing
+# the cache by handle. Entries are refreshed (TTL extended) when used within PREFIX_CACHE_REFRESH_MARGIN_SECONDS
+# of expiry, and recreated if they expired unused. A prefix the provider refuses to cache (model without
+# context caching, prefix below its minimum size) is sent inline in front of the payload, as before, and
+# creation is retried after PREFIX_CACHE_RETRY_SECONDS.
+#
+# Backends (PREFIX_CACHE_BACKEND):
+#   off    - no cache (the default): get_prefix_cache() returns None and PipelineContext.model sends every prefix
+#            inline, counting it in the run's "prefix_inline" metric.
+#   vertex - Vertex AI context caching (vertexai.preview.caching.CachedContent). Needs a model that supports
+#            it and prefixes above its minimum cacheable size; with the configured gemini-1.0-pro and the
+#            current 400-1100 token prefixes every creation fails, so only set this with a caching-capable model.
+#   local  - in-process stand-in with the same TTL/refresh behaviour; the cached prefix is re-attached locally
+#            before the model call. Used by load_test.py and for testing without credentials.
+import abc
+import datetime
+import hashlib
+import os
+import threading
+import time
+from collections import namedtuple
+
+from prompt_builder import estimate_tokens
+
+PREFIX_CACHE_BACKEND = os.getenv("PREFIX_CACHE_BACKEND", "off")
+PREFIX_CACHE_TTL_SECONDS = int(os.getenv("PREFIX_CACHE_TTL_SECONDS", "3600"))
+PREFIX_CACHE_REFRESH_MARGIN_SECONDS = int(os.getenv("PREFIX_CACHE_REFRESH_MARGIN_SECONDS", "300"))
+PREFIX_CACHE_RETRY_SECONDS = int(os.getenv("PREFIX_CACHE_RETRY_SECONDS", "3600"))
+
+# A static prompt prefix: `name` identifies it in logs and stats, `text` is sent as the system instruction.
+StaticPrefix = namedtuple("StaticPrefix", ["name", "text"])
+
+# How a prefix reaches the model for one call: `resource` is the provider's cache object when `cached`,
+# otherwise the prefix text has to be sent inline.
+PrefixHandle = namedtuple("PrefixHandle", ["prefix", "model_name", "tokens", "cached", "resource"])
+
+
+class _Entry:
+    def __init__(self, resource, expire_time):
+        self.resource = resource
+        self.expire_time = expire_time
+        self.created = time.time()
+        self.hits = 0
+        self.refreshes = 0
+
+
+class PrefixCache(abc.ABC):
+    """
+    Backend-independent bookkeeping: one cache entry per (prefix name, model, prefix text). Backends implement
+    _create, _refresh and model_for.
+    """
+
+    backend = None
+
+    def __init__(self):
+        self._entries = {}
+        self._uncacheable_until = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._stats = {"hits": 0, "misses": 0, "refreshes": 0, "inline": 0, "cached_tokens_served": 0}
+
+    @staticmethod
+    def _key(prefix, model_name):
+        return prefix.name, model_name, hashlib.sha256(prefix.text.encode("utf-8")).hexdigest()[:16]
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def resolve(self, prefix, model_name):
+        """A PrefixHandle for `prefix` on `model_name`, creating or refreshing the cache entry as needed."""
+        tokens = estimate_tokens(prefix.text)
+        key = self._key(prefix, model_name)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            entry = self._lookup(key, prefix, model_name)
+        if entry is None:
+            self._count("inline")
+            return PrefixHandle(prefix, model_name, tokens, False, None)
+        self._count("cached_tokens_served", tokens)
+        return PrefixHandle(prefix, model_name, tokens, True, entry.resource)
+
+    def _lookup(self, key, prefix, model_name):
+        now = time.time()
+        if self._uncacheable_until.get(key, 0) > now:
+            return None
+        entry = self._entries.get(key)
+        if entry is not None and entry.expire_time > now:
+            if entry.expire_time - now < PREFIX_CACHE_REFRESH_MARGIN_SECONDS:
+                try:
+                    entry.expire_time = self._refresh(entry.resource)
+                    entry.refreshes += 1
+                    self._count("refreshes")
+                except Exception as e:
+                    print(f"WARNING: Could not refresh cached prefix '{prefix.name}': {e}. Recreating it.")
+                    entry = None
+            if entry is not None:
+                entry.hits += 1
+                self._count("hits")
+                return entry
+        try:
+            resource, expire_time = self._create(prefix, model_name)
+        except Exception as e:
+            self._uncacheable_until[key] = now + PREFIX_CACHE_RETRY_SECONDS
+            print(f"WARNING: Could not cache prompt prefix '{prefix.name}' for {model_name} ({self.backend}): {e}. "
+                  f"Sending it inline; retrying in {PREFIX_CACHE_RETRY_SECONDS}s.")
+            return None
+        self._entries[key] = entry = _Entry(resource, expire_time)
+        self._count("misses")
+        print(f"DEBUG: Cached prompt prefix '{prefix.name}' for {model_name} "
+              f"(~{estimate_tokens(prefix.text)} tokens, expires in {expire_time - now:.0f}s).")
+        return entry
+
+    @abc.abstractmethod
+    def _create(self, prefix, model_name):
+        """Registers the prefix with the provider. Returns (resource, expire_time as a Unix timestamp)."""
+
+    @abc.abstractmethod
+    def _refresh(self, resource):
+        """Extends the entry's TTL. Returns the new expire_time."""
+
+    @abc.abstractmethod
+    def model_for(self, handle, model_factory):
+        """The model client that generates with the cached prefix of `handle`."""
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            entries = [{"prefix": key[0], "model": key[1], "hits": entry.hits, "refreshes": entry.refreshes,
+                        "expires_in_s": round(entry.expire_time - time.time())}
+                       for key, entry in self._entries.items()]
+        lookups = stats["hits"] + stats["misses"] + stats["inline"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["backend"] = self.backend
+        stats["entries"] = entries
+        return stats
+
+
+class VertexPrefixCache(PrefixCache):
+    """Vertex AI context caching: the prefix becomes the system instruction of a CachedContent resource."""
+
+    backend = "vertex"
+
+    def _create(self, prefix, model_name):
+        # Deferred import, like the other Vertex AI imports (see note_processing_core).
+        from vertexai.preview import caching
+        cached_content = caching.CachedContent.create(
+            model_name=model_name, system_instruction=prefix.text, display_name=f"amy-lloyd-{prefix.name}",
+            ttl=datetime.timedelta(seconds=PREFIX_CACHE_TTL_SECONDS))
+        return cached_content, _expire_timestamp(cached_content)
+
+    def _refresh(self, resource):
+        resource.update(ttl=datetime.timedelta(seconds=PREFIX_CACHE_TTL_SECONDS))
+        resource.refresh()
+        return _expire_timestamp(resource)
+
+    def model_for(self, handle, model_factory):
+        return model_factory(handle.model_name, cached_content=handle.resource)
+
+
+def _expire_timestamp(cached_content):
+    expire_time = getattr(cached_content, "expire_time", None)
+    if expire_time is None:
+        return time.time() + PREFIX_CACHE_TTL_SECONDS
+    return expire_time.timestamp()
+
+
+class LocalCachedContent:
+    """What the local backend keeps per cached prefix."""
+
+    def __init__(self, name, model_name, system_instruction):
+        self.name = name
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+
+
+class _LocalCachedModel:
+    """Re-attaches a locally cached prefix as the first prompt part, as the provider would server-side."""
+
+    def __init__(self, model, cached_content):
+        self._model = model
+        self._cached_content = cached_content
+
+    def generate_content(self, contents, *args, **kwargs):
+        parts = list(contents) if isinstance(contents, list) else [contents]
+        parts.insert(0, self._cached_content.system_instruction + "\n")
+        return self._model.generate_content(parts, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+
+class LocalPrefixCache(PrefixCache):
+    """In-process stand-in for the provider cache, with the same expiry and refresh bookkeeping."""
+
+    backend = "local"
+
+    def _create(self, prefix, model_name):
+        name = f"local/{prefix.name}/{hashlib.sha256(prefix.text.encode('utf-8')).hexdigest()[:12]}"
+        return LocalCachedContent(name, model_name, prefix.text), time.time() + PREFIX_CACHE_TTL_SECONDS
+
+    def _refresh(self, resource):
+        return time.time() + PREFIX_CACHE_TTL_SECONDS
+
+    def model_for(self, handle, model_factory):
+        return _LocalCachedModel(model_factory(handle.model_name), handle.resource)
+
+
+_BACKENDS = {"vertex": VertexPrefixCache, "local": LocalPrefixCache}
+_cache = None
+_cache_resolved = False
+_cache_lock = threading.Lock()
+
+
+def get_prefix_cache():
+    """The process-wide prefix cache for PREFIX_CACHE_BACKEND (read at first use), or None when it is "off"."""
+    global _cache, _cache_resolved
+    with _cache_lock:
+        if not _cache_resolved:
+            backend = os.getenv("PREFIX_CACHE_BACKEND", PREFIX_CACHE_BACKEND)
+            if backend in _BACKENDS:
+                _cache = _BACKENDS[backend]()
+            elif backend != "off":
+                print(f"WARNING: Unknown PREFIX_CACHE_BACKEND '{backend}'; prompt prefixes are sent inline.")
+            _cache_resolved = True
+        return _cache
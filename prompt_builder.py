@@ -0,0 +1,202 @@
+# prompt_builder.py
+# Assembles stage prompts from named segments (instructions, each patient data section, the diagnostic
+# assessment, ...) and accounts for their size. Each segment's tokens are estimated; paragraphs that already
+# appear in a more important segment of the same prompt are replaced by a short reference; and when a prompt
+# exceeds its stage's token budget, the least important segments are truncated first (required segments,
+# such as the task instructions, never are). The static instruction prefix of a stage is not part of the
+# built prompt (see prefix_cache.py) but is counted against its budget and reported. Every built prompt is
+# recorded on the run's PipelineContext, and generate_full_note logs the per-stage size report at the end of
+# the run.
+#
+# Budgets can be overridden per stage, e.g. PROMPT_TOKEN_BUDGETS="checklist=8000,elaboration=8000" (0 = no budget).
+import math
+import os
+import re
+from collections import namedtuple
+
+# Gemini tokenizes English clinical text at roughly 4 characters per token; close enough for budgeting.
+PROMPT_CHARS_PER_TOKEN = float(os.getenv("PROMPT_CHARS_PER_TOKEN", "4"))
+PROMPT_DEDUPE_MIN_CHARS = int(os.getenv("PROMPT_DEDUPE_MIN_CHARS", "200"))  # Shorter paragraphs are never deduplicated.
+
+# gemini-1.0-pro accepts ~30k input tokens; the large stages leave room for that, the focused ones are kept small.
+DEFAULT_STAGE_TOKEN_BUDGETS = {
+    "note_body": 24000,
+    "diagnostic_assessment": 24000,
+    "primary_diagnosis": 8000,
+    "checklist": 10000,
+    "elaboration": 10000,
+    "literature": 8000,
+}
+
+
+def _parse_budgets(value):
+    budgets = dict(DEFAULT_STAGE_TOKEN_BUDGETS)
+    for item in (value or "").split(","):
+        if "=" in item:
+            stage, tokens = item.split("=", 1)
+            try:
+                budgets[stage.strip()] = int(tokens)
+            except ValueError:
+                print(f"WARNING: Ignoring invalid PROMPT_TOKEN_BUDGETS entry '{item}'.")
+    return budgets
+
+
+STAGE_TOKEN_BUDGETS = _parse_budgets(os.getenv("PROMPT_TOKEN_BUDGETS"))
+
+# A prompt part. `header` is always kept; only `body` is deduplicated or truncated.
+# Higher `priority` means more important: on overflow the lowest-priority truncatable segment is cut first.
+PromptSegment = namedtuple("PromptSegment", ["name", "body", "header", "priority", "required", "dedupe"],
+                           defaults=("", 0, False, False))
+
+
+class BuiltPrompt(namedtuple("BuiltPrompt", ["parts", "report"])):
+    """
+    `parts` are the segment headers, bodies and separators in order, sent to the model as separate text parts:
+    an unchanged body is the caller's own string, so no prompt-sized copy of the patient text is made.
+    """
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+
+_PARAGRAPH_SPLIT_RE = re.compile(r"(\n\s*\n)")
+
+
+def estimate_tokens(text):
+    return int(math.ceil(len(text) / PROMPT_CHARS_PER_TOKEN)) if text else 0
+
+
+def estimate_tokens_of_parts(parts):
+    """estimate_tokens of the concatenated text parts, without concatenating them."""
+    return int(math.ceil(sum(len(part) for part in parts if isinstance(part, str)) / PROMPT_CHARS_PER_TOKEN))
+
+
+def _segment_tokens(segment):
+    return estimate_tokens_of_parts((segment.header, segment.body))
+
+
+def _paragraph_key(paragraph):
+    return " ".join(paragraph.split()).lower()
+
+
+def dedupe_segments(segments):
+    """
+    Replaces each long paragraph of a `dedupe` segment that also occurs in a more important `dedupe` segment
+    (or earlier in an equally important one) with a reference to that segment.
+    """
+    seen = {}
+    bodies = {}
+    for index, segment in sorted(enumerate(segments), key=lambda item: (-item[1].priority, item[0])):
+        if not segment.dedupe or not segment.body:
+            continue
+        parts = _PARAGRAPH_SPLIT_RE.split(segment.body)
+        for i in range(0, len(parts), 2):  # Odd indices are the separators.
+            key = _paragraph_key(parts[i])
+            if len(key) < PROMPT_DEDUPE_MIN_CHARS:
+                continue
+            if key in seen:
+                parts[i] = f"[Same paragraph as in {seen[key]}.]" if seen[key] != segment.name else ""
+                bodies[index] = None
+            else:
+                seen[key] = segment.name
+        if index in bodies:  # Only rebuilt when a paragraph was replaced; otherwise the original string is kept.
+            bodies[index] = "".join(parts)
+    return [segment._replace(body=bodies[i]) if i in bodies else segment for i, segment in enumerate(segments)]
+
+
+def truncate_body(body, max_tokens):
+    """The start of `body` within max_tokens, cut at a paragraph or line break where possible."""
+    if estimate_tokens(body) <= max_tokens:
+        return body
+    marker = "\n[... {} characters omitted to fit the prompt size budget ...]"
+    limit = max(0, int(max_tokens * PROMPT_CHARS_PER_TOKEN) - len(marker) - 8)
+    if limit == 0:
+        return "[Omitted to fit the prompt size budget.]"
+    cut = body.rfind("\n\n", 0, limit)
+    if cut < limit // 2:
+        cut = body.rfind("\n", 0, limit)
+    if cut < limit // 2:
+        cut = limit
+    return body[:cut].rstrip() + marker.format(len(body) - cut)
+
+
+def build_prompt(stage, segments, ctx=None, budget_tokens=None, prefix=None):
+    """
+    Lays out the segments (header + body) as the stage's prompt parts after deduplication and budget enforcement.
+    Returns BuiltPrompt(parts, report); the report is also recorded on `ctx` when given.
+    budget_tokens: overrides STAGE_TOKEN_BUDGETS[stage]; 0 or None without a configured budget means unlimited.
+    prefix: the prefix_cache.StaticPrefix the prompt will be sent with; its tokens count against the budget.
+    """
+    prefix_tokens = estimate_tokens(prefix.text) if prefix is not None else 0
+    original_tokens = {segment.name: _segment_tokens(segment) for segment in segments}
+    segments = dedupe_segments(segments)
+    deduped_tokens = {segment.name: _segment_tokens(segment) for segment in segments}
+
+    budget = STAGE_TOKEN_BUDGETS.get(stage) if budget_tokens is None else budget_tokens
+    truncated = set()
+    total = prefix_tokens + sum(deduped_tokens.values())
+    if budget and total > budget:
+        order = sorted((i for i, s in enumerate(segments) if not s.required and s.body),
+                       key=lambda i: (segments[i].priority, -deduped_tokens[segments[i].name]))
+        for i in order:
+            if total <= budget:
+                break
+            segment = segments[i]
+            body_tokens = estimate_tokens(segment.body)
+            keep = max(0, body_tokens - (total - budget))
+            segments[i] = segment._replace(body=truncate_body(segment.body, keep))
+            total += estimate_tokens(segments[i].body) - body_tokens
+            truncated.add(segment.name)
+
+    parts = []
+    for segment in segments:
+        if parts:
+            parts.append("\n")
+        parts.extend(part for part in (segment.header, segment.body) if part)
+    report = {
+        "stage": stage,
+        "budget_tokens": budget or None,
+        "total_tokens": prefix_tokens + estimate_tokens_of_parts(parts),
+        "prefix": prefix.name if prefix is not None else None,
+        "prefix_tokens": prefix_tokens,
+        "segments": [{
+            "name": segment.name,
+            "original_tokens": original_tokens[segment.name],
+            "tokens": _segment_tokens(segment),
+            "deduplicated": deduped_tokens[segment.name] < original_tokens[segment.name],
+            "truncated": segment.name in truncated,
+        } for segment in segments],
+    }
+    if ctx is not None:
+        ctx.record_prompt(report)
+        budget_note = f" (budget {budget})" if budget else ""
+        prefix_note = f"prefix '{prefix.name}' {prefix_tokens}, " if prefix is not None else ""
+        ctx.log(f"DEBUG: Prompt '{stage}': ~{report['total_tokens']} tokens{budget_note}; {prefix_note}"
+                + ", ".join(_describe_segment(entry) for entry in report["segments"]))
+    return BuiltPrompt(parts, report)
+
+
+def _describe_segment(entry):
+    notes = []
+    if entry["deduplicated"]:
+        notes.append("deduplicated")
+    if entry["truncated"]:
+        notes.append("truncated")
+    if notes:
+        return f"{entry['name']} {entry['tokens']} (was {entry['original_tokens']}, {' and '.join(notes)})"
+    return f"{entry['name']} {entry['tokens']}"
+
+
+def format_size_report(reports):
+    """Per-stage table of estimated prompt tokens (one row per built prompt) for a run's log."""
+    lines = [f"{'stage':<22} {'tokens':>8} {'prefix':>8} {'budget':>8} {'saved':>8}  largest segments"]
+    for report in reports:
+        saved = sum(s["original_tokens"] for s in report["segments"]) - sum(s["tokens"] for s in report["segments"])
+        largest = sorted(report["segments"], key=lambda s: -s["tokens"])[:3]
+        lines.append(f"{report['stage']:<22} {report['total_tokens']:>8} {report['prefix_tokens']:>8} "
+                     f"{report['budget_tokens'] or '-':>8} {saved:>8}  "
+                     + ", ".join(f"{s['name']} {s['tokens']}" for s in largest))
+    lines.append(f"{'total':<22} {sum(r['total_tokens'] for r in reports):>8} "
+                 f"{sum(r['prefix_tokens'] for r in reports):>8}")
+    return lines
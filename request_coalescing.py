@@ -0,0 +1,110 @@
+# request_coalescing.py
+# Single-flight execution for /generate_note.
+# Identical requests (same processed section texts and de-identify flag) that arrive while one is already
+# running attach to that run and receive its result instead of starting their own pipeline run.
+# Results can also be remembered for a short window under a client-supplied idempotency key, so a
+# browser retry after a slow response gets the stored result.
+import hashlib
+import threading
+import time
+
+
+def request_fingerprint(*parts):
+    """Stable hash of the request content; parts are joined with a separator that cannot appear in text."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode("utf-8", errors="replace"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+class _InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    `do(key, fn)` runs fn() once per key at a time; concurrent callers with the same key wait for and
+    share the first caller's result (or exception). Counts are kept in `stats()`.
+    """
+
+    def __init__(self, idempotency_ttl_seconds=600, max_idempotent_results=256):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._idempotent_results = {}  # idempotency key -> (expires_at, result)
+        self._idempotency_ttl = idempotency_ttl_seconds
+        self._max_idempotent_results = max_idempotent_results
+        self._counts = {"executions": 0, "coalesced": 0, "idempotent_hits": 0, "errors": 0}
+
+    def do(self, key, fn):
+        """Returns (result, shared) where shared is True if this call attached to an in-flight run."""
+        with self._lock:
+            call = self._in_flight.get(key)
+            if call is not None:
+                call.waiters += 1
+                self._counts["coalesced"] += 1
+                leader = False
+            else:
+                call = _InFlightCall()
+                self._in_flight[key] = call
+                self._counts["executions"] += 1
+                leader = True
+
+        if not leader:
+            print(f"DEBUG: Coalescing duplicate request {key[:12]} onto in-flight run.")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            with self._lock:
+                self._counts["errors"] += 1
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            call.done.set()
+            if call.waiters:
+                print(f"DEBUG: Run {key[:12]} finished; shared its result with {call.waiters} duplicate request(s).")
+        return call.result, False
+
+    def get_idempotent_result(self, idempotency_key):
+        """Stored result for an idempotency key within its window, or None."""
+        if not idempotency_key:
+            return None
+        with self._lock:
+            entry = self._idempotent_results.get(idempotency_key)
+            if entry is None:
+                return None
+            expires_at, result = entry
+            if expires_at < time.monotonic():
+                del self._idempotent_results[idempotency_key]
+                return None
+            self._counts["idempotent_hits"] += 1
+            return result
+
+    def store_idempotent_result(self, idempotency_key, result):
+        if not idempotency_key:
+            return
+        now = time.monotonic()
+        with self._lock:
+            expired = [k for k, (expires_at, _) in self._idempotent_results.items() if expires_at < now]
+            for k in expired:
+                del self._idempotent_results[k]
+            while len(self._idempotent_results) >= self._max_idempotent_results:
+                oldest = min(self._idempotent_results, key=lambda k: self._idempotent_results[k][0])
+                del self._idempotent_results[oldest]
+            self._idempotent_results[idempotency_key] = (now + self._idempotency_ttl, result)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts, in_flight=len(self._in_flight),
+                        stored_idempotent_results=len(self._idempotent_results))
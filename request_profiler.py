@@ -0,0 +1,213 @@
+# request_profiler.py
+# Opt-in per-request profiling for /generate_note.
+# A request is profiled when it carries the X-Profile-Request header (values: "1"/"full" or "sampling") or
+# is picked by PROFILE_SAMPLE_RATE. The request thread then runs under cProfile (full mode) and a sampling
+# thread records its stack every PROFILE_SAMPLE_INTERVAL_MS. Stage boundaries marked with profile_stage()
+# (upload extraction, de-identification, each pipeline stage) record wall and thread-CPU time, and every stack
+# sample is prefixed with the stage it was taken in. A stage with much more wall than CPU time was waiting,
+# mostly on model calls; a stage where they are close is a local CPU hotspot.
+# Each profile is saved to PROFILE_DIR as <id>.pstats, <id>.collapsed (for flamegraph.pl / speedscope) and
+# <id>.json (stage table); only the newest PROFILE_RING_SIZE profiles are kept.
+#
+#     python request_profiler.py list
+#     python request_profiler.py show <profile_id> [N]
+import cProfile
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+PROFILE_HEADER = "X-Profile-Request"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # Fraction of requests profiled without the header.
+PROFILE_DEFAULT_MODE = os.getenv("PROFILE_DEFAULT_MODE", "sampling")  # Mode for sampled requests.
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join("data", "profiles"))
+PROFILE_RING_SIZE = int(os.getenv("PROFILE_RING_SIZE", "50"))
+
+_PROFILE_MODES = ("full", "sampling")
+_active = threading.local()
+_ring_lock = threading.Lock()
+
+
+class RequestProfile:
+    """Profiling state of one request, bound to the thread that started it."""
+
+    def __init__(self, label, mode):
+        self.profile_id = f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:8]}"
+        self.label = label
+        self.mode = mode
+        self.thread_id = threading.get_ident()
+        self.stages = []  # {"stage", "depth", "start_ms", "wall_ms", "cpu_ms"}
+        self.stage_stack = []
+        self.samples = Counter()
+        self._profiler = cProfile.Profile() if mode == "full" else None
+        self._stop_sampling = threading.Event()
+        self._sampler = None
+        self._started_wall = None
+        self._started_cpu = None
+        self.wall_ms = None
+        self.cpu_ms = None
+
+    def start(self):
+        self._started_wall = time.perf_counter()
+        self._started_cpu = time.thread_time()
+        self._sampler = threading.Thread(target=self._sample_loop, name=f"profiler-{self.profile_id}", daemon=True)
+        self._sampler.start()
+        if self._profiler:
+            self._profiler.enable()
+
+    def stop(self):
+        if self._profiler:
+            self._profiler.disable()
+        self.wall_ms = (time.perf_counter() - self._started_wall) * 1000
+        self.cpu_ms = (time.thread_time() - self._started_cpu) * 1000
+        self._stop_sampling.set()
+        self._sampler.join()
+
+    def _sample_loop(self):
+        interval = PROFILE_SAMPLE_INTERVAL_MS / 1000
+        while not self._stop_sampling.wait(interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            stage_path = [f"stage:{name}" for name in list(self.stage_stack)] or ["stage:(none)"]
+            self.samples[";".join(stage_path + stack[::-1])] += 1
+
+    @contextmanager
+    def stage(self, name):
+        entry = {"stage": name, "depth": len(self.stage_stack),
+                 "start_ms": round((time.perf_counter() - self._started_wall) * 1000, 2)}
+        self.stage_stack.append(name)
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            entry["wall_ms"] = round((time.perf_counter() - wall) * 1000, 2)
+            entry["cpu_ms"] = round((time.thread_time() - cpu) * 1000, 2)
+            self.stage_stack.pop()
+            self.stages.append(entry)
+
+    def save(self):
+        """Writes the profile files and trims the ring. Returns the base path."""
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, self.profile_id)
+        if self._profiler:
+            self._profiler.dump_stats(base + ".pstats")
+        with open(base + ".collapsed", "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        summary = {
+            "profile_id": self.profile_id, "label": self.label, "mode": self.mode,
+            "wall_ms": round(self.wall_ms, 2), "cpu_ms": round(self.cpu_ms, 2),
+            "sample_interval_ms": PROFILE_SAMPLE_INTERVAL_MS, "samples": sum(self.samples.values()),
+            "stages": sorted(self.stages, key=lambda s: s["start_ms"]),
+        }
+        with open(base + ".json", "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=1)
+        _trim_ring()
+        return base
+
+
+def _trim_ring():
+    with _ring_lock:
+        try:
+            ids = sorted({name.rsplit(".", 1)[0] for name in os.listdir(PROFILE_DIR) if name.endswith(".json")})
+        except OSError:
+            return
+        for profile_id in ids[:max(0, len(ids) - PROFILE_RING_SIZE)]:
+            for ext in (".pstats", ".collapsed", ".json"):
+                try:
+                    os.remove(os.path.join(PROFILE_DIR, profile_id + ext))
+                except OSError:
+                    pass
+
+
+def requested_mode(header_value):
+    """The profiling mode for a request, or None if it is not profiled."""
+    value = (header_value or "").strip().lower()
+    if value in _PROFILE_MODES:
+        return value
+    if value in ("1", "true", "yes", "on"):
+        return "full"
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return PROFILE_DEFAULT_MODE
+    return None
+
+
+@contextmanager
+def profile_request(label, header_value=None):
+    """
+    Profiles the body of the with-block when requested (see requested_mode) and yields the RequestProfile,
+    otherwise yields None at no cost. The profile is saved when the block exits, also on errors.
+    """
+    mode = requested_mode(header_value)
+    if mode is None or getattr(_active, "profile", None) is not None:
+        yield None
+        return
+    profile = RequestProfile(label, mode)
+    _active.profile = profile
+    profile.start()
+    try:
+        yield profile
+    finally:
+        profile.stop()
+        _active.profile = None
+        try:
+            base = profile.save()
+            print(f"DEBUG: Saved {mode} profile of {label} ({profile.wall_ms:.0f} ms wall, "
+                  f"{profile.cpu_ms:.0f} ms CPU) to {base}.*")
+        except OSError as e:
+            print(f"WARNING: Could not save request profile {profile.profile_id}: {e}")
+
+
+@contextmanager
+def profile_stage(name):
+    """Marks a stage boundary in the current thread's request profile; does nothing when not profiling."""
+    profile = getattr(_active, "profile", None)
+    if profile is None:
+        yield
+        return
+    with profile.stage(name):
+        yield
+
+
+def _print_profile(profile_id, top_n=25):
+    import pstats
+
+    base = os.path.join(PROFILE_DIR, profile_id)
+    with open(base + ".json", "r", encoding="utf-8") as f:
+        summary = json.load(f)
+    print(f"{summary['label']} [{summary['mode']}]: {summary['wall_ms']:.0f} ms wall, {summary['cpu_ms']:.0f} ms CPU, "
+          f"{summary['samples']} samples")
+    print(f"{'stage':<40} {'start ms':>10} {'wall ms':>10} {'cpu ms':>10} {'waiting':>8}")
+    for s in summary["stages"]:
+        waiting = 1 - s["cpu_ms"] / s["wall_ms"] if s["wall_ms"] else 0.0
+        print(f"{'  ' * s['depth'] + s['stage']:<40} {s['start_ms']:>10.1f} {s['wall_ms']:>10.1f} "
+              f"{s['cpu_ms']:>10.1f} {waiting:>8.0%}")
+    if os.path.exists(base + ".pstats"):
+        pstats.Stats(base + ".pstats").sort_stats("cumulative").print_stats(top_n)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == "list":
+        for name in sorted(os.listdir(PROFILE_DIR)) if os.path.isdir(PROFILE_DIR) else []:
+            if name.endswith(".json"):
+                with open(os.path.join(PROFILE_DIR, name), "r", encoding="utf-8") as f:
+                    info = json.load(f)
+                print(f"{info['profile_id']}  {info['label']:<20} {info['mode']:<9} {info['wall_ms']:>9.0f} ms wall "
+                      f"{info['cpu_ms']:>9.0f} ms CPU")
+    elif len(sys.argv) >= 3 and sys.argv[1] == "show":
+        _print_profile(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 25)
+    else:
+        print("Usage: python request_profiler.py list | show <profile_id> [N]")
+        sys.exit(2)
@@ -0,0 +1,73 @@
+# response_compression.py
+# Content-encoding negotiation for the app's responses. A finished note is tens of kilobytes of markdown (and
+# as much again as rendered HTML), which matters on slow clinic networks. JSON, HTML and text responses of at
+# least COMPRESS_MIN_BYTES are sent with brotli when the client accepts it and the optional `brotli` package
+# is installed, otherwise gzip. Streamed responses (send_file, chunk downloads) are left alone.
+# Compressed responses carry "Vary: Accept-Encoding", and their ETag is made weak, since the bytes now
+# depend on the encoding; If-None-Match uses weak comparison, so revalidation still returns 304.
+import gzip
+import os
+
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "6"))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "5"))  # 11 is far slower for little gain here.
+
+COMPRESSIBLE_MIMETYPES = {"application/json", "text/html", "text/plain", "text/css", "application/javascript"}
+
+_brotli = None
+_brotli_checked = False
+
+
+def _get_brotli():
+    """The brotli module if installed (optional dependency), else None."""
+    global _brotli, _brotli_checked
+    if not _brotli_checked:
+        try:
+            import brotli
+            _brotli = brotli
+        except ImportError:
+            _brotli = None
+        _brotli_checked = True
+    return _brotli
+
+
+def available_encodings():
+    return ["br", "gzip"] if _get_brotli() is not None else ["gzip"]
+
+
+def choose_encoding(accept_encodings):
+    """The best of available_encodings() for a werkzeug Accept-Encoding header, or None."""
+    return accept_encodings.best_match(available_encodings())
+
+
+def compress(data, encoding):
+    if encoding == "br":
+        return _get_brotli().compress(data, quality=COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=COMPRESS_GZIP_LEVEL, mtime=0)
+
+
+def _weaken_etag(response):
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def compress_response(response, accept_encodings):
+    """Flask after_request hook body: compresses `response` in place when worthwhile. Returns it."""
+    if response.status_code == 304:
+        response.vary.add("Accept-Encoding")
+        if choose_encoding(accept_encodings):
+            _weaken_etag(response)  # Same validator as the compressed 200 the client is revalidating.
+        return response
+    if (response.direct_passthrough or response.is_streamed or "Content-Encoding" in response.headers
+            or response.status_code < 200 or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding(accept_encodings)
+    data = response.get_data()
+    if encoding is None or len(data) < COMPRESS_MIN_BYTES:
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    _weaken_etag(response)
+    return response
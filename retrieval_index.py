@@ -0,0 +1,145 @@
+# retrieval_index.py
+# Per-request, in-memory BM25 index over the patient input sections.
+# Stages that only need specific facts (e.g. the Alzheimer's checklist) declare their information needs
+# in STAGE_INFORMATION_NEEDS and receive only the top-k relevant passages from each section,
+# instead of the full concatenation of every input. Pure Python, no external dependencies.
+import math
+import os
+import re
+from collections import Counter
+
+# Set NOTE_RETRIEVAL_CONTEXT=0 to send every stage the full input text again.
+RETRIEVAL_CONTEXT_ENABLED = os.getenv("NOTE_RETRIEVAL_CONTEXT", "1") != "0"
+
+PASSAGE_MAX_CHARS = 600
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# What each retrieval-backed stage needs to see. Multi-word needs are tokenized like the passages.
+STAGE_INFORMATION_NEEDS = {
+    "checklist": [
+        "age years old", "MMSE mini mental", "MoCA montreal", "CDR clinical dementia rating", "FAQ functional",
+        "GDS geriatric depression", "BMI weight height kg", "APOE genotype e4", "INR", "platelets",
+        "anticoagulant warfarin apixaban rivaroxaban dabigatran edoxaban heparin", "aPTT CBC CMP TSH B12 folate vitamin D",
+        "MRI microhemorrhages siderosis white matter infarct stroke", "amyloid PET CSF biomarker tau",
+        "pacemaker implant claustrophobia", "cancer malignancy oncology", "depression anxiety suicidal psychiatric",
+        "alcohol drug substance", "pregnant lactating", "HIV immunological autoimmune", "seizure TIA",
+        "monoclonal antibody immunoglobulin biologic", "mild cognitive impairment dementia",
+    ],
+    "elaboration": [
+        "onset gradual insidious progression years decline", "memory forgetting repeating misplacing",
+        "language word finding", "executive planning", "visuospatial getting lost", "behavior personality",
+        "function ADL IADL independence driving", "MMSE MoCA CDR FAQ score", "amyloid PET CSF biomarker tau",
+        "MRI atrophy hippocampal vascular stroke", "FDG PET hypometabolism", "APOE genotype",
+        "depression medications delirium thyroid B12", "family history dementia",
+    ],
+}
+STAGE_RETRIEVAL_TOP_K = {
+    "checklist": 16,
+    "elaboration": 20,
+}
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_SENTENCE_BREAK_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall(text.lower())
+
+
+def split_into_passages(text, max_chars=PASSAGE_MAX_CHARS):
+    """Paragraph-level passages; paragraphs longer than max_chars are split into sentence windows."""
+    passages = []
+    for paragraph in re.split(r"\n\s*\n", text or ""):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= max_chars:
+            passages.append(paragraph)
+            continue
+        window = ""
+        for sentence in _SENTENCE_BREAK_RE.split(paragraph):
+            if window and len(window) + len(sentence) + 1 > max_chars:
+                passages.append(window)
+                window = ""
+            window = f"{window} {sentence}".strip()
+        if window:
+            passages.append(window)
+    return passages
+
+
+class InputRetrievalIndex:
+    """
+    BM25 index over passages of the named input sections, built once per request.
+    `sections` is an ordered mapping of section name -> text.
+    """
+
+    def __init__(self, sections):
+        self.section_names = list(sections)
+        self.section_chars = {name: len(text or "") for name, text in sections.items()}
+        self.passages = []  # (section_name, position_in_section, text)
+        self._term_freqs = []
+        self._lengths = []
+        doc_freq = Counter()
+        for name, text in sections.items():
+            for position, passage in enumerate(split_into_passages(text)):
+                terms = Counter(tokenize(passage))
+                self.passages.append((name, position, passage))
+                self._term_freqs.append(terms)
+                self._lengths.append(sum(terms.values()))
+                doc_freq.update(terms.keys())
+        n = len(self.passages)
+        self._avg_length = (sum(self._lengths) / n) if n else 0.0
+        self._idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freq.items()}
+
+    def _score(self, passage_index, query_terms):
+        term_freqs = self._term_freqs[passage_index]
+        length_norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[passage_index] / (self._avg_length or 1.0))
+        score = 0.0
+        for term in query_terms:
+            tf = term_freqs.get(term)
+            if tf:
+                score += self._idf[term] * tf * (BM25_K1 + 1) / (tf + length_norm)
+        return score
+
+    def search(self, needs, top_k):
+        """
+        Scores every passage against each information need and keeps, for each passage, its best
+        need score (so one frequent topic cannot crowd out the rest). Returns the top_k passage indices.
+        """
+        best = {}
+        for need in needs:
+            query_terms = set(tokenize(need))
+            for i in range(len(self.passages)):
+                score = self._score(i, query_terms)
+                if score > best.get(i, 0.0):
+                    best[i] = score
+        ranked = sorted(best, key=lambda i: best[i], reverse=True)
+        return ranked[:top_k]
+
+    def context_for_stage(self, stage, top_k=None, needs=None):
+        """
+        Returns (header, {section_name: text}) with only the passages relevant to `stage`,
+        kept in their original order within each section. `needs` defaults to the stage's declared needs.
+        """
+        needs = STAGE_INFORMATION_NEEDS[stage] if needs is None else needs
+        top_k = top_k or STAGE_RETRIEVAL_TOP_K.get(stage, 12)
+        selected = sorted(self.search(needs, top_k), key=lambda i: (self.section_names.index(self.passages[i][0]),
+                                                                    self.passages[i][1]))
+        by_section = {name: [] for name in self.section_names}
+        for i in selected:
+            by_section[self.passages[i][0]].append(self.passages[i][2])
+
+        section_texts = {}
+        for name in self.section_names:
+            if by_section[name]:
+                section_texts[name] = "\n[...]\n".join(by_section[name])
+            elif self.section_chars[name]:
+                section_texts[name] = "No passages relevant to this stage were found in this section."
+            else:
+                section_texts[name] = ""
+        total_chars = sum(self.section_chars.values())
+        kept_chars = sum(len(self.passages[i][2]) for i in selected)
+        header = (f"NOTE: Patient data below is limited to the {len(selected)} of {len(self.passages)} passages most "
+                  f"relevant to this task ({kept_chars} of {total_chars} characters); omitted text is marked [...].")
+        return header, section_texts
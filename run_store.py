@@ -0,0 +1,113 @@
+# run_store.py
+# Local SQLite store of pipeline runs: the inputs of each run and the output of every completed stage.
+# generate_full_note checkpoints each stage here under a run ID, so a run that failed part-way
+# (e.g. the checklist call errored or the literature summary timed out) can be resumed and only the
+# failed or missing stages are executed again. Runs older than RUN_RETENTION_HOURS are purged.
+# Each input text is stored as its own run_inputs row, bound directly as a parameter: the inputs can be
+# megabytes of records, and one JSON document of all of them would hold an escaped copy of every text in memory.
+import json
+import os
+import sqlite3
+import time
+import uuid
+
+from sqlite_store import SQLiteStore
+
+RUN_STORE_PATH = os.getenv("RUN_STORE_PATH", os.path.join("data", "runs.sqlite3"))
+RUN_RETENTION_SECONDS = int(os.getenv("RUN_RETENTION_HOURS", "72")) * 3600
+RUN_PURGE_INTERVAL_SECONDS = 600
+
+_last_purge = {"at": 0.0}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    status TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stage_outputs (
+    run_id TEXT NOT NULL REFERENCES runs(run_id) ON DELETE CASCADE,
+    stage TEXT NOT NULL,
+    output TEXT NOT NULL,
+    completed_at REAL NOT NULL,
+    PRIMARY KEY (run_id, stage)
+);
+CREATE TABLE IF NOT EXISTS run_inputs (
+    run_id TEXT NOT NULL REFERENCES runs(run_id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value TEXT,
+    is_json INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (run_id, name)
+);
+CREATE INDEX IF NOT EXISTS runs_updated_at ON runs(updated_at);
+"""
+_store = SQLiteStore(_SCHEMA)
+
+
+def new_run_id():
+    return uuid.uuid4().hex
+
+
+def _transaction():
+    return _store.transaction(RUN_STORE_PATH)
+
+
+def create_run(run_id, inputs):
+    """Registers a new run with its input texts (a dict of generate_full_note keyword arguments)."""
+    now = time.time()
+    with _transaction() as conn:
+        conn.execute("INSERT INTO runs (run_id, created_at, updated_at, status) VALUES (?, ?, ?, ?)",
+                     (run_id, now, now, "running"))
+        conn.executemany("INSERT INTO run_inputs (run_id, name, value, is_json) VALUES (?, ?, ?, ?)",
+                         ((run_id, name, value, 0) if value is None or isinstance(value, str)
+                          else (run_id, name, json.dumps(value), 1) for name, value in inputs.items()))
+    maybe_purge_expired_runs()
+
+
+def load_run(run_id):
+    """Returns {"status", "inputs", "stages": {stage: output}} or None if the run is unknown or purged."""
+    with _transaction() as conn:
+        row = conn.execute("SELECT status FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        if row is None:
+            return None
+        inputs = {name: json.loads(value) if is_json else value for name, value, is_json in
+                  conn.execute("SELECT name, value, is_json FROM run_inputs WHERE run_id = ?", (run_id,))}
+        stages = {stage: json.loads(output) for stage, output in
+                  conn.execute("SELECT stage, output FROM stage_outputs WHERE run_id = ?", (run_id,))}
+    return {"status": row[0], "inputs": inputs, "stages": stages}
+
+
+def save_stage_output(run_id, stage, output):
+    now = time.time()
+    with _transaction() as conn:
+        conn.execute("INSERT OR REPLACE INTO stage_outputs (run_id, stage, output, completed_at) VALUES (?, ?, ?, ?)",
+                     (run_id, stage, json.dumps(output), now))
+        conn.execute("UPDATE runs SET updated_at = ? WHERE run_id = ?", (now, run_id))
+
+
+def set_run_status(run_id, status):
+    with _transaction() as conn:
+        conn.execute("UPDATE runs SET status = ?, updated_at = ? WHERE run_id = ?", (status, time.time(), run_id))
+
+
+def purge_expired_runs(retention_seconds=RUN_RETENTION_SECONDS):
+    """Deletes runs (and their stage outputs) not updated within the retention period. Returns the count."""
+    cutoff = time.time() - retention_seconds
+    with _transaction() as conn:
+        deleted = conn.execute("DELETE FROM runs WHERE updated_at < ?", (cutoff,)).rowcount
+    if deleted:
+        print(f"DEBUG: Purged {deleted} expired pipeline runs from the run store.")
+    return deleted
+
+
+def maybe_purge_expired_runs():
+    """Purges at most once per RUN_PURGE_INTERVAL_SECONDS, piggybacking on run creation."""
+    now = time.monotonic()
+    if _last_purge["at"] and now - _last_purge["at"] < RUN_PURGE_INTERVAL_SECONDS:
+        return
+    _last_purge["at"] = now
+    try:
+        purge_expired_runs()
+    except sqlite3.Error as e:
+        print(f"WARNING: Run store purge failed: {e}")
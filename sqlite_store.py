@@ -0,0 +1,40 @@
+# sqlite_store.py
+# The connection handling shared by the local SQLite stores (run_store, patient_fact_store, note_archive):
+# a short-lived connection per operation with foreign keys on, WAL journaling and the store's schema applied
+# once per database path, and a transaction context. SQLite serializes writers across threads and processes.
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class SQLiteStore:
+    """One store's schema; the database path is passed per call, so a store can be pointed elsewhere at runtime."""
+
+    def __init__(self, schema):
+        self.schema = schema
+        self._schema_lock = threading.Lock()
+        self._schema_ready_for = None
+
+    def connect(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute("PRAGMA foreign_keys = ON")
+        if self._schema_ready_for != path:
+            with self._schema_lock:
+                if self._schema_ready_for != path:
+                    conn.execute("PRAGMA journal_mode = WAL")
+                    conn.executescript(self.schema)
+                    self._schema_ready_for = path
+        return conn
+
+    @contextmanager
+    def transaction(self, path):
+        conn = self.connect(path)
+        try:
+            with conn:  # Commits on success, rolls back on error.
+                yield conn
+        finally:
+            conn.close()
@@ -0,0 +1,82 @@
+# startup_benchmark.py
+# Import-time guard for the web app and the core pipeline, based on `python -X importtime`.
+# Run from the project directory:  python startup_benchmark.py
+# Exits non-zero if a module goes over its budget or eagerly imports one of the heavy SDKs,
+# so it can be used as a check in CI alongside the rest of the test run.
+import os
+import subprocess
+import sys
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Cumulative import time budgets in milliseconds (override with STARTUP_BUDGET_<MODULE>_MS).
+IMPORT_TIME_BUDGETS_MS = {
+    "note_processing_core": 100,
+    "APP": 1000,  # Dominated by Flask/Werkzeug themselves.
+}
+
+# Modules that must never be pulled in just by importing the app or the core module.
+HEAVY_MODULES = ("google.cloud.aiplatform", "vertexai", "Bio.Entrez")
+
+IMPORT_RUNS = 3  # Best-of-N, to smooth out a cold filesystem cache.
+
+
+def measure_import_time(module_name):
+    """
+    Imports `module_name` in a fresh interpreter with `-X importtime`.
+    Returns (cumulative_ms, imported_module_names) for the fastest of IMPORT_RUNS runs.
+    """
+    best_ms = None
+    imported = set()
+    for _ in range(IMPORT_RUNS):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+            cwd=PROJECT_DIR, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"Importing {module_name} failed:\n{result.stderr[-2000:]}")
+
+        cumulative_us = None
+        run_imported = set()
+        for line in result.stderr.splitlines():
+            # Format: "import time: <self us> | <cumulative us> | <indented module name>"
+            if not line.startswith("import time:"):
+                continue
+            parts = line[len("import time:"):].split("|")
+            if len(parts) != 3 or not parts[1].strip().isdigit():
+                continue  # Header line
+            name = parts[2].strip()
+            run_imported.add(name)
+            if name == module_name:
+                cumulative_us = int(parts[1])
+        if cumulative_us is None:
+            raise RuntimeError(f"No importtime entry found for {module_name}.")
+
+        run_ms = cumulative_us / 1000.0
+        if best_ms is None or run_ms < best_ms:
+            best_ms = run_ms
+        imported = run_imported
+    return best_ms, imported
+
+
+def check_startup_budget(budgets=None):
+    """Returns a list of human-readable failures (empty when everything is within budget)."""
+    budgets = budgets or IMPORT_TIME_BUDGETS_MS
+    failures = []
+    for module_name, default_budget_ms in budgets.items():
+        budget_ms = float(os.getenv(f"STARTUP_BUDGET_{module_name.upper()}_MS", default_budget_ms))
+        elapsed_ms, imported = measure_import_time(module_name)
+        print(f"{module_name}: {elapsed_ms:.1f} ms (budget {budget_ms:.0f} ms)")
+        if elapsed_ms > budget_ms:
+            failures.append(f"{module_name} import took {elapsed_ms:.1f} ms, budget is {budget_ms:.0f} ms")
+        heavy = sorted(name for name in imported if name in HEAVY_MODULES)
+        if heavy:
+            failures.append(f"{module_name} eagerly imports heavy SDK module(s): {', '.join(heavy)}")
+    return failures
+
+
+if __name__ == '__main__':
+    startup_failures = check_startup_budget()
+    for failure in startup_failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if startup_failures else 0)
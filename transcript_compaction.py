@@ -0,0 +1,280 @@
+# transcript_compaction.py
+# Local, deterministic compaction of the visit transcription before generate_full_note builds its prompts.
+# Speech-to-text output carries a lot that costs tokens in every prompt it is copied into without adding
+# information: fillers ("um", "uh", and "you know"/"I mean" set off by commas or opening a clause), false starts
+# and stutters ("she- she was", "I I think"), chunk timestamps ("[00:04:10]", SRT/VTT cue timings), a speaker label
+# on every line, and sentences said twice. The stage, which runs on the de-identified text:
+#   - strips disfluencies and timestamp noise,
+#   - merges consecutive turns of the same speaker into one "Speaker: ..." line,
+#   - drops sentences that repeat an earlier one by the same speaker, exactly or nearly (Jaccard similarity of
+#     hashed word 3-grams of at least TRANSCRIPT_NEAR_DUPLICATE_SIMILARITY, or all of its 3-grams already said; the
+#     numbers in both must match, so "7 times" is never dropped as a repeat of "3 times"; questions are only
+#     compared with questions, so an answer that echoes the question is kept), and
+#   - optionally (TRANSCRIPT_DROP_SMALL_TALK=1) drops small talk: sentences with small-talk keywords and no
+#     clinical keyword or number.
+# Short sentences ("Yes.", "No.", "Mm-hmm.") are never deduplicated: each answers the question before it.
+# Every case reports the character and estimated token reduction. With TRANSCRIPT_KEEP_RAW=1 the raw transcript
+# is archived with the note for auditing (the run store always keeps the raw inputs until the run is purged).
+import os
+import re
+import sys
+import zlib
+from collections import namedtuple
+
+from prompt_builder import estimate_tokens
+
+TRANSCRIPT_COMPACTION_ENABLED = os.getenv("TRANSCRIPT_COMPACTION", "1") != "0"
+TRANSCRIPT_KEEP_RAW = os.getenv("TRANSCRIPT_KEEP_RAW", "0") == "1"
+TRANSCRIPT_DROP_SMALL_TALK = os.getenv("TRANSCRIPT_DROP_SMALL_TALK", "0") == "1"
+TRANSCRIPT_NEAR_DUPLICATE_SIMILARITY = float(os.getenv("TRANSCRIPT_NEAR_DUPLICATE_SIMILARITY", "0.8"))
+TRANSCRIPT_DEDUPE_MIN_WORDS = 5  # Shorter sentences are kept even when repeated.
+SHINGLE_WORDS = 3
+
+CompactionReport = namedtuple("CompactionReport", [
+    "raw_chars", "compact_chars", "raw_tokens", "compact_tokens", "fillers_removed", "timestamps_removed",
+    "turns_merged", "duplicates_removed", "small_talk_removed"])
+
+_SPEAKER_WORDS = (r"doctor|dr\.?(?:\s+\[?[A-Za-z_0-9]+\]?)?|physician|provider|clinician|nurse|np|pa|resident|"
+                  r"fellow|patient|pt|daughter|son|wife|husband|spouse|partner|caregiver|mother|father|sister|"
+                  r"brother|friend|interpreter|family(?:\s+member)?|speaker\s*_?\d+|\[[A-Z]+_\d+\]")
+# A speaker label starts a line or follows the end of a sentence: "Doctor: ...", "SPEAKER_1: ...".
+_SPEAKER_RE = re.compile(rf"(?:^|(?<=[.!?\"]\s)|(?<=\n))[ \t]*(?P<label>{_SPEAKER_WORDS})[ \t]*:[ \t]*",
+                         re.IGNORECASE | re.MULTILINE)
+_CUE_TIME = r"\d{1,2}:\d{2}(?::\d{2})?(?:[.,]\d{1,3})?"
+_TIMESTAMP_RES = (
+    re.compile(r"^\s*WEBVTT.*$", re.MULTILINE),  # VTT header
+    # SRT cue numbers: only a number alone on the line before a cue timing, so "How many times?\n3" keeps the 3.
+    re.compile(rf"^[ \t]*\d+[ \t]*$(?=\n[ \t]*{_CUE_TIME}[ \t]*-->)", re.MULTILINE),
+    re.compile(rf"^\s*{_CUE_TIME}\s*-->\s*{_CUE_TIME}.*$", re.MULTILINE),  # SRT/VTT cue timings
+    re.compile(r"[\[(]\d{1,2}:\d{2}(?::\d{2})?(?:[.,]\d{1,3})?[\])]"),  # [00:04:10], (4:10)
+    re.compile(r"^[ \t]*\d{1,2}:\d{2}(?::\d{2})?(?=[ \t])", re.MULTILINE),  # a bare time at the start of a line
+)
+_FILLER_RE = re.compile(r"(?:,\s*)?\b(?:u+m+|u+h+|e+r+m+|e+h+|a+h+|h+m+)\b(?:\s*,)?(?=[\s.,!?]|$)", re.IGNORECASE)
+# "you know" / "I mean" only between commas or opening a clause before a comma: "Do you know what year it is?" stays.
+_PHRASE_FILLER_RE = re.compile(r"(?:,[ \t]*|^|(?<=[.!?;:][ \t]))\b(?:you know|i mean)\b"
+                               r"(?:[ \t]*,|(?=[ \t]*(?:[.!?]|$)))", re.IGNORECASE)
+# A fragment followed by the same word or one starting with it: "sh- she", "went-- went"; not "March-- no, April".
+_FRAGMENT_RE = re.compile(r"\b([A-Za-z]{1,12})--?[ \t]+(?=\1)", re.IGNORECASE)
+_REPEAT_RE = re.compile(r"\b((?:[A-Za-z']+\s+){0,3}[A-Za-z']+)(?:[\s,]+\1\b)+", re.IGNORECASE)
+_LEGITIMATE_REPEATS = {"that that", "had had", "is is"}
+_SENTENCE_RE = re.compile(r"[^.!?\n]+(?:[.!?]+|$)")
+_WORD_RE = re.compile(r"[a-z0-9']+")
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)?")
+
+# The keyword model for TRANSCRIPT_DROP_SMALL_TALK.
+SMALL_TALK_KEYWORDS = {
+    "weather", "rain", "raining", "snow", "sunny", "traffic", "parking", "parked", "football", "baseball",
+    "basketball", "game", "team", "spurs", "cowboys", "vacation", "holiday", "holidays", "weekend", "movie",
+    "restaurant", "nice", "meet", "seat", "thanks", "thank", "bye", "goodbye", "morning", "afternoon", "hello", "hi",
+}
+CLINICAL_KEYWORDS = {
+    "memory", "forget", "forgets", "forgetting", "forgot", "confused", "confusion", "repeat", "repeats", "lost",
+    "medication", "medications", "medicine", "pill", "pills", "dose", "mg", "sleep", "sleeping", "pain", "fall",
+    "fell", "falls", "driving", "mood", "depressed", "anxious", "hallucinations", "mri", "scan", "pet", "test",
+    "tests", "blood", "symptom", "symptoms", "walk", "walking", "balance", "tremor", "speech", "words", "eat",
+    "eating", "weight", "bathing", "dressing", "bills", "money", "cooking", "alone", "safety", "worse", "better",
+    "started", "since", "years", "months", "weeks", "daily", "night", "appointment", "doctor", "neurologist",
+    "drive", "drives", "hot", "cold", "dizzy", "headache",
+}
+
+
+def _strip_timestamps(text):
+    removed = 0
+    for pattern in _TIMESTAMP_RES:
+        text, count = pattern.subn("", text)
+        removed += count
+    return text, removed
+
+
+def _clean_disfluencies(text):
+    """Returns (text, fillers removed): fillers, word fragments and repeated words or phrases dropped."""
+    text, fillers = _FILLER_RE.subn("", text)
+    text, phrases = _PHRASE_FILLER_RE.subn("", text)
+    text, fragments = _FRAGMENT_RE.subn("", text)
+
+    def collapse(match):
+        phrase = match.group(1)
+        if phrase.lower() in _LEGITIMATE_REPEATS or not phrase.strip():
+            return match.group(0)
+        return phrase
+
+    text, repeats = _REPEAT_RE.subn(collapse, text)
+    text = re.sub(r"[ \t]{2,}", " ", text)
+    text = re.sub(r"\s+([,.!?])", r"\1", text)
+    text = re.sub(r"([.!?])[,]+", r"\1", text)
+    text = re.sub(r"(^|[.!?]\s+),\s*", r"\1", text)
+    return text.strip(" ,"), fillers + phrases + fragments + repeats
+
+
+def split_turns(text):
+    """[(speaker label or None, text)] in order; text before the first label (or without labels) has no speaker."""
+    turns = []
+    last_end = 0
+    label = None
+    for match in _SPEAKER_RE.finditer(text):
+        if match.start() > last_end or label is not None:
+            turns.append((label, text[last_end:match.start()]))
+        label = " ".join(match.group("label").split())
+        last_end = match.end()
+    turns.append((label, text[last_end:]))
+    return [(speaker, body.strip()) for speaker, body in turns if body.strip()]
+
+
+def _shingles(words):
+    if len(words) < SHINGLE_WORDS:
+        return {zlib.crc32(" ".join(words).encode("utf-8"))}
+    return {zlib.crc32(" ".join(words[i:i + SHINGLE_WORDS]).encode("utf-8"))
+            for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+class _DuplicateFilter:
+    """Remembers the sentences kept so far; an inverted shingle index finds near-duplicate candidates."""
+
+    def __init__(self, similarity):
+        self.similarity = similarity
+        self._exact = set()
+        self._sentences = []  # (shingles, numbers) per kept sentence
+        self._index = {}  # shingle -> [sentence index]
+
+    def is_duplicate(self, sentence):
+        words = _WORD_RE.findall(sentence.lower())
+        if len(words) < TRANSCRIPT_DEDUPE_MIN_WORDS:
+            return False
+        key = " ".join(words)
+        if key in self._exact:
+            return True
+        shingles = _shingles(words)
+        numbers = tuple(_NUMBER_RE.findall(key))
+        overlaps = {}
+        for shingle in shingles:
+            for index in self._index.get(shingle, ()):
+                overlaps[index] = overlaps.get(index, 0) + 1
+        for index, overlap in overlaps.items():
+            other_shingles, other_numbers = self._sentences[index]
+            if numbers != other_numbers:
+                continue
+            # Near-identical, or nothing in it that the earlier sentence did not already say.
+            if overlap == len(shingles) or overlap / len(shingles | other_shingles) >= self.similarity:
+                return True
+        self._exact.add(key)
+        for shingle in shingles:
+            self._index.setdefault(shingle, []).append(len(self._sentences))
+        self._sentences.append((shingles, numbers))
+        return False
+
+
+def is_small_talk(sentence):
+    """Keyword model: small-talk words, and no clinical word or number."""
+    words = set(_WORD_RE.findall(sentence.lower()))
+    return bool(words & SMALL_TALK_KEYWORDS) and not words & CLINICAL_KEYWORDS and not _NUMBER_RE.search(sentence)
+
+
+def compact_transcript(text, drop_small_talk=None, similarity=None):
+    """Returns (compacted text, CompactionReport). Text without speaker labels is compacted paragraph by paragraph."""
+    drop_small_talk = TRANSCRIPT_DROP_SMALL_TALK if drop_small_talk is None else drop_small_talk
+    similarity = TRANSCRIPT_NEAR_DUPLICATE_SIMILARITY if similarity is None else similarity
+    raw = text or ""
+    cleaned, timestamps = _strip_timestamps(raw.replace("\r\n", "\n"))
+    turns = split_turns(cleaned)
+    if all(speaker is None for speaker, _ in turns):
+        turns = [(None, paragraph) for paragraph in re.split(r"\n\s*\n", cleaned) if paragraph.strip()]
+
+    duplicates = {}  # (speaker, is question) -> _DuplicateFilter: only a speaker's own repeats are dropped
+    merged = []  # [speaker, [sentences]]
+    fillers = duplicates_removed = small_talk_removed = turns_merged = 0
+    for speaker, body in turns:
+        body, removed = _clean_disfluencies(" ".join(body.split()))
+        fillers += removed
+        sentences = []
+        for sentence in _SENTENCE_RE.findall(body):
+            sentence = sentence.strip()
+            if not sentence or not re.search(r"\w", sentence):
+                continue
+            sentence = sentence[0].upper() + sentence[1:]  # "she- she said" was cleaned to "she said"
+            if drop_small_talk and is_small_talk(sentence):
+                small_talk_removed += 1
+                continue
+            key = ((speaker or "").lower(), sentence.endswith("?"))
+            if key not in duplicates:
+                duplicates[key] = _DuplicateFilter(similarity)
+            if duplicates[key].is_duplicate(sentence):
+                duplicates_removed += 1
+            else:
+                sentences.append(sentence)
+        if not sentences:
+            continue
+        if speaker is not None and merged and merged[-1][0] is not None and merged[-1][0].lower() == speaker.lower():
+            merged[-1][1].extend(sentences)
+            turns_merged += 1
+        else:
+            merged.append([speaker, sentences])
+
+    separator = "\n" if any(speaker is not None for speaker, _ in merged) else "\n\n"
+    compacted = separator.join(f"{speaker}: {' '.join(sentences)}" if speaker else " ".join(sentences)
+                               for speaker, sentences in merged)
+    return compacted, CompactionReport(
+        raw_chars=len(raw), compact_chars=len(compacted), raw_tokens=estimate_tokens(raw),
+        compact_tokens=estimate_tokens(compacted), fillers_removed=fillers, timestamps_removed=timestamps,
+        turns_merged=turns_merged, duplicates_removed=duplicates_removed, small_talk_removed=small_talk_removed)
+
+
+def describe_report(report):
+    saved = 1 - report.compact_chars / report.raw_chars if report.raw_chars else 0.0
+    return (f"{report.raw_chars} -> {report.compact_chars} chars (~{report.raw_tokens} -> ~{report.compact_tokens} "
+            f"tokens, {saved:.0%} less); {report.fillers_removed} disfluencies, {report.timestamps_removed} "
+            f"timestamps, {report.duplicates_removed} repeated sentences and {report.small_talk_removed} small-talk "
+            f"sentences removed, {report.turns_merged} turns merged")
+
+
+def _regression_failures():
+    """Cases from review: clinical content that an earlier version of the cleanup removed."""
+    def compacted(text):
+        return compact_transcript(text, drop_small_talk=False)[0]
+
+    checks = (
+        ("orientation question with 'you know' kept",
+         "Do you know what year it is?" in compacted("Doctor: Do you know what year it is?")),
+        ("orientation question with 'you know ... right now' kept",
+         "Do you know where you are right now?" in compacted("Doctor: Do you know where you are right now?")),
+        ("'you know' between commas still removed",
+         compacted("Daughter: She repeats questions, you know, all day.")
+         == "Daughter: She repeats questions all day."),
+        ("'I mean' opening a clause still removed",
+         compacted("Patient: I mean, I forget things.") == "Patient: I forget things."),
+        ("answer echoing the question kept",
+         "Daughter: She gets lost while driving now." in compacted(
+             "Doctor: So she gets lost while driving now? Daughter: She gets lost while driving now.")),
+        ("same speaker's repeat still dropped",
+         compacted("Daughter: She repeats questions all day long. Daughter: She repeats questions all day.")
+         == "Daughter: She repeats questions all day long."),
+        ("number answering a question kept", "3" in compacted("Doctor: How many times?\n3")),
+        ("SRT cue numbers still removed",
+         compacted("1\n00:00:01,000 --> 00:00:03,000\nDoctor: Any falls?\n\n2\n00:00:04,000 --> 00:00:06,000\n"
+                   "Patient: Twice.") == "Doctor: Any falls?\nPatient: Twice."),
+        ("self-correction keeps the first word",
+         "March-- no, April" in compacted("Daughter: It started in March-- no, April.")),
+        ("stutter fragments still removed",
+         compacted("Daughter: Sh- she went-- went out.") == "Daughter: She went out."),
+    )
+    return [description for description, ok in checks if not ok]
+
+
+if __name__ == '__main__':
+    # python transcript_compaction.py [TRANSCRIPT.txt] [--small-talk]: regression cases, then the compacted
+    # transcript and report.
+    for failure in _regression_failures():
+        print(f"FAILED: {failure}")
+    args = [arg for arg in sys.argv[1:] if arg != "--small-talk"]
+    if args:
+        with open(args[0], "r", encoding="utf-8") as f:
+            sample = f.read()
+    else:
+        sample = ("[00:00:00] Doctor: Good morning, nice to see you again. Patient: Hi. Doctor: Um, so how has, "
+                  "uh, the memory been? Daughter: She- she repeats questions, you know, all day. Daughter: She "
+                  "repeats questions all day long. Daughter: She misplaced her keys 3 times this week.\n\n"
+                  "[00:00:40] Patient: I I think I'm fine. Doctor: Any falls? Patient: No. Doctor: Any falls at "
+                  "all? Patient: No. Daughter: The traffic was terrible getting here. Doctor: Is she still taking "
+                  "the donepezil 10 mg every night? Daughter: Yes. Daughter: Um, yes, every night.")
+    compacted_text, compaction_report = compact_transcript(sample, drop_small_talk="--small-talk" in sys.argv)
+    print(compacted_text)
+    print(f"\n{describe_report(compaction_report)}")